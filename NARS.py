@@ -20,8 +20,17 @@
 # THE SOFTWARE.
 import sys
 import os
+import errno
+import stat
 import re
 import shutil
+import bisect
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+import hashlib
+import pickle
 
 # ElementTree XML parser
 import xml.etree.ElementTree as ET
@@ -32,6 +41,12 @@ import xml.etree.ElementTree as ET
 # HOWEVER: the reduce command takes AGES checking the dependencies!!!
 import xml.etree.cElementTree as cET
 
+# Pillow is optional. It is only needed to transcode artwork (see Artwork_Transcoder).
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
 # ElementTree generated XML files are nasty looking (no end of lines).
 # Minidom does a much better job.
 # NOTE minidom is VERY SLOW.
@@ -177,16 +192,16 @@ def delete_CHD_directory(CHD_dir, __prog_option_dry_run):
   num_deleted_CHD = 0
 
   CHD_list = []
-  for file in os.listdir(CHD_dir):
-    if file.endswith(".chd"):
-      CHD_full_path = CHD_dir + '/' + file
-      if __DEBUG_delete_CHD_directory: 
-        print('CHD_list file {0}'.format(CHD_full_path))
-      CHD_list.append(CHD_full_path)
+  for file in fs_dir_snapshot(CHD_dir).file_list('.chd'):
+    CHD_full_path = CHD_dir + '/' + file
+    if __DEBUG_delete_CHD_directory: 
+      print('CHD_list file {0}'.format(CHD_full_path))
+    CHD_list.append(CHD_full_path)
+  fs_forget_dir_snapshot(CHD_dir)
 
   # Delete all CHD files inside directory
   if __prog_option_dry_run:
-    return
+    return len(CHD_list)
   for file in CHD_list:
     try:
       os.remove(file)
@@ -218,6 +233,239 @@ def have_dir_or_abort(dirName, infoStr):
     print_error('\033[31m[ERROR]\033[0m Directory does not exist ' + infoStr + ' = ' + dirName)
     sys.exit(10)
 
+# -------------------------------------------------------------------------------------------------
+# Rate limiter
+# -------------------------------------------------------------------------------------------------
+# An unthrottled sync can starve other programs reading the same disks (for
+# example, the emulators of the cabinets). The copy functions can be limited
+# in bytes per second and files per second with token buckets. The buckets
+# are shared by all the copy worker threads, so the limits apply to the whole
+# run and not to every worker.
+#
+# Bytes are accounted when written, in chunks of at most chunk_size, so the
+# throughput is smooth even for multi-GB files. A reflink writes no data and
+# costs only a file token.
+#
+class Token_Bucket:
+  # capacity is the burst size. Default is one second of rate.
+  def __init__(self, rate, capacity = None):
+    self.rate = float(rate)
+    self.capacity = float(capacity if capacity else rate)
+    self.tokens = self.capacity
+    self.timestamp = time.monotonic()
+    self.lock = threading.Lock()
+
+  # Takes amount tokens, sleeping until they are available. Callers reserve
+  # tokens in order (the bucket may go into debt), so threads are served fairly.
+  def consume(self, amount):
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+      self.timestamp = now
+      self.tokens -= amount
+      wait_time = -self.tokens / self.rate if self.tokens < 0 else 0.0
+    if wait_time > 0:
+      time.sleep(wait_time)
+
+class Rate_Limiter:
+  def __init__(self):
+    self.configure(0, 0)
+
+  # 0 means no limit.
+  def configure(self, bytes_per_second, files_per_second):
+    self.byte_bucket = Token_Bucket(bytes_per_second) if bytes_per_second > 0 else None
+    self.file_bucket = Token_Bucket(files_per_second) if files_per_second > 0 else None
+    # About 16 chunks per second, between 64 KiB and 1 MiB
+    self.chunk_size = 1024 * 1024
+    if bytes_per_second > 0:
+      self.chunk_size = max(64 * 1024, min(1024 * 1024, bytes_per_second // 16))
+
+  def begin_file(self):
+    if self.file_bucket is not None: self.file_bucket.consume(1)
+
+  # Returns how many of remaining bytes can be written now. If bytes are not
+  # limited that is all of them.
+  def acquire_bytes(self, remaining):
+    if self.byte_bucket is None: return remaining
+    num_bytes = min(remaining, self.chunk_size)
+    self.byte_bucket.consume(num_bytes)
+
+    return num_bytes
+
+  def consume_bytes(self, num_bytes):
+    if self.byte_bucket is not None and num_bytes > 0: self.byte_bucket.consume(num_bytes)
+
+rate_limiter = Rate_Limiter()
+
+def set_rate_limit(bytes_per_second, files_per_second):
+  if bytes_per_second > 0:
+    print_info('Limiting copy to {0} bytes/s'.format(bytes_per_second))
+  if files_per_second > 0:
+    print_info('Limiting copy to {0} files/s'.format(files_per_second))
+  rate_limiter.configure(bytes_per_second, files_per_second)
+
+# Parses a rate like '500', '64K', '20M' or '1G' (powers of 1024).
+# Returns an integer or raises ValueError.
+rate_suffix_dic = {'K' : 1024, 'M' : 1024 ** 2, 'G' : 1024 ** 3}
+def parse_rate_string(rate_str):
+  rate_str = rate_str.strip().upper()
+  multiplier = 1
+  if rate_str and rate_str[-1] in rate_suffix_dic:
+    multiplier = rate_suffix_dic[rate_str[-1]]
+    rate_str = rate_str[:-1]
+  rate = int(float(rate_str) * multiplier)
+  if rate < 0:
+    raise ValueError('Negative rate')
+
+  return rate
+
+# -------------------------------------------------------------------------------------------------
+# File transfer strategies
+# -------------------------------------------------------------------------------------------------
+# shutil.copy() reads the source into a user space buffer and writes it back.
+# The kernel can do much better: a reflink (FICLONE, btrfs/XFS) shares the
+# data blocks and costs nothing, copy_file_range() copies inside the kernel
+# (and the filesystem may offload it), and sendfile() at least avoids the user
+# space buffers. The first strategy that works is remembered for every pair
+# (source directory, destination directory), so the capability probe is done
+# on the first file copied and the other files go straight to the good one.
+#
+# Each strategy raises Transfer_Unsupported if it cannot be used between the
+# two files, and EnvironmentError on real errors.
+#
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errno values that mean "this strategy cannot be used here", not "copy failed".
+transfer_unsupported_errno = set([errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS,
+                                  errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ETXTBSY])
+
+class Transfer_Unsupported(Exception):
+  pass
+
+def fs_transfer_unsupported(exception):
+  return exception.errno in transfer_unsupported_errno
+
+def fs_copy_reflink(source_file, dest_file, size):
+  if fcntl is None:
+    raise Transfer_Unsupported('fcntl not available')
+  try:
+    fcntl.ioctl(dest_file.fileno(), FICLONE, source_file.fileno())
+  except OSError as e:
+    if fs_transfer_unsupported(e): raise Transfer_Unsupported(str(e))
+    raise
+
+def fs_copy_file_range(source_file, dest_file, size):
+  if not hasattr(os, 'copy_file_range'):
+    raise Transfer_Unsupported('os.copy_file_range() not available')
+  offset = 0
+  while offset < size:
+    count = rate_limiter.acquire_bytes(size - offset)
+    try:
+      n = os.copy_file_range(source_file.fileno(), dest_file.fileno(), count, offset, offset)
+    except OSError as e:
+      if offset == 0 and fs_transfer_unsupported(e): raise Transfer_Unsupported(str(e))
+      raise
+    # Some filesystems (procfs, some FUSE) return 0 instead of an error.
+    # Later, 0 means the source is shorter than when the copy started.
+    if n == 0:
+      if offset == 0: raise Transfer_Unsupported('copy_file_range() copied nothing')
+      raise OSError(errno.EIO, 'Short copy, source truncated while copying')
+    offset += n
+
+def fs_copy_sendfile(source_file, dest_file, size):
+  if not hasattr(os, 'sendfile'):
+    raise Transfer_Unsupported('os.sendfile() not available')
+  offset = 0
+  while offset < size:
+    count = rate_limiter.acquire_bytes(size - offset)
+    try:
+      n = os.sendfile(dest_file.fileno(), source_file.fileno(), offset, count)
+    except OSError as e:
+      if offset == 0 and fs_transfer_unsupported(e): raise Transfer_Unsupported(str(e))
+      raise
+    if n == 0:
+      if offset == 0: raise Transfer_Unsupported('sendfile() copied nothing')
+      raise OSError(errno.EIO, 'Short copy, source truncated while copying')
+    offset += n
+
+def fs_copy_stream(source_file, dest_file, size):
+  while True:
+    block = source_file.read(rate_limiter.acquire_bytes(1024 * 1024))
+    if not block: break
+    dest_file.write(block)
+
+transfer_strategy_list = [
+  ('reflink',         fs_copy_reflink),
+  ('copy_file_range', fs_copy_file_range),
+  ('sendfile',        fs_copy_sendfile),
+  ('stream',          fs_copy_stream)
+]
+
+# Key (source directory, destination directory), value index in transfer_strategy_list.
+transfer_strategy_dic = {}
+transfer_strategy_lock = threading.Lock()
+
+# Files are written into a temporary file in the destination directory and
+# renamed with os.replace() when complete, so an interrupted copy never leaves
+# a truncated file under the final name.
+def fs_temp_path(dest_path):
+  (dest_dir, dest_name) = os.path.split(dest_path)
+
+  return os.path.join(dest_dir, '.' + dest_name + '.nars-tmp')
+
+def fs_remove_temp(temp_path):
+  try:
+    os.remove(temp_path)
+  except OSError:
+    pass
+
+# Copies source_path into dest_path, and the permission bits like shutil.copy().
+# Raises EnvironmentError if copy fails.
+def fs_copy(source_path, dest_path):
+  key = (os.path.dirname(source_path), os.path.dirname(dest_path))
+  with transfer_strategy_lock:
+    index = transfer_strategy_dic.get(key, 0)
+
+  rate_limiter.begin_file()
+  temp_path = fs_temp_path(dest_path)
+  try:
+    fs_copy_into(source_path, temp_path, key, index)
+    os.replace(temp_path, dest_path)
+  except BaseException:
+    fs_remove_temp(temp_path)
+    raise
+
+def fs_copy_into(source_path, dest_path, key, index):
+  with open(source_path, 'rb') as source_file:
+    source_stat = os.fstat(source_file.fileno())
+    with open(dest_path, 'wb') as dest_file:
+      while True:
+        (strategy_name, strategy) = transfer_strategy_list[index]
+        try:
+          strategy(source_file, dest_file, source_stat.st_size)
+          break
+        except Transfer_Unsupported as e:
+          print_debug('fs_copy >> {0} unsupported ({1})'.format(strategy_name, e))
+          index += 1
+          dest_file.seek(0)
+          dest_file.truncate()
+          source_file.seek(0)
+      if hasattr(os, 'fchmod'):
+        os.fchmod(dest_file.fileno(), source_stat.st_mode & 0o7777)
+
+  if key not in transfer_strategy_dic:
+    print_debug('fs_copy >> Using {0} for {1} -> {2}'.format(strategy_name, key[0], key[1]))
+  with transfer_strategy_lock:
+    transfer_strategy_dic[key] = index
+  if not hasattr(os, 'fchmod'):
+    shutil.copymode(source_path, dest_path)
+
 #
 # Returns:
 #  0  File copied, no error
@@ -236,7 +484,7 @@ def copy_file(source_path, dest_path, __prog_option_dry_run):
     return 0
     
   try:
-    shutil.copy(source_path, dest_path)
+    fs_copy(source_path, dest_path)
   except EnvironmentError:
     print_info('[WARNING] copy_file >> source_path {0}'.format(source_path))
     print_info('[WARNING] copy_file >> dest_path {0}'.format(dest_path))
@@ -246,74 +494,959 @@ def copy_file(source_path, dest_path, __prog_option_dry_run):
   return 0
 
 # Returns:
-#  0  File copied (sizes different)
+#  0  File copied (sizes or contents different)
 #  1  Source file missing
 #  2  File not copied (updated)
 # -1  Copy/Stat error (exception)
-def update_file(source_path, dest_path, __prog_option_dry_run):
+#
+# If digest_cache is a Digest_Cache, files with the same size are also compared
+# by content (content verified sync).
+def update_file(source_path, dest_path, __prog_option_dry_run, digest_cache = None):
   print_debug('Updating ' + source_path)
   print_debug('Into     ' + dest_path)
 
-  existsSource = os.path.isfile(source_path)
-  existsDest = os.path.isfile(dest_path)
-  if not existsSource:
+  # One stat() per file, instead of isfile() and getsize()
+  try:
+    sizeSource = os.stat(source_path).st_size
+  except OSError:
     return 1
-
-  sizeSource = os.path.getsize(source_path)
-  if existsDest:
-    sizeDest = os.path.getsize(dest_path)
-  else:
+  try:
+    sizeDest = os.stat(dest_path).st_size
+  except OSError:
     sizeDest = -1
 
   # If sizes are equal. Skip copy and return 2
+  source_digest = None
   if sizeSource == sizeDest:
-    return 2
+    if digest_cache is None:
+      return 2
+    try:
+      source_digest = digest_cache.get_digest(source_path)
+      if source_digest == digest_cache.get_digest(dest_path):
+        return 2
+    except EnvironmentError:
+      print_info('[WARNING] update_file >> Cannot hash {0} or {1}'.format(source_path, dest_path))
+      return -1
+    print_verb('<Content changed> ' + dest_path)
 
-  # destFile does not exist or sizes are different, copy.
+  # destFile does not exist or sizes/contents are different, copy.
   if __prog_option_dry_run:
     return 0
 
   try:
-    shutil.copy(source_path, dest_path)
+    fs_copy(source_path, dest_path)
   except EnvironmentError:
     print_info('[WARNING] update_file >> source_path {0}'.format(source_path))
     print_info('[WARNING] update_file >> dest_path {0}'.format(dest_path))
     print_info('[WARNING] update_file >> Exception EnvironmentError triggered')
     return -1
+  if source_digest is not None:
+    digest_cache.set_digest(dest_path, source_digest)
 
   return 0
 
+# -------------------------------------------------------------------------------------------------
+# Link mode
+# -------------------------------------------------------------------------------------------------
+# When source and destination are on the same volume a filtered view of a ROM
+# set does not need copies. In link mode the destination files are hardlinks
+# ('hard') or relative symlinks ('sym') to the source files. A hardlink
+# requires both directories on the same filesystem.
+#
+link_mode_list = ['hard', 'sym']
+
+# True if dest_path is already a link of the requested kind to source_path.
+def fs_is_link_to(source_path, dest_path, link_mode):
+  try:
+    if link_mode == 'sym':
+      if not os.path.islink(dest_path): return False
+      link_target = os.path.join(os.path.dirname(dest_path), os.readlink(dest_path))
+      return os.path.normpath(link_target) == os.path.normpath(source_path)
+    else:
+      # os.path.samefile() follows symlinks, so a symlink to the source would
+      # pass as a hardlink. Look at the destination entry itself.
+      dest_stat = os.lstat(dest_path)
+      if stat.S_ISLNK(dest_stat.st_mode): return False
+      source_stat = os.stat(source_path)
+      return dest_stat.st_ino == source_stat.st_ino and dest_stat.st_dev == source_stat.st_dev
+  except OSError:
+    return False
+
+#
+# Returns:
+#  0  Link created
+#  1  Source file missing
+#  2  Link already correct (not touched)
+# -1  Link error (exception)
+#
+def link_file(source_path, dest_path, __prog_option_dry_run, link_mode):
+  print_debug('Linking ' + source_path)
+  print_debug('Into    ' + dest_path)
+
+  if not os.path.isfile(source_path):
+    return 1
+  if fs_is_link_to(source_path, dest_path, link_mode):
+    return 2
+
+  if __prog_option_dry_run:
+    return 0
+
+  # The link is made with a temporary name and replaces the copy or stale link
+  # that may be in the way in one step.
+  rate_limiter.begin_file()
+  temp_path = fs_temp_path(dest_path)
+  try:
+    fs_remove_temp(temp_path)
+    if link_mode == 'sym':
+      os.symlink(os.path.relpath(source_path, os.path.dirname(dest_path)), temp_path)
+    else:
+      os.link(source_path, temp_path)
+    os.replace(temp_path, dest_path)
+  except EnvironmentError:
+    fs_remove_temp(temp_path)
+    print_info('[WARNING] link_file >> source_path {0}'.format(source_path))
+    print_info('[WARNING] link_file >> dest_path {0}'.format(dest_path))
+    print_info('[WARNING] link_file >> Exception EnvironmentError triggered')
+    return -1
+
+  return 0
+
+# -------------------------------------------------------------------------------------------------
+# Content digests
+# -------------------------------------------------------------------------------------------------
+# In content verified sync mode update_file() does not trust file sizes only.
+# If source and destination have the same size their contents are hashed and
+# the file is copied only if the digests are different. BLAKE2b is the fastest
+# hash in hashlib.
+#
+# Digests are cached in a file with key the file path and value a tuple
+# (size, mtime_ns, digest). A cached digest is valid while the file size and
+# mtime do not change, so every file is hashed only once. The cache is shared
+# by the copy worker threads.
+#
+digest_cache_filename = '.nars-digest-cache'
+digest_cache_version = 1
+
+def fs_file_digest(file_path):
+  digest = hashlib.blake2b(digest_size = 20)
+  with open(file_path, 'rb') as f:
+    while True:
+      block = f.read(1024 * 1024)
+      if not block: break
+      digest.update(block)
+
+  return digest.hexdigest()
+
+class Digest_Cache:
+  version = digest_cache_version
+
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.entries = {}
+    if not os.path.isfile(self.filename):
+      return
+    try:
+      with open(self.filename, 'rb') as f:
+        digest_cache = pickle.load(f)
+      if digest_cache['version'] == self.version:
+        self.entries = digest_cache['entries']
+    except (EnvironmentError, pickle.UnpicklingError, EOFError, KeyError):
+      print_info('[WARNING] Digest_Cache >> Cannot read digest cache {0}'.format(self.filename))
+
+  # Returns the digest of file_path, hashing the file only if needed.
+  def get_digest(self, file_path):
+    stat = os.stat(file_path)
+    key = os.path.abspath(file_path)
+    with self.lock:
+      entry = self.entries.get(key)
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+      return entry[2]
+    digest = self.compute_digest(file_path)
+    self.set_digest(file_path, digest, stat)
+
+    return digest
+
+  # Returns the cached digest of file_path, or None if there is no valid cached
+  # digest. Never hashes the file.
+  def get_cached_digest(self, file_path):
+    stat = os.stat(file_path)
+    with self.lock:
+      entry = self.entries.get(os.path.abspath(file_path))
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+      return entry[2]
+
+    return None
+
+  def compute_digest(self, file_path):
+    return fs_file_digest(file_path)
+
+  # Sets the digest of a file whose contents are known (for example, just copied).
+  def set_digest(self, file_path, digest, stat = None):
+    if stat is None: stat = os.stat(file_path)
+    with self.lock:
+      self.entries[os.path.abspath(file_path)] = (stat.st_size, stat.st_mtime_ns, digest)
+
+  def save(self):
+    temp_filename = self.filename + '.tmp'
+    try:
+      with self.lock:
+        with open(temp_filename, 'wb') as f:
+          pickle.dump({'version' : self.version, 'entries' : self.entries}, f,
+                      pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_filename, self.filename)
+    except EnvironmentError:
+      print_info('[WARNING] Digest_Cache >> Cannot write digest cache {0}'.format(self.filename))
+
+# -------------------------------------------------------------------------------------------------
+# Delta sync
+# -------------------------------------------------------------------------------------------------
+# CHDs can be tens of GB and a small change in the source (for example, a new
+# CHD version) makes update_file() copy the whole file again. In delta mode
+# files are split in fixed size blocks and every block is hashed. Only the
+# blocks with a different digest are rewritten, in a clone (reflink) of the
+# destination file, and the clone is truncated to the source size.
+#
+# Without reflinks cloning the destination is a full copy of it, so changed
+# files are copied whole with fs_copy(). Directories where cloning failed are
+# remembered, and there files with a different size are copied without hashing
+# them first.
+#
+# Block digests are cached like file digests (see Digest_Cache). Running again
+# against an unchanged source costs only a stat() of the source and the
+# destination. In dry run mode files are not hashed: cached digests are used
+# if valid, otherwise files are compared by size.
+#
+delta_block_size = 4 * 1024 * 1024
+block_digest_cache_filename = '.nars-block-digest-cache'
+block_digest_cache_version = 1
+
+# Destination directories where fs_clone_into() is not supported.
+delta_no_clone_set = set()
+
+# Returns a tuple with the digest of every block of file_path.
+def fs_file_block_digests(file_path):
+  digest_list = []
+  with open(file_path, 'rb') as f:
+    while True:
+      block = f.read(delta_block_size)
+      if not block: break
+      digest_list.append(hashlib.blake2b(block, digest_size = 20).digest())
+
+  return tuple(digest_list)
+
+class Block_Digest_Cache(Digest_Cache):
+  version = block_digest_cache_version
+
+  def compute_digest(self, file_path):
+    return fs_file_block_digests(file_path)
+
+# Clones source_path into dest_path (reflink). dest_path is removed if the
+# clone fails. Raises Transfer_Unsupported if the filesystem cannot clone and
+# EnvironmentError if clone fails.
+def fs_clone_into(source_path, dest_path):
+  try:
+    with open(source_path, 'rb') as source_file, open(dest_path, 'wb') as dest_file:
+      fs_copy_reflink(source_file, dest_file, 0)
+    shutil.copymode(source_path, dest_path)
+  except BaseException:
+    fs_remove_temp(dest_path)
+    raise
+
+#
+# Like update_file() but only rewrites the blocks of dest_path that are
+# different from source_path. dest_path is never written in place: it is
+# cloned into a temporary file (see fs_temp_path()), the blocks are rewritten
+# there, and the temporary file replaces dest_path. An interrupted delta
+# update leaves dest_path untouched. If dest_path is a symlink or a hardlink
+# (--link), or the filesystem cannot clone it, it is replaced by a full copy
+# and the linked file is never written.
+# Returns:
+#  0  File copied or blocks rewritten
+#  1  Source file missing
+#  2  File not copied (updated)
+# -1  Copy/Stat error (exception)
+#
+def delta_update_file(source_path, dest_path, __prog_option_dry_run, block_digest_cache):
+  print_debug('Delta updating ' + source_path)
+  print_debug('Into           ' + dest_path)
+
+  try:
+    sizeSource = os.stat(source_path).st_size
+  except OSError:
+    return 1
+  # New files are copied normally
+  if not os.path.isfile(dest_path):
+    return update_file(source_path, dest_path, __prog_option_dry_run)
+
+  try:
+    sizeDest = os.stat(dest_path).st_size
+    if __prog_option_dry_run:
+      if sizeSource != sizeDest: return 0
+      source_digests = block_digest_cache.get_cached_digest(source_path)
+      dest_digests = block_digest_cache.get_cached_digest(dest_path)
+      if source_digests is None or dest_digests is None: return 2
+      return 2 if source_digests == dest_digests else 0
+
+    dest_dir = os.path.dirname(os.path.abspath(dest_path))
+    with transfer_strategy_lock:
+      can_clone = dest_dir not in delta_no_clone_set
+    if not can_clone and sizeSource != sizeDest:
+      fs_copy(source_path, dest_path)
+      return 0
+
+    source_digests = block_digest_cache.get_digest(source_path)
+    dest_digests = block_digest_cache.get_digest(dest_path)
+    if sizeSource == sizeDest and source_digests == dest_digests:
+      return 2
+
+    if os.path.islink(dest_path) or os.stat(dest_path).st_nlink > 1:
+      fs_copy(source_path, dest_path)
+      block_digest_cache.set_digest(dest_path, source_digests)
+      print_verb('<Delta> Linked {0} replaced by a copy'.format(dest_path))
+      return 0
+
+    num_blocks = 0
+    temp_path = fs_temp_path(dest_path)
+    if can_clone:
+      try:
+        fs_clone_into(dest_path, temp_path)
+      except Transfer_Unsupported as e:
+        print_debug('delta_update_file >> Clone unsupported in {0} ({1})'.format(dest_dir, e))
+        with transfer_strategy_lock:
+          delta_no_clone_set.add(dest_dir)
+        can_clone = False
+    if not can_clone:
+      fs_copy(source_path, dest_path)
+      block_digest_cache.set_digest(dest_path, source_digests)
+      print_verb('<Delta> {0} copied (clone unsupported)'.format(dest_path))
+      return 0
+
+    rate_limiter.begin_file()
+    try:
+      with open(source_path, 'rb') as source_file, open(temp_path, 'r+b') as dest_file:
+        for (index, digest) in enumerate(source_digests):
+          if index < len(dest_digests) and dest_digests[index] == digest: continue
+          source_file.seek(index * delta_block_size)
+          dest_file.seek(index * delta_block_size)
+          block_size = delta_block_size
+          while block_size > 0:
+            block = source_file.read(rate_limiter.acquire_bytes(block_size))
+            if not block: break
+            dest_file.write(block)
+            block_size -= len(block)
+          num_blocks += 1
+        dest_file.truncate(sizeSource)
+      os.replace(temp_path, dest_path)
+    except BaseException:
+      fs_remove_temp(temp_path)
+      raise
+  except EnvironmentError:
+    print_info('[WARNING] delta_update_file >> source_path {0}'.format(source_path))
+    print_info('[WARNING] delta_update_file >> dest_path {0}'.format(dest_path))
+    print_info('[WARNING] delta_update_file >> Exception EnvironmentError triggered')
+    return -1
+  block_digest_cache.set_digest(dest_path, source_digests)
+  print_verb('<Delta> {0} blocks of {1} rewritten in {2}'.format(num_blocks, len(source_digests), dest_path))
+
+  return 0
+
+# -------------------------------------------------------------------------------------------------
+# Directory snapshots
+# -------------------------------------------------------------------------------------------------
+# Listing the same directories again and again (source ROMs, destination ROMs,
+# artwork) and calling isfile()/getsize() per file is slow on network and USB
+# drives. A snapshot reads a directory with one os.scandir() and keeps the
+# names of the files. Most callers only need names, which os.scandir() gets
+# without a stat() per file. A file is stat()ed the first time its stats are
+# asked for (see get_stat()), so a small copy list taken from a huge source
+# directory only stats the files it copies. Snapshots are cached, so every
+# phase of a command (scan, sync manifest, copy, clean) shares them.
+#
+# Functions that modify a directory must call fs_forget_dir_snapshot() when
+# they are done, so next phase takes a fresh snapshot.
+#
+class Dir_Snapshot:
+  def __init__(self, directory):
+    self.directory = directory
+    self.entry_dic = {}     # key = file name : value = os.DirEntry (caches its stat())
+    self.dir_set = set()    # directory names
+    self.link_set = set()   # symlink names (to files, to directories or dangling)
+    self.ext_dic = None     # key = base name : value = {lowercase extension : file name}, see resolve()
+    self.exists = True
+    try:
+      with os.scandir(directory) as dir_iterator:
+        for entry in dir_iterator:
+          try:
+            if entry.is_symlink():
+              self.link_set.add(entry.name)
+            if entry.is_dir():
+              self.dir_set.add(entry.name)
+            elif entry.is_file():
+              self.entry_dic[entry.name] = entry
+          except OSError:
+            pass
+    except FileNotFoundError:
+      self.exists = False
+
+  def has_file(self, name):
+    return name in self.entry_dic
+
+  # Returns the (size, mtime_ns, inode) of a file, or None if file does not exist.
+  # The file is stat()ed on first call only.
+  def get_stat(self, name):
+    entry = self.entry_dic.get(name)
+    if entry is None: return None
+    try:
+      stat = entry.stat()
+    except OSError:
+      return None
+
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+  # Returns a list of the file names ending in endswith.
+  def file_list(self, endswith = ''):
+    return [name for name in self.entry_dic if name.endswith(endswith)]
+
+  # Symlinks whose target does not exist.
+  def is_dangling(self, name):
+    return name in self.link_set and name not in self.entry_dic and name not in self.dir_set
+
+  # Returns the name of the file with base name baseName and the first extension
+  # of ext_list found (extensions compared lowercase), or None if there is no
+  # such file. The base name map is built from the snapshot on first use, so a
+  # lookup never stats the filesystem, whatever the number of extensions.
+  # Building the map twice from 2 threads is harmless.
+  def resolve(self, baseName, ext_list):
+    if self.ext_dic is None:
+      ext_dic = {}
+      for name in self.entry_dic:
+        base, ext = os.path.splitext(name)
+        ext_dic.setdefault(base, {})[ext.lower()] = name
+      self.ext_dic = ext_dic
+    name_dic = self.ext_dic.get(baseName)
+    if name_dic is None: return None
+    for ext in ext_list:
+      name = name_dic.get(ext)
+      if name is not None: return name
+
+    return None
+
+# key = normalised directory : value = Dir_Snapshot
+dir_snapshot_dic = {}
+dir_snapshot_lock = threading.Lock()
+
+def fs_dir_snapshot(directory):
+  key = os.path.normpath(directory)
+  with dir_snapshot_lock:
+    snapshot = dir_snapshot_dic.get(key)
+  if snapshot is None:
+    snapshot = Dir_Snapshot(directory)
+    with dir_snapshot_lock:
+      dir_snapshot_dic[key] = snapshot
+
+  return snapshot
+
+def fs_forget_dir_snapshot(directory):
+  with dir_snapshot_lock:
+    dir_snapshot_dic.pop(os.path.normpath(directory), None)
+
+# -------------------------------------------------------------------------------------------------
+# Sync manifest
+# -------------------------------------------------------------------------------------------------
+# Every destination directory has a manifest file with the state of the files
+# after the last successful sync. For every file (key is the path relative to
+# destDir) it stores the (size, mtime, inode) of the source and the destination
+# files.
+#
+# In sync (update) mode the source and destination directories are read with
+# one os.scandir() each, and only the files to be synced are stat()ed (see
+# Dir_Snapshot). If the source and destination stats of a file are
+# the same as in the manifest the file is up to date and is not touched at all.
+# Only new or changed files go through update_file().
+#
+sync_manifest_filename = '.nars-sync-manifest'
+sync_manifest_version = 1
+
+class Sync_Manifest:
+  def __init__(self, destDir):
+    self.filename = destDir + sync_manifest_filename
+    self.entries = {}       # key = relative path : value = (source stat, dest stat)
+    self.source_stats = {}  # key = relative path : value = source stat of this run
+    self.dest_stats = {}    # key = relative path : value = dest stat of this run
+    if not os.path.isfile(self.filename):
+      return
+    try:
+      with open(self.filename, 'rb') as f:
+        manifest = pickle.load(f)
+      if manifest['version'] == sync_manifest_version:
+        self.entries = manifest['entries']
+    except (EnvironmentError, pickle.UnpicklingError, EOFError, KeyError):
+      print_info('[WARNING] Sync_Manifest >> Cannot read manifest {0}'.format(self.filename))
+
+  # Reads the stats of the files in name_list in source_dir and dest_dir.
+  # Keys are prefix + file name.
+  def scan(self, source_dir, dest_dir, name_list, prefix = ''):
+    source_snapshot = fs_dir_snapshot(source_dir)
+    dest_snapshot = fs_dir_snapshot(dest_dir)
+    for name in name_list:
+      source_stat = source_snapshot.get_stat(name)
+      if source_stat is not None: self.source_stats[prefix + name] = source_stat
+      dest_stat = dest_snapshot.get_stat(name)
+      if dest_stat is not None: self.dest_stats[prefix + name] = dest_stat
+
+  def get_source_size(self, key):
+    if key in self.source_stats: return self.source_stats[key][0]
+
+    return None
+
+  # True if file has not changed since the last sync.
+  def is_unchanged(self, key):
+    if key not in self.entries: return False
+    if key not in self.source_stats or key not in self.dest_stats: return False
+
+    return self.entries[key] == (self.source_stats[key], self.dest_stats[key])
+
+  # Records the current state of a synced file.
+  def record(self, key, source_path, dest_path):
+    try:
+      source_stat = os.stat(source_path)
+      dest_stat = os.stat(dest_path)
+    except OSError:
+      self.entries.pop(key, None)
+      return
+    self.entries[key] = ((source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino),
+                         (dest_stat.st_size, dest_stat.st_mtime_ns, dest_stat.st_ino))
+
+  def forget(self, key):
+    self.entries.pop(key, None)
+
+  def save(self):
+    temp_filename = self.filename + '.tmp'
+    try:
+      with open(temp_filename, 'wb') as f:
+        pickle.dump({'version' : sync_manifest_version, 'entries' : self.entries}, f,
+                    pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_filename, self.filename)
+    except EnvironmentError:
+      print_info('[WARNING] Sync_Manifest >> Cannot write manifest {0}'.format(self.filename))
+
+# -------------------------------------------------------------------------------------------------
+# Sync journal
+# -------------------------------------------------------------------------------------------------
+# Write-ahead journal of an update run. Before a file is transferred a begin
+# line is appended to the journal and flushed, and when a file is actually
+# copied a done line with the source (size, mtime). Files found up to date get
+# no done line. The journal is deleted when the run finishes. Plain copy runs
+# copy every file anyway and do not keep a journal.
+#
+# If a run is interrupted the journal is still there. Next run skips the files
+# done (if the source did not change and the destination is still there with
+# the source size) and deletes the temporary files of the files begun but not
+# finished. Lines are separated by tabs, and the key (the path relative to
+# destDir) is always the last field.
+#
+#   B<tab>key
+#   D<tab>size<tab>mtime_ns<tab>key
+#
+sync_journal_filename = '.nars-sync-journal'
+
+class Sync_Journal:
+  def __init__(self, destDir):
+    self.filename = destDir + sync_journal_filename
+    # done_dic = { key : (source_size, source_mtime_ns) }
+    self.done_dic = {}
+    begun_set = set()
+    if os.path.isfile(self.filename):
+      with open(self.filename, 'r', encoding = 'utf-8') as f:
+        for line in f:
+          # The last line may be truncated if the process was killed. Malformed
+          # lines are skipped.
+          fields = line.rstrip('\n').split('\t')
+          if fields[0] == 'B' and len(fields) == 2:
+            begun_set.add(fields[1])
+          elif fields[0] == 'D' and len(fields) == 4:
+            try:
+              self.done_dic[fields[3]] = (int(fields[1]), int(fields[2]))
+            except ValueError:
+              continue
+            begun_set.discard(fields[3])
+      print_info('Resuming interrupted sync ({0} files done)'.format(len(self.done_dic)))
+      # Partial files of the interrupted run
+      for key in begun_set:
+        fs_remove_temp(fs_temp_path(destDir + key))
+    self.file = open(self.filename, 'a', encoding = 'utf-8')
+
+  # True if file was done in the interrupted run, source did not change since
+  # and destination was not deleted or truncated since.
+  def is_done(self, copy_item):
+    if copy_item[2] not in self.done_dic: return False
+    try:
+      stat = os.stat(copy_item[0])
+      dest_stat = os.stat(copy_item[1])
+    except OSError:
+      return False
+
+    return self.done_dic[copy_item[2]] == (stat.st_size, stat.st_mtime_ns) and dest_stat.st_size == stat.st_size
+
+  def begin(self, copy_item):
+    self.file.write('B\t{0}\n'.format(copy_item[2]))
+    self.file.flush()
+
+  def done(self, copy_item):
+    try:
+      stat = os.stat(copy_item[0])
+    except OSError:
+      return
+    self.file.write('D\t{0}\t{1}\t{2}\n'.format(stat.st_size, stat.st_mtime_ns, copy_item[2]))
+    self.file.flush()
+
+  # Run finished, nothing to resume.
+  def close(self):
+    self.file.close()
+    try:
+      os.remove(self.filename)
+    except OSError:
+      print_info('[WARNING] Sync_Journal >> Cannot delete journal {0}'.format(self.filename))
+
+# -------------------------------------------------------------------------------------------------
+# Parallel copy engine
+# -------------------------------------------------------------------------------------------------
+# Copying files one at a time is bounded by per-file latency (NAS, USB drives),
+# not by bandwidth. copy_file_list() copies files with a bounded pool of worker
+# threads. Files are scheduled in 2 lanes:
+#  a) Small files (ROM ZIPs) use a pool with num_workers threads.
+#  b) Large files (size >= large_file_threshold, CHDs) use a separate pool with
+#     num_workers / 4 threads (at least 1).
+# Small files never wait behind a multi-GB CHD, and a few CHDs cannot use all
+# the bandwidth.
+#
+# Workers only copy files. Reporting and counters are done by the caller, in the
+# main thread, as results arrive.
+#
+large_file_threshold = 256 * 1024 * 1024
+
+# If delta is True digest_cache must be a Block_Digest_Cache (see delta_update_file()).
+def transfer_file(source_path, dest_path, __prog_option_sync, __prog_option_dry_run, digest_cache = None,
+                  link_mode = None, delta = False):
+  if link_mode:
+    return link_file(source_path, dest_path, __prog_option_dry_run, link_mode)
+  elif __prog_option_sync and delta:
+    return delta_update_file(source_path, dest_path, __prog_option_dry_run, digest_cache)
+  elif __prog_option_sync:
+    return update_file(source_path, dest_path, __prog_option_dry_run, digest_cache)
+  else:
+    return copy_file(source_path, dest_path, __prog_option_dry_run)
+
+#
+# copy_list is a list of tuples (source_path, dest_path, report_name), where
+# report_name is the path relative to destDir.
+# This is a generator: it yields (copy_item, ret) for every file in copy_list,
+# where ret is the copy_file()/update_file() return value. If there is only
+# 1 worker files are copied in order in the caller thread. Otherwise files are
+# yielded in completion order.
+#
+# If manifest is a Sync_Manifest (already scanned), in sync mode files that did
+# not change since the last sync are reported as up to date (ret = 2) without
+# touching them. Synced files are recorded in the manifest, and the manifest is
+# saved when all the files are done.
+#
+# If digest_cache is a Digest_Cache files are synced comparing contents (see
+# update_file()). If delta is True digest_cache must be a Block_Digest_Cache and
+# files are synced block by block (see delta_update_file()). The digest cache is
+# saved when all the files are done.
+#
+# If link_mode is 'hard' or 'sym' files are linked instead of copied (see
+# link_file()).
+#
+# If journal is a Sync_Journal files done in an interrupted run are reported as
+# up to date (ret = 2) and copied files are journaled. If all the files are done
+# the journal is closed (deleted). If the caller stops consuming the generator
+# the journal is kept, and next run resumes.
+#
+def copy_file_list(copy_list, __prog_option_sync, __prog_option_dry_run, num_workers = 1,
+                   manifest = None, digest_cache = None, link_mode = None, journal = None, delta = False):
+  for (copy_item, ret) in copy_file_list_unrecorded(copy_list, __prog_option_sync, __prog_option_dry_run,
+                                                    num_workers, manifest, digest_cache, link_mode, journal,
+                                                    delta):
+    if manifest is not None and not __prog_option_dry_run:
+      if ret == 0 or ret == 2: manifest.record(copy_item[2], copy_item[0], copy_item[1])
+      else:                    manifest.forget(copy_item[2])
+    if journal is not None and ret == 0:
+      journal.done(copy_item)
+    yield (copy_item, ret)
+  if manifest is not None and not __prog_option_dry_run:
+    manifest.save()
+  if digest_cache is not None and not __prog_option_dry_run:
+    digest_cache.save()
+  if journal is not None:
+    journal.close()
+  for dest_dir in set(os.path.dirname(copy_item[1]) for copy_item in copy_list):
+    fs_forget_dir_snapshot(dest_dir)
+
+def copy_file_list_unrecorded(copy_list, __prog_option_sync, __prog_option_dry_run, num_workers, manifest,
+                              digest_cache, link_mode, journal, delta):
+  # --- Files not changed since last sync are not touched ---
+  # A content verified sync does not trust the manifest. Digests of unchanged
+  # files are cached anyway, so they are not hashed again. In link mode
+  # checking a link is as cheap as checking the manifest, and a copy made
+  # in a previous sync must be replaced by a link.
+  if __prog_option_sync and manifest is not None and digest_cache is None and not link_mode:
+    pending_list = []
+    for copy_item in copy_list:
+      if manifest.is_unchanged(copy_item[2]): yield (copy_item, 2)
+      else:                                   pending_list.append(copy_item)
+    copy_list = pending_list
+
+  # --- Files done in the interrupted run are not copied again ---
+  if journal is not None:
+    pending_list = []
+    for copy_item in copy_list:
+      if journal.is_done(copy_item): yield (copy_item, 2)
+      else:                          pending_list.append(copy_item)
+    copy_list = pending_list
+
+  if num_workers <= 1:
+    for copy_item in copy_list:
+      if journal is not None: journal.begin(copy_item)
+      yield (copy_item, transfer_file(copy_item[0], copy_item[1], __prog_option_sync, __prog_option_dry_run,
+                                      digest_cache, link_mode, delta))
+    return
+
+  small_executor = concurrent.futures.ThreadPoolExecutor(max_workers = num_workers)
+  large_executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, num_workers // 4))
+  future_dic = {}
+  try:
+    for copy_item in copy_list:
+      source_size = None
+      if manifest is not None: source_size = manifest.get_source_size(copy_item[2])
+      if source_size is None:
+        try:
+          source_size = os.path.getsize(copy_item[0])
+        except OSError:
+          source_size = 0
+      if source_size >= large_file_threshold: executor = large_executor
+      else:                                   executor = small_executor
+      if journal is not None: journal.begin(copy_item)
+      future = executor.submit(transfer_file, copy_item[0], copy_item[1],
+                               __prog_option_sync, __prog_option_dry_run, digest_cache, link_mode, delta)
+      future_dic[future] = copy_item
+    for future in concurrent.futures.as_completed(future_dic):
+      yield (future_dic[future], future.result())
+  finally:
+    # If the caller aborts do not start copying the files still queued.
+    for future in future_dic:
+      future.cancel()
+    small_executor.shutdown(wait = True)
+    large_executor.shutdown(wait = True)
+
+# -------------------------------------------------------------------------------------------------
+# Fan-out copy engine
+# -------------------------------------------------------------------------------------------------
+# Several filters usually share a source directory and write to different
+# destinations. Copying filter by filter reads the same source files again and
+# again. The fan-out engine takes the union of the copy plans: every source
+# file is read once, into one buffer, and written to every destination that
+# needs it.
+#
+fanout_buffer_size = 1024 * 1024
+
+# Copies source_path into every file in dest_path_list reading source only once.
+# Raises EnvironmentError if copy fails.
+def fs_copy_fanout(source_path, dest_path_list):
+  if len(dest_path_list) == 1:
+    fs_copy(source_path, dest_path_list[0])
+    return
+
+  temp_path_list = [fs_temp_path(dest_path) for dest_path in dest_path_list]
+  dest_file_list = []
+  try:
+    with open(source_path, 'rb') as source_file:
+      source_stat = os.fstat(source_file.fileno())
+      for temp_path in temp_path_list:
+        dest_file_list.append(open(temp_path, 'wb'))
+      buffer = bytearray(fanout_buffer_size)
+      buffer_view = memoryview(buffer)
+      for dest_file in dest_file_list:
+        rate_limiter.begin_file()
+      while True:
+        n = source_file.readinto(buffer_view[:rate_limiter.acquire_bytes(fanout_buffer_size)])
+        if not n: break
+        # Every destination writes n bytes
+        rate_limiter.consume_bytes(n * (len(dest_file_list) - 1))
+        for dest_file in dest_file_list:
+          dest_file.write(buffer_view[:n])
+      for dest_file in dest_file_list:
+        if hasattr(os, 'fchmod'):
+          os.fchmod(dest_file.fileno(), source_stat.st_mode & 0o7777)
+        dest_file.close()
+    for (temp_path, dest_path) in zip(temp_path_list, dest_path_list):
+      os.replace(temp_path, dest_path)
+  except BaseException:
+    for dest_file in dest_file_list:
+      dest_file.close()
+    for temp_path in temp_path_list:
+      fs_remove_temp(temp_path)
+    raise
+  if not hasattr(os, 'fchmod'):
+    for dest_path in dest_path_list:
+      shutil.copymode(source_path, dest_path)
+
+#
+# Like copy_file()/update_file() for a list of destinations. Returns a list
+# with the return value for each destination.
+#
+def fanout_file(source_path, dest_path_list, __prog_option_sync, __prog_option_dry_run):
+  try:
+    sizeSource = os.stat(source_path).st_size
+  except OSError:
+    return [1] * len(dest_path_list)
+
+  ret_list = [0] * len(dest_path_list)
+  copy_index_list = []
+  for (index, dest_path) in enumerate(dest_path_list):
+    if __prog_option_sync:
+      try:
+        if os.stat(dest_path).st_size == sizeSource:
+          ret_list[index] = 2
+          continue
+      except OSError:
+        pass
+    copy_index_list.append(index)
+  if not copy_index_list or __prog_option_dry_run:
+    return ret_list
+
+  try:
+    fs_copy_fanout(source_path, [dest_path_list[index] for index in copy_index_list])
+  except EnvironmentError:
+    print_info('[WARNING] fanout_file >> source_path {0}'.format(source_path))
+    print_info('[WARNING] fanout_file >> Exception EnvironmentError triggered')
+    for index in copy_index_list:
+      ret_list[index] = -1
+
+  return ret_list
+
+#
+# fanout_list is a list of tuples (source_path, target_list). Each target is a
+# tuple (dest_path, report_name, manifest, journal, ...) and may have more
+# fields for the caller. manifest and journal may be None.
+# This is a generator: it yields (source_path, target, ret) for every target,
+# like copy_file_list(). Manifests are saved and journals closed when all the
+# files are done.
+#
+def copy_fanout_list(fanout_list, __prog_option_sync, __prog_option_dry_run, num_workers = 1):
+  manifest_list = []
+  journal_list = []
+  for (source_path, target_list) in fanout_list:
+    for target in target_list:
+      if target[2] is not None and target[2] not in manifest_list: manifest_list.append(target[2])
+      if target[3] is not None and target[3] not in journal_list: journal_list.append(target[3])
+
+  for (source_path, target, ret) in copy_fanout_list_unrecorded(fanout_list, __prog_option_sync,
+                                                                __prog_option_dry_run, num_workers):
+    (dest_path, report_name, manifest, journal) = target[0:4]
+    if manifest is not None and not __prog_option_dry_run:
+      if ret == 0 or ret == 2: manifest.record(report_name, source_path, dest_path)
+      else:                    manifest.forget(report_name)
+    if journal is not None and ret == 0:
+      journal.done((source_path, dest_path, report_name))
+    yield (source_path, target, ret)
+  if not __prog_option_dry_run:
+    for manifest in manifest_list:
+      manifest.save()
+  for journal in journal_list:
+    journal.close()
+  for (source_path, target_list) in fanout_list:
+    for target in target_list:
+      fs_forget_dir_snapshot(os.path.dirname(target[0]))
+
+def fanout_journal_begin(source_path, target_list):
+  for target in target_list:
+    if target[3] is not None: target[3].begin((source_path, target[0], target[1]))
+
+def copy_fanout_list_unrecorded(fanout_list, __prog_option_sync, __prog_option_dry_run, num_workers):
+  # --- Targets up to date or done in an interrupted run are not touched ---
+  pending_list = []
+  for (source_path, target_list) in fanout_list:
+    pending_target_list = []
+    for target in target_list:
+      (dest_path, report_name, manifest, journal) = target[0:4]
+      if __prog_option_sync and manifest is not None and manifest.is_unchanged(report_name):
+        yield (source_path, target, 2)
+      elif journal is not None and journal.is_done((source_path, dest_path, report_name)):
+        yield (source_path, target, 2)
+      else:
+        pending_target_list.append(target)
+    if pending_target_list:
+      pending_list.append((source_path, pending_target_list))
+
+  if num_workers <= 1:
+    for (source_path, target_list) in pending_list:
+      fanout_journal_begin(source_path, target_list)
+      ret_list = fanout_file(source_path, [target[0] for target in target_list],
+                             __prog_option_sync, __prog_option_dry_run)
+      for (target, ret) in zip(target_list, ret_list):
+        yield (source_path, target, ret)
+    return
+
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers = num_workers)
+  future_dic = {}
+  try:
+    for (source_path, target_list) in pending_list:
+      fanout_journal_begin(source_path, target_list)
+      future = executor.submit(fanout_file, source_path, [target[0] for target in target_list],
+                               __prog_option_sync, __prog_option_dry_run)
+      future_dic[future] = (source_path, target_list)
+    for future in concurrent.futures.as_completed(future_dic):
+      (source_path, target_list) = future_dic[future]
+      for (target, ret) in zip(target_list, future.result()):
+        yield (source_path, target, ret)
+  finally:
+    for future in future_dic:
+      future.cancel()
+    executor.shutdown(wait = True)
+
 # -------------------------------------------------------------------------------------------------
 # Filesystem helper functions
 # -------------------------------------------------------------------------------------------------
 def fs_create_dir_list_files(directory, endswith):
     file_list = []
-    for file in os.listdir(directory):
-        if file.endswith(endswith):
-            thisFileName, thisFileExtension = os.path.splitext(file)
-            file_list.append(thisFileName)
+    for file in fs_dir_snapshot(directory).file_list(endswith):
+        thisFileName, thisFileExtension = os.path.splitext(file)
+        file_list.append(thisFileName)
 
     return file_list
 
-def copy_ROM_list(rom_list, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run):
+def copy_ROM_list(rom_list, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run,
+                  __prog_option_workers = 1, __prog_option_verify_hash = 0, __prog_option_link = None):
   print_info('[Copying ROMs into destDir]')
 
-  num_steps = len(rom_list)
+  copy_list = []
+  for rom_copy_item in sorted(rom_list):
+    romFileName = rom_copy_item + '.zip'
+    copy_list.append((sourceDir + romFileName, destDir + romFileName, romFileName))
+
+  # --- Read source and destination directories only once ---
+  manifest = Sync_Manifest(destDir)
+  manifest.scan(sourceDir, destDir, [copy_item[2] for copy_item in copy_list])
+  digest_cache = None
+  if __prog_option_verify_hash and not __prog_option_link:
+    digest_cache = Digest_Cache(destDir + digest_cache_filename)
+  journal = None
+  if __prog_option_sync and not __prog_option_dry_run: journal = Sync_Journal(destDir)
+
+  num_steps = len(copy_list)
   step = 0 # 0 here prints [0, ..., 99%] instead [1, ..., 100%]
   num_roms = 0
   num_copied_roms = 0
   num_updated_roms = 0
   num_missing_roms = 0
   num_errors = 0
-  for rom_copy_item in sorted(rom_list):
-    romFileName = rom_copy_item + '.zip'
-    source_path = sourceDir + romFileName
-    dest_path = destDir + romFileName
+  for (copy_item, ret) in copy_file_list(copy_list, __prog_option_sync, __prog_option_dry_run,
+                                         __prog_option_workers, manifest, digest_cache,
+                                         __prog_option_link, journal):
+    romFileName = copy_item[2]
     num_roms += 1
-    if __prog_option_sync:
-      ret = update_file(source_path, dest_path, __prog_option_dry_run)
-    else:
-      ret = copy_file(source_path, dest_path, __prog_option_dry_run)
     # On default verbosity level only report copied files and errors
     percentage = 100 * step / num_steps
     if ret == 0:
@@ -321,14 +1454,14 @@ def copy_ROM_list(rom_list, sourceDir, destDir, __prog_option_sync, __prog_optio
       sys.stdout.write('{:3.0f}% '.format(percentage))
       print_info('<Copied > ' + romFileName)
     elif ret == 1:
+      num_missing_roms += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<Missing> ' + romFileName)
+    elif ret == 2:
       num_updated_roms += 1
       if log_level >= Log.verb:
         sys.stdout.write('{:3.0f}% '.format(percentage))
       print_verb('<Updated> ' + romFileName)
-    elif ret == 2:
-      num_missing_roms += 1
-      sys.stdout.write('{:3.0f}% '.format(percentage))
-      print_info('<Missing> ' + romFileName)
     elif ret == -1:
       num_errors += 1
       sys.stdout.write('{:3.0f}% '.format(percentage))
@@ -336,21 +1469,24 @@ def copy_ROM_list(rom_list, sourceDir, destDir, __prog_option_sync, __prog_optio
     else:
       print_error('Wrong value returned by update_ROM_file()')
       sys.exit(10)
+    sys.stdout.flush()
     # --- Update progress
     step += 1
 
   print_info('[Report]')
-  print_info('Total CHDs   ' + '{:4d}'.format(num_roms))
-  print_info('Copied CHDs  ' + '{:4d}'.format(num_copied_roms))
-  print_info('Update CHDs  ' + '{:4d}'.format(num_updated_roms))
-  print_info('Missing CHDs ' + '{:4d}'.format(num_missing_roms))
+  print_info('Total ROMs   ' + '{:4d}'.format(num_roms))
+  print_info('Copied ROMs  ' + '{:4d}'.format(num_copied_roms))
+  print_info('Update ROMs  ' + '{:4d}'.format(num_updated_roms))
+  print_info('Missing ROMs ' + '{:4d}'.format(num_missing_roms))
   print_info('Copy errors  ' + '{:4d}'.format(num_errors))
 
 #
 # CHD_dic = { 'machine_name' : ['chd1', 'chd2', ...], ... }
 #
 __debug_copy_CHD_dic = 0
-def copy_CHD_dic(CHD_dic, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run):
+def copy_CHD_dic(CHD_dic, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run,
+                 __prog_option_workers = 1, __prog_option_verify_hash = 0, __prog_option_link = None,
+                 __prog_option_delta_CHD = 0):
   print_info('[Copying CHDs into destDir]')
 
   # If user did not configure CHDs source directory then do nothing
@@ -363,14 +1499,20 @@ def copy_CHD_dic(CHD_dic, sourceDir, destDir, __prog_option_sync, __prog_option_
     print_error('CHD source directory not found ' + sourceDir)
     sys.exit(10)
 
-  # --- Copy CHDs ---
-  num_steps = len(CHD_dic)
-  step = 0 # 0 here prints [0, ..., 99%], 1 prints [1, ..., 100%]
-  num_CHD = 0
-  num_copied_CHD = 0
-  num_updated_CHD = 0
-  num_missing_CHD = 0
-  num_errors = 0
+  # --- Make list of CHDs to copy ---
+  manifest = Sync_Manifest(destDir)
+  digest_cache = None
+  delta = False
+  if __prog_option_link:
+    pass
+  elif __prog_option_delta_CHD:
+    digest_cache = Block_Digest_Cache(destDir + block_digest_cache_filename)
+    delta = True
+  elif __prog_option_verify_hash:
+    digest_cache = Digest_Cache(destDir + digest_cache_filename)
+  journal = None
+  if __prog_option_sync and not __prog_option_dry_run: journal = Sync_Journal(destDir)
+  copy_list = []
   for machine_name in sorted(CHD_dic):
     # Check if CHD directory exists. If not, create it. Abort if creation fails.
     chdSourceDir = sourceDir + machine_name + '/'
@@ -380,41 +1522,53 @@ def copy_CHD_dic(CHD_dic, sourceDir, destDir, __prog_option_sync, __prog_option_
       if __debug_copy_CHD_dic: print('Creating CHD dir = {0}\n'.format(chdDestDir))
       os.makedirs(chdDestDir)
 
-    # Iterate over this machine CHD list and copy them. Abort if CHD cannot be
-    # copied
+    manifest.scan(chdSourceDir, chdDestDir, [CHD_file + '.chd' for CHD_file in CHD_dic[machine_name]],
+                  machine_name + '/')
+
+    # Iterate over this machine CHD list.
     CHD_list = CHD_dic[machine_name]
     for CHD_file in CHD_list:
       chd_file_name = CHD_file + '.chd'
-      chd_file_path_source = chd_file_name + chdSourceDir
-      chd_file_path_dest = chd_file_name + chdDestDir
-      num_CHD += 1
-      if __prog_option_sync:
-        ret = update_file(chd_file_path_source, chd_file_path_dest, __prog_option_dry_run)
-      else:
-        ret = copy_file(chd_file_path_source, chd_file_path_dest, __prog_option_dry_run)
-      # On default verbosity level only report copied files and errors
-      percentage = 100 * step / num_steps
-      if ret == 0:
-        num_copied_CHD += 1
-        sys.stdout.write('{:3.0f}% '.format(percentage))
-        print_info('<Copied > ' + machine_name + '/' + chd_file_name)
-      elif ret == 1:
-        num_updated_CHD += 1
-        if log_level >= Log.verb:
-          sys.stdout.write('{:3.0f}% '.format(percentage))
-        print_verb('<Updated> ' + machine_name + '/' + chd_file_name)
-      elif ret == 2:
-        num_missing_CHD += 1
-        sys.stdout.write('{:3.0f}% '.format(percentage))
-        print_info('<Missing> ' + machine_name + '/' + chd_file_name)
-      elif ret == -1:
-        num_errors += 1
+      chd_file_path_source = chdSourceDir + chd_file_name
+      chd_file_path_dest = chdDestDir + chd_file_name
+      copy_list.append((chd_file_path_source, chd_file_path_dest, machine_name + '/' + chd_file_name))
+
+  # --- Copy CHDs ---
+  num_steps = len(copy_list)
+  step = 0 # 0 here prints [0, ..., 99%], 1 prints [1, ..., 100%]
+  num_CHD = 0
+  num_copied_CHD = 0
+  num_updated_CHD = 0
+  num_missing_CHD = 0
+  num_errors = 0
+  for (copy_item, ret) in copy_file_list(copy_list, __prog_option_sync, __prog_option_dry_run,
+                                         __prog_option_workers, manifest, digest_cache,
+                                         __prog_option_link, journal, delta):
+    chd_report_name = copy_item[2]
+    num_CHD += 1
+    # On default verbosity level only report copied files and errors
+    percentage = 100 * step / num_steps
+    if ret == 0:
+      num_copied_CHD += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<Copied > ' + chd_report_name)
+    elif ret == 1:
+      num_missing_CHD += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<Missing> ' + chd_report_name)
+    elif ret == 2:
+      num_updated_CHD += 1
+      if log_level >= Log.verb:
         sys.stdout.write('{:3.0f}% '.format(percentage))
-        print_info('<ERROR  > ' + machine_name + '/' + chd_file_name)
-      else:
-        print_error('Wrong value returned by update_ROM_file()')
-        sys.exit(10)
-      sys.stdout.flush()
+      print_verb('<Updated> ' + chd_report_name)
+    elif ret == -1:
+      num_errors += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<ERROR  > ' + chd_report_name)
+    else:
+      print_error('Wrong value returned by update_ROM_file()')
+      sys.exit(10)
+    sys.stdout.flush()
     # --- Update progress
     step += 1
 
@@ -425,6 +1579,87 @@ def copy_CHD_dic(CHD_dic, sourceDir, destDir, __prog_option_sync, __prog_option_
   print_info('Missing CHDs ' + '{:4d}'.format(num_missing_CHD))
   print_info('Copy errors  ' + '{:4d}'.format(num_errors))
 
+#
+# Copies the ROMs of several filters at once (see copy_fanout_list()).
+# plan_list = [ (filter_name, sourceDir, destDir, rom_list), ... ]
+#
+def copy_ROM_fanout(plan_list, __prog_option_sync, __prog_option_dry_run, __prog_option_workers = 1):
+  print_info('[Copying ROMs into destDirs]')
+
+  # fanout_dic = { source_path : [ (dest_path, report_name, manifest, journal, plan_index), ... ] }
+  # Filters sharing a destDir share its manifest and journal.
+  fanout_dic = {}
+  manifest_dic = {}
+  journal_dic = {}
+  dest_path_set = set()
+  for (plan_index, (filter_name, sourceDir, destDir, rom_list)) in enumerate(plan_list):
+    if destDir not in manifest_dic:
+      manifest_dic[destDir] = Sync_Manifest(destDir)
+      journal_dic[destDir] = None
+      if __prog_option_sync and not __prog_option_dry_run: journal_dic[destDir] = Sync_Journal(destDir)
+    manifest = manifest_dic[destDir]
+    journal = journal_dic[destDir]
+    name_list = []
+    for rom_copy_item in rom_list:
+      romFileName = rom_copy_item + '.zip'
+      if destDir + romFileName in dest_path_set: continue
+      dest_path_set.add(destDir + romFileName)
+      name_list.append(romFileName)
+      target = (destDir + romFileName, romFileName, manifest, journal, plan_index)
+      fanout_dic.setdefault(sourceDir + romFileName, []).append(target)
+    manifest.scan(sourceDir, destDir, name_list)
+  fanout_list = [(source_path, fanout_dic[source_path]) for source_path in sorted(fanout_dic)]
+
+  # counters_list[plan_index] = [total, copied, updated, missing, errors]
+  counters_list = [[0, 0, 0, 0, 0] for plan in plan_list]
+  num_steps = sum(len(target_list) for (source_path, target_list) in fanout_list)
+  step = 0 # 0 here prints [0, ..., 99%] instead [1, ..., 100%]
+  for (source_path, target, ret) in copy_fanout_list(fanout_list, __prog_option_sync, __prog_option_dry_run,
+                                                     __prog_option_workers):
+    dest_path = target[0]
+    counters = counters_list[target[4]]
+    counters[0] += 1
+    # On default verbosity level only report copied files and errors
+    percentage = 100 * step / num_steps
+    if ret == 0:
+      counters[1] += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<Copied > ' + dest_path)
+    elif ret == 1:
+      counters[3] += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<Missing> ' + dest_path)
+    elif ret == 2:
+      counters[2] += 1
+      if log_level >= Log.verb:
+        sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_verb('<Updated> ' + dest_path)
+    elif ret == -1:
+      counters[4] += 1
+      sys.stdout.write('{:3.0f}% '.format(percentage))
+      print_info('<ERROR  > ' + dest_path)
+    else:
+      print_error('Wrong value returned by fanout_file()')
+      sys.exit(10)
+    sys.stdout.flush()
+    # --- Update progress
+    step += 1
+
+  print_info('[Report]')
+  print_info('Source ROMs  ' + '{:4d}'.format(len(fanout_list)))
+  for (plan, counters) in zip(plan_list, counters_list):
+    print_info('<{0}>'.format(plan[0]))
+    print_info('Total ROMs   ' + '{:4d}'.format(counters[0]))
+    print_info('Copied ROMs  ' + '{:4d}'.format(counters[1]))
+    print_info('Update ROMs  ' + '{:4d}'.format(counters[2]))
+    print_info('Missing ROMs ' + '{:4d}'.format(counters[3]))
+    print_info('Copy errors  ' + '{:4d}'.format(counters[4]))
+
+# Allowed extensions of every kind of artwork, in order of preference.
+artwork_image_ext_list   = ['.png', '.jpg']
+artwork_manual_ext_list  = ['.pdf']
+artwork_trailer_ext_list = ['.mp4']
+
 def copy_ArtWork_list(filter_config, rom_copy_dic, __prog_option_sync, __prog_option_dry_run):
   print_info('[Copying ArtWork]')
   fanartSourceDir = filter_config.fanartSourceDir
@@ -521,12 +1756,67 @@ def copy_ArtWork_list(filter_config, rom_copy_dic, __prog_option_sync, __prog_op
 #
 #
 #
-def copy_ArtWork_file(art_baseName, asset_name, source_dir, dest_dir, __prog_option_sync, __prog_option_dry_run):
-    art_path_source = source_dir + art_baseName + '.png'
-    art_path_dest   = dest_dir   + art_baseName + '.png'
-    if __prog_option_sync: ret = update_file(art_path_source, art_path_dest, __prog_option_dry_run)
-    else:                  ret = copy_file(art_path_source, art_path_dest, __prog_option_dry_run)
+# source_snapshot/dest_snapshot are the Dir_Snapshot of source_dir/dest_dir. When
+# given, missing artwork and up-to-date artwork are resolved without touching
+# the filesystem, so an artwork pass costs one scan per asset directory instead
+# of one stat per ROM per asset.
+def copy_ArtWork_file(art_baseName, asset_name, source_dir, dest_dir, __prog_option_sync, __prog_option_dry_run,
+                      source_snapshot = None, dest_snapshot = None, ext_list = artwork_image_ext_list):
+    ret = transfer_ArtWork_file(art_baseName, source_dir, dest_dir, __prog_option_sync, __prog_option_dry_run,
+                                source_snapshot, dest_snapshot, ext_list)
+    report_ArtWork_file(art_baseName, asset_name, ret)
+
+    return ret
+
+# Copies/updates one artwork file, no reporting. Returns the copy_file()/update_file() value.
+# The source file is art_baseName with the first extension in ext_list found in
+# source_dir. The destination file keeps the source extension.
+# If transcoder is an Artwork_Transcoder and transcode_spec is not None the
+# destination file is the transcoded image (see Artwork_Transcoder), with the
+# extension of the transcode format.
+def transfer_ArtWork_file(art_baseName, source_dir, dest_dir, __prog_option_sync, __prog_option_dry_run,
+                          source_snapshot = None, dest_snapshot = None, ext_list = artwork_image_ext_list,
+                          transcoder = None, transcode_spec = None):
+    if source_snapshot is None: source_snapshot = fs_dir_snapshot(source_dir)
+    art_fileName = source_snapshot.resolve(art_baseName, ext_list)
+    if art_fileName is None: return 1
+
+    art_path_source = source_dir + art_fileName
+    if transcoder is not None and transcode_spec is not None:
+        try:
+            derived_path = transcoder.transcode(art_path_source, transcode_spec)
+        # >> Pillow raises more than EnvironmentError/ValueError on bad images
+        # >> (for example, Image.DecompressionBombError). Only this image fails.
+        except Exception as e:
+            print_info('[WARNING] transfer_ArtWork_file >> Cannot transcode {0}'.format(art_path_source))
+            print_info('[WARNING] transfer_ArtWork_file >> {0}'.format(e))
+            return -1
+        # >> Dry run and image not in the derived cache.
+        if derived_path is None: return 0
+        art_path_source = derived_path
+        art_fileName    = art_baseName + transcode_format_dic[transcode_spec[2]][1]
+        art_path_dest   = dest_dir + art_fileName
+        if __prog_option_sync: return update_file(art_path_source, art_path_dest, __prog_option_dry_run)
+        else:                  return copy_file(art_path_source, art_path_dest, __prog_option_dry_run)
+
+    art_path_dest = dest_dir + art_fileName
+    # >> get_stat() is None if the file was deleted after the scan. In that case
+    # >> update_file() looks at the filesystem.
+    source_stat = None
+    dest_stat = None
+    if __prog_option_sync and dest_snapshot is not None and dest_snapshot.has_file(art_fileName):
+        source_stat = source_snapshot.get_stat(art_fileName)
+        dest_stat = dest_snapshot.get_stat(art_fileName)
+    if source_stat is not None and dest_stat is not None and source_stat[0] == dest_stat[0]:
+        ret = 2
+    elif __prog_option_sync:
+        ret = update_file(art_path_source, art_path_dest, __prog_option_dry_run)
+    else:
+        ret = copy_file(art_path_source, art_path_dest, __prog_option_dry_run)
+
+    return ret
 
+def report_ArtWork_file(art_baseName, asset_name, ret):
     # >> On default verbosity level only report copied files
     if ret == 0:
       print_info('<Copied  {0}> {1}'.format(asset_name, art_baseName))
@@ -540,120 +1830,328 @@ def copy_ArtWork_file(art_baseName, asset_name, source_dir, dest_dir, __prog_opt
       print_error('Wrong value returned by update_file()/copy_file()')
       sys.exit(10)
 
+# -------------------------------------------------------------------------------------------------
+# Artwork transcoding
+# -------------------------------------------------------------------------------------------------
+# Front-ends usually do not need full resolution artwork. An asset type can be
+# transcoded when synced: images are downscaled to fit in a maximum size
+# (aspect ratio is kept, smaller images are not enlarged) and saved in a given
+# format and quality.
+#
+# Transcoded images are stored in a derived cache directory. The name of a
+# derived image is the digest of the source contents and the transcode spec,
+# so an unchanged image is never encoded again, in the next run or in another
+# filter that uses the same source and spec. Source digests are cached (see
+# Digest_Cache), so a cache hit costs one stat() of the source.
+#
+# Images are encoded in a pool of worker processes. Needs Pillow.
+#
+derived_cache_version = 1
+transcode_default_quality = 90
+
+# key = format name : value = (Pillow format, file extension)
+transcode_format_dic = {
+  'png'  : ('PNG',  '.png'),
+  'jpg'  : ('JPEG', '.jpg'),
+  'webp' : ('WEBP', '.webp')
+}
+
+# Parses a transcode spec like '512x512', '512x512, jpg' or '512x512, jpg, 85'.
+# Returns a tuple (max_width, max_height, format, quality). Default format is
+# png. Raises ValueError if transcode_str is wrong.
+def parse_transcode_string(transcode_str):
+  field_list = [field.strip() for field in transcode_str.split(',')]
+  if len(field_list) > 3:
+    raise ValueError('Wrong transcode spec {0}'.format(transcode_str))
+  size_list = field_list[0].lower().split('x')
+  if len(size_list) != 2:
+    raise ValueError('Wrong transcode size {0}'.format(field_list[0]))
+  max_width  = int(size_list[0])
+  max_height = int(size_list[1])
+  format_name = field_list[1].lower() if len(field_list) > 1 else 'png'
+  quality = int(field_list[2]) if len(field_list) > 2 else transcode_default_quality
+  if max_width < 1 or max_height < 1 or format_name not in transcode_format_dic or not 1 <= quality <= 100:
+    raise ValueError('Wrong transcode spec {0}'.format(transcode_str))
+
+  return (max_width, max_height, format_name, quality)
+
+# Encodes source_path into dest_path. Runs in a worker process.
+# Raises EnvironmentError or ValueError if the image cannot be read or written.
+def transcode_image(source_path, dest_path, transcode_spec):
+  (max_width, max_height, format_name, quality) = transcode_spec
+  temp_path = fs_temp_path(dest_path)
+  try:
+    with Image.open(source_path) as image:
+      image.thumbnail((max_width, max_height), Image.LANCZOS)
+      if format_name == 'jpg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+      if format_name == 'png': image.save(temp_path, 'PNG', optimize = True)
+      else:                    image.save(temp_path, transcode_format_dic[format_name][0], quality = quality)
+    os.replace(temp_path, dest_path)
+  except BaseException:
+    fs_remove_temp(temp_path)
+    raise
+
+# Worker processes are forked. The scripts run their command at module level, so
+# a spawned worker would run the whole command again. Where fork is not
+# available (Windows) images are encoded in threads instead.
+#
+# Forking while other threads hold locks (the artwork copy threads, logging)
+# can deadlock the child. The pool starts all its workers on the first
+# submit(), so a no-op job is run here, while the caller is still the only
+# thread. Create the executor before any worker thread.
+def transcode_executor(num_workers):
+  if 'fork' in multiprocessing.get_all_start_methods():
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers = num_workers,
+                                                      mp_context = multiprocessing.get_context('fork'))
+    executor.submit(os.getpid).result()
+    return executor
+
+  return concurrent.futures.ThreadPoolExecutor(max_workers = num_workers)
+
+# In dry run mode the transcoder does not hash, encode or write anything: only
+# images whose source digest is already cached can be found in the derived
+# cache, and no worker is started.
+class Artwork_Transcoder:
+  def __init__(self, cache_dir, num_workers = 1, __prog_option_dry_run = 0):
+    self.cache_dir = cache_dir
+    self.dry_run = __prog_option_dry_run
+    self.digest_cache = Digest_Cache(cache_dir + digest_cache_filename)
+    self.executor = None
+    if not self.dry_run: self.executor = transcode_executor(num_workers)
+    self.lock = threading.Lock()
+    self.future_dic = {}    # key = derived path : value = future, an image is encoded once per run
+
+  # Returns None in dry run mode if the source digest is not cached.
+  def get_derived_path(self, source_path, transcode_spec):
+    if self.dry_run: source_digest = self.digest_cache.get_cached_digest(source_path)
+    else:            source_digest = self.digest_cache.get_digest(source_path)
+    if source_digest is None: return None
+    key = hashlib.blake2b(repr((derived_cache_version, source_digest, transcode_spec)).encode('utf-8'),
+                          digest_size = 20).hexdigest()
+
+    return os.path.join(self.cache_dir, key[0:2], key + transcode_format_dic[transcode_spec[2]][1])
+
+  # Returns the path of the transcoded image in the derived cache, encoding it
+  # if not cached. In dry run images are not encoded and None is returned if the
+  # image is not cached. Thread safe.
+  def transcode(self, source_path, transcode_spec):
+    derived_path = self.get_derived_path(source_path, transcode_spec)
+    if derived_path is not None and os.path.isfile(derived_path): return derived_path
+    if self.dry_run: return None
+    with self.lock:
+      future = self.future_dic.get(derived_path)
+      if future is None:
+        os.makedirs(os.path.dirname(derived_path), exist_ok = True)
+        future = self.executor.submit(transcode_image, source_path, derived_path, transcode_spec)
+        self.future_dic[derived_path] = future
+    future.result()
+
+    return derived_path
+
+  def close(self):
+    if self.dry_run: return
+    self.executor.shutdown(wait = True)
+    self.digest_cache.save()
+
+# -------------------------------------------------------------------------------------------------
+# Artwork sync pipeline
+# -------------------------------------------------------------------------------------------------
+# Artwork is many small files spread in up to 11 asset directories. Copying
+# them ROM by ROM and asset by asset is bounded by per-file latency.
+# copy_ArtWork_asset_list() keeps one work queue per asset type. Queues are
+# drained round-robin into a shared pool of worker threads, so titles, snaps,
+# flyers, trailers, etc. transfer at the same time, and a large asset directory
+# does not delay the others.
+#
+# Workers only copy files. Reporting and counters are done in the main thread,
+# as results arrive.
+#
+# asset_plan_list is a list of tuples
+#   (asset_name, source_dir, dest_dir, art_baseName_list, source_snapshot, dest_snapshot, ext_list,
+#    transcode_spec)
+# where the snapshots and transcode_spec may be None. Images of assets with a
+# transcode_spec are transcoded with transcoder (see Artwork_Transcoder).
+# Returns a dictionary
+#   { asset_name : {'copied' : int, 'updated' : int, 'missing' : int, 'error' : int} }
+#
+artwork_ret_key_dic = {0 : 'copied', 1 : 'missing', 2 : 'updated', -1 : 'error'}
+
+def copy_ArtWork_asset_list(asset_plan_list, __prog_option_sync, __prog_option_dry_run, num_workers = 1,
+                            transcoder = None):
+  counter_dic = {}
+  for asset_plan in asset_plan_list:
+    counter_dic[asset_plan[0]] = {'copied' : 0, 'updated' : 0, 'missing' : 0, 'error' : 0}
+
+  for (asset_plan, art_baseName, ret) in copy_ArtWork_asset_list_unreported(asset_plan_list, __prog_option_sync,
+                                                                            __prog_option_dry_run, num_workers,
+                                                                            transcoder):
+    report_ArtWork_file(art_baseName, asset_plan[0], ret)
+    counter_dic[asset_plan[0]][artwork_ret_key_dic[ret]] += 1
+  for asset_plan in asset_plan_list:
+    fs_forget_dir_snapshot(asset_plan[2])
+
+  return counter_dic
+
+# Yields (asset_plan, art_baseName) round-robin from the asset queues.
+def artwork_queue_round_robin(asset_plan_list):
+  queue_list = [(asset_plan, iter(asset_plan[3])) for asset_plan in asset_plan_list]
+  while queue_list:
+    pending_list = []
+    for (asset_plan, queue) in queue_list:
+      art_baseName = next(queue, None)
+      if art_baseName is None: continue
+      pending_list.append((asset_plan, queue))
+      yield (asset_plan, art_baseName)
+    queue_list = pending_list
+
+def copy_ArtWork_asset_list_unreported(asset_plan_list, __prog_option_sync, __prog_option_dry_run, num_workers,
+                                       transcoder):
+  work_iter = artwork_queue_round_robin(asset_plan_list)
+  if num_workers <= 1:
+    for (asset_plan, art_baseName) in work_iter:
+      yield (asset_plan, art_baseName,
+             transfer_ArtWork_file(art_baseName, asset_plan[1], asset_plan[2], __prog_option_sync,
+                                   __prog_option_dry_run, asset_plan[4], asset_plan[5], asset_plan[6],
+                                   transcoder, asset_plan[7]))
+    return
+
+  # --- Keep a bounded number of files in flight, queues are consumed lazily ---
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers = num_workers)
+  max_in_flight = 4 * num_workers
+  future_dic = {}
+  try:
+    for (asset_plan, art_baseName) in work_iter:
+      future = executor.submit(transfer_ArtWork_file, art_baseName, asset_plan[1], asset_plan[2],
+                               __prog_option_sync, __prog_option_dry_run, asset_plan[4], asset_plan[5],
+                               asset_plan[6], transcoder, asset_plan[7])
+      future_dic[future] = (asset_plan, art_baseName)
+      if len(future_dic) < max_in_flight: continue
+      done_set, pending_set = concurrent.futures.wait(future_dic, return_when = concurrent.futures.FIRST_COMPLETED)
+      for future in done_set:
+        (asset_plan, art_baseName) = future_dic.pop(future)
+        yield (asset_plan, art_baseName, future.result())
+    for future in concurrent.futures.as_completed(list(future_dic)):
+      (asset_plan, art_baseName) = future_dic.pop(future)
+      yield (asset_plan, art_baseName, future.result())
+  finally:
+    # If the caller aborts do not start copying the files still queued.
+    for future in future_dic:
+      future.cancel()
+    executor.shutdown(wait = True)
+
 # Delete ROMs present in destDir not present in the filtered list
 # 1) Make a list of .zip files in destDir
 # 2) Delete all .zip files of games no in the filtered list
+# ROMs may be links (see link_file()). Deleting a link never touches the linked
+# file. Symlinks whose target does not exist any more are also deleted.
 def clean_ROMs_destDir(rom_copy_dic, destDir, __prog_option_dry_run):
   print_info('[Cleaning ROMs in ROMsDest]')
 
-  rom_main_list = []
-  for file in os.listdir(destDir):
-    if file.endswith(".zip"):
-      rom_main_list.append(file)
+  snapshot = fs_dir_snapshot(destDir)
+  rom_main_list = snapshot.file_list('.zip')
+  rom_main_list.extend([file for file in snapshot.link_set if file.endswith('.zip') and snapshot.is_dangling(file)])
 
   num_cleaned_roms = 0
   for file in sorted(rom_main_list):
     basename, ext = os.path.splitext(file)  # Remove extension
-    if basename not in rom_copy_dic:
+    file_path = destDir + file
+    is_link = file in snapshot.link_set
+    if basename not in rom_copy_dic or snapshot.is_dangling(file):
       num_cleaned_roms += 1
-      file_path = destDir + file
       delete_file(file_path, __prog_option_dry_run)
-      print_info('<Deleted> ' + file)
+      if is_link: print_info('<Unlinked> ' + file)
+      else:       print_info('<Deleted> ' + file)
+  fs_forget_dir_snapshot(destDir)
 
   print_info('Deleted ' + str(num_cleaned_roms) + ' redundant ROMs')
 
 # Delete CHDs in destDir not in the filtered list
 # 1) Scan directories in destDir
 # 2) Check if directory is a machine name in filtered list.
-# 3) If not, deleted directory with contents inside.
+# 3) If not, deleted directory with contents inside. If the directory is a
+#    symlink only the link is deleted, never the CHDs in the linked directory.
 __DEBUG_clean_CHDs_destDir = 0
 def clean_CHDs_destDir(CHD_dic, destDir, __prog_option_dry_run):
   print_info('[Cleaning ROMs in ROMsDest]')
 
   # directories_dic = { 'machine' : 'CHD_destDirectory'}
   directories_dic = {}
-  for file in os.listdir(destDir):
-    # if __DEBUG_clean_CHDs_destDir: print('listdir entry {0}'.format(file))
+  snapshot = fs_dir_snapshot(destDir)
+  for file in snapshot.dir_set:
     CHD_dir_full_name = destDir + file
-    if os.path.isdir(CHD_dir_full_name):
-      if __DEBUG_clean_CHDs_destDir: print('Directory {0}'.format(CHD_dir_full_name))
-      directories_dic[file] = CHD_dir_full_name
+    if __DEBUG_clean_CHDs_destDir: print('Directory {0}'.format(CHD_dir_full_name))
+    directories_dic[file] = CHD_dir_full_name
   
   num_deleted_dirs = 0
   num_deleted_CHD = 0
   for CHD_dir_name in sorted(directories_dic):
     CHD_dir_full_name = directories_dic[CHD_dir_name]
     if CHD_dir_name not in CHD_dic:
-      num_CHD = delete_CHD_directory(CHD_dir_full_name, __prog_option_dry_run)
       num_deleted_dirs += 1
+      if CHD_dir_name in snapshot.link_set:
+        delete_file(CHD_dir_full_name, __prog_option_dry_run)
+        print_info('<Unlinked> ' + CHD_dir_full_name)
+        continue
+      num_CHD = delete_CHD_directory(CHD_dir_full_name, __prog_option_dry_run)
       num_deleted_CHD += num_CHD
       print_info('<Deleted> ' + CHD_dir_full_name)
     else:
       if __DEBUG_clean_CHDs_destDir: print('CHD_dir_name {0} in filtered list'.format(CHD_dir_name))
 
+  fs_forget_dir_snapshot(destDir)
+
   print_info('Deleted directories  ' + str(num_deleted_dirs))
   print_info('Deleted CHDs         ' + str(num_deleted_CHD))
 
 def clean_NFO_destDir(destDir, __prog_option_dry_run):
   print_info('[Deleting redundant NFO files]')
   num_deletedNFO_files = 0
-  for file in os.listdir(destDir):
-    if file.endswith(".nfo"):
-      # Chech if there is a corresponding ROM for this NFO file
-      thisFileName, thisFileExtension = os.path.splitext(file)
-      romFileName_temp = thisFileName + '.zip'
-      rom_file_path = destDir + romFileName_temp
-      if not os.path.isfile(rom_file_path):
-        nfo_file_path = destDir + file
-        delete_file(nfo_file_path, __prog_option_dry_run)
-        num_deletedNFO_files += 1
-        print_info('<Deleted NFO> ' + file)
+  snapshot = fs_dir_snapshot(destDir)
+  for file in snapshot.file_list('.nfo'):
+    # Chech if there is a corresponding ROM for this NFO file
+    thisFileName, thisFileExtension = os.path.splitext(file)
+    romFileName_temp = thisFileName + '.zip'
+    if not snapshot.has_file(romFileName_temp):
+      nfo_file_path = destDir + file
+      delete_file(nfo_file_path, __prog_option_dry_run)
+      num_deletedNFO_files += 1
+      print_info('<Deleted NFO> ' + file)
+  fs_forget_dir_snapshot(destDir)
 
   print_info('Deleted ' + str(num_deletedNFO_files) + ' redundant NFO files')
 
-def clean_ArtWork_destDir(filter_config, artwork_copy_dic, __prog_option_dry_run):
+#
+# Deletes the artwork files in the asset destination directories that are not
+# in the asset art_baseName_list. asset_plan_list is the list given to
+# copy_ArtWork_asset_list().
+# Files with an extension in the asset ext_list are cleaned. In image assets
+# files with an extension of any transcode format are cleaned too, so images
+# left by a previous transcode spec (for example, .webp) are not kept. If the
+# asset has a transcode_spec only the files with its format extension are kept.
+#
+def clean_ArtWork_destDir(asset_plan_list, __prog_option_dry_run):
   print_info('[Cleaning ArtWork]')
 
-  thumbsDestDir = filter_config.thumbsDestDir
-  fanartDestDir = filter_config.fanartDestDir
-  
-  # --- Check that directories exist
-  have_dir_or_abort(thumbsDestDir, 'thumbsDestDir')
-  have_dir_or_abort(fanartDestDir, 'fanartDestDir')
-
-  # --- Delete unknown thumbs
-  thumbs_file_list = []
-  for file in os.listdir(thumbsDestDir):
-    if file.endswith(".png"):
-      thumbs_file_list.append(file)
-
-  num_cleaned_thumbs = 0
-  for file in sorted(thumbs_file_list):
-    art_baseName, ext = os.path.splitext(file)  # Remove extension
-    if art_baseName not in artwork_copy_dic:
-      num_cleaned_thumbs += 1
-      thumb_file_path_dest = thumbsDestDir + file
-      delete_file(thumb_file_path_dest, __prog_option_dry_run)
-      print_info('<Deleted thumb > ' + file)
-
-  # --- Delete unknown fanart
-  fanart_file_list = []
-  for file in os.listdir(fanartDestDir):
-    if file.endswith(".png"):
-      fanart_file_list.append(file)
-
-  num_cleaned_fanart = 0
-  for file in sorted(fanart_file_list):
-    art_baseName, ext = os.path.splitext(file)  # Remove extension
-    if art_baseName not in artwork_copy_dic:
-      num_cleaned_fanart += 1
-      fanart_file_path_dest = thumbsDestDir + file
-      delete_file(fanart_file_path_dest, __prog_option_dry_run)
-      print_info('<Deleted fanart> ' + file)
-
-  # Print eport
-  print_info('Deleted ' + str(num_cleaned_thumbs) + ' redundant thumbs')
-  print_info('Deleted ' + str(num_cleaned_fanart) + ' redundant fanart')
+  transcode_ext_set = set(format_tuple[1] for format_tuple in transcode_format_dic.values())
+  for asset_plan in asset_plan_list:
+    (asset_name, dest_dir, art_baseName_list, ext_list, transcode_spec) = \
+      (asset_plan[0], asset_plan[2], asset_plan[3], asset_plan[6], asset_plan[7])
+    clean_ext_set = set(ext_list)
+    if clean_ext_set & transcode_ext_set: clean_ext_set |= transcode_ext_set
+    if transcode_spec is not None: keep_ext_set = {transcode_format_dic[transcode_spec[2]][1]}
+    else:                          keep_ext_set = set(ext_list)
+    art_baseName_set = set(art_baseName_list)
+
+    num_cleaned = 0
+    for file in sorted(fs_dir_snapshot(dest_dir).file_list(tuple(clean_ext_set))):
+      art_baseName, ext = os.path.splitext(file)
+      if art_baseName in art_baseName_set and ext in keep_ext_set: continue
+      num_cleaned += 1
+      delete_file(dest_dir + file, __prog_option_dry_run)
+      print_info('<Deleted {0}> {1}'.format(asset_name, file))
+    fs_forget_dir_snapshot(dest_dir)
+    print_info('Deleted {0} redundant {1}'.format(num_cleaned, asset_name))
 
 # -----------------------------------------------------------------------------
 # XML functions
@@ -701,6 +2199,65 @@ def XML_read_file_cElementTree(filename, infoString):
 
   return tree
 
+#
+# Streams a XML file using iterparse() instead of loading the whole tree. This is
+# a generator: it yields every child element of the root element once the child
+# is completely parsed. After the caller is done with the element it is cleared
+# and detached from root, so memory consumption is bounded by the size of one
+# child element and not by the size of the file.
+#
+# If root_attrib is a dictionary the root element attributes are copied into it
+# as soon as the root start tag is parsed.
+#
+# NOTE Elements yielded are destroyed when the generator is resumed. Copy any
+#      information that you want to keep.
+#
+def XML_iterparse_file(filename, infoString, root_attrib = None):
+  print(infoString + " '" + filename + "' (streaming)")
+  sys.stdout.flush()
+  if not os.path.isfile(filename):
+    print('\033[31m[ERROR]\033[0m File \'{0}\' not found'.format(filename))
+    sys.exit(10)
+
+  depth = 0
+  root = None
+  for event, elem in ET.iterparse(filename, events = ('start', 'end')):
+    if event == 'start':
+      if depth == 0:
+        root = elem
+        if root_attrib is not None: root_attrib.update(elem.attrib)
+      depth += 1
+    else:
+      depth -= 1
+      if depth == 1:
+        yield elem
+        elem.clear()
+        root.remove(elem)
+
+#
+# Writes a XML file one element at a time. Use together with XML_iterparse_file()
+# to transform big XML files without building the output tree in memory.
+# Elements written are indented like indent_ElementTree_XML() does.
+#
+class XML_Stream_Writer:
+  def __init__(self, filename, root_tag, root_attrib):
+    self.root_tag = root_tag
+    self.f = open(filename, 'w', encoding = 'utf-8')
+    root_EL = ET.Element(root_tag, root_attrib)
+    root_str = ET.tostring(root_EL, encoding = 'unicode')
+    # ET.tostring() returns an empty element like <mame build="..." />
+    self.f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+    self.f.write(root_str[:root_str.rfind('/>')].rstrip() + '>\n')
+
+  def write_element(self, elem):
+    indent_ElementTree_XML(elem, 1)
+    elem.tail = '\n'
+    self.f.write(' ' + ET.tostring(elem, encoding = 'unicode'))
+
+  def close(self):
+    self.f.write('</{0}>\n'.format(self.root_tag))
+    self.f.close()
+
 # See http://norwied.wordpress.com/2013/08/27/307/
 def indent_ElementTree_XML(elem, level=0):
   i = "\n" + level*" "
@@ -717,41 +2274,386 @@ def indent_ElementTree_XML(elem, level=0):
     if level and (not elem.tail or not elem.tail.strip()):
       elem.tail = i
 
+# -----------------------------------------------------------------------------
+# Binary cache functions
+# -----------------------------------------------------------------------------
+#
+# A cache file stores 2 pickles one after the other: a small header and the
+# cached object. The header is read first, so a stale cache is detected without
+# unpickling the (big) object.
+#
+# Header: { 'version' : int, 'size' : int, 'mtime' : int (ns), 'sha1' : str }
+#
+# The cache is valid if the version is the same and the source file size and
+# mtime have not changed. If the mtime changed but the size did not (for example,
+# the file was copied or touched) the SHA1 of the source file is checked. If the
+# hash matches, the cache is still valid and the header is refreshed.
+#
+def cache_source_sha1(filename):
+  sha1 = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    while True:
+      block = f.read(1024 * 1024)
+      if not block: break
+      sha1.update(block)
+
+  return sha1.hexdigest()
+
+#
+# Returns the cached object or None if there is no valid cache.
+#
+def cache_load(cache_filename, source_filename, version):
+  if not os.path.isfile(cache_filename):
+    print_info('Cache file \'{0}\' not found'.format(cache_filename))
+    return None
+  source_stat = os.stat(source_filename)
+  try:
+    with open(cache_filename, 'rb') as f:
+      header = pickle.load(f)
+      if header['version'] != version or header['size'] != source_stat.st_size:
+        print_info('Cache file \'{0}\' is outdated'.format(cache_filename))
+        return None
+      refresh_header = False
+      if header['mtime'] != source_stat.st_mtime_ns:
+        if header['sha1'] != cache_source_sha1(source_filename):
+          print_info('Cache file \'{0}\' is outdated'.format(cache_filename))
+          return None
+        refresh_header = True
+      print_info('Loading cache file \'{0}\''.format(cache_filename))
+      cached_object = pickle.load(f)
+  except (EnvironmentError, pickle.UnpicklingError, EOFError, KeyError, AttributeError):
+    print_info('[WARNING] cache_load >> Cannot read cache file {0}'.format(cache_filename))
+    return None
+
+  if refresh_header:
+    cache_save(cache_filename, source_filename, version, cached_object, header['sha1'])
+
+  return cached_object
+
+#
+# Writes cache file. The cache is written to a temporal file and then renamed,
+# so an interrupted write never leaves a corrupt cache behind.
+#
+def cache_save(cache_filename, source_filename, version, cached_object, source_sha1 = None):
+  source_stat = os.stat(source_filename)
+  if source_sha1 is None:
+    source_sha1 = cache_source_sha1(source_filename)
+  header = {'version' : version,
+            'size'    : source_stat.st_size,
+            'mtime'   : source_stat.st_mtime_ns,
+            'sha1'    : source_sha1}
+  temp_filename = cache_filename + '.tmp'
+  try:
+    with open(temp_filename, 'wb') as f:
+      pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+      pickle.dump(cached_object, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, cache_filename)
+  except EnvironmentError:
+    print_info('[WARNING] cache_save >> Cannot write cache file {0}'.format(cache_filename))
+
+# -----------------------------------------------------------------------------
+# Bitset functions
+# -----------------------------------------------------------------------------
+# A bitset is a Python int where bit n is set if item with id n belongs to the
+# set. Set operations are bitwise operations on the whole set at once:
+#   intersection  a & b
+#   union         a | b
+#   difference    a & ~b
+#
+# Tuple of set bit positions of every byte value, to iterate bitsets quickly.
+bitset_byte_table = tuple(tuple(bit for bit in range(8) if byte & (1 << bit)) for byte in range(256))
+
+# Creates a bitset with the ids in id_iterable set. Builds the bitset in a
+# bytearray, because OR-ing bits one by one into a big int is quadratic.
+def bitset_from_ids(id_iterable, num_bits):
+  bitset_bytes = bytearray((num_bits + 7) // 8)
+  for id in id_iterable:
+    bitset_bytes[id >> 3] |= 1 << (id & 7)
+
+  return int.from_bytes(bitset_bytes, 'little')
+
+# Generator of the ids set in bitset, in ascending order.
+def bitset_to_ids(bitset):
+  bitset_bytes = bitset.to_bytes((bitset.bit_length() + 7) // 8, 'little')
+  for byte_index, byte in enumerate(bitset_bytes):
+    if byte:
+      base = byte_index << 3
+      for bit in bitset_byte_table[byte]:
+        yield base + bit
+
+def bitset_count(bitset):
+  return bin(bitset).count('1')
+
+# -----------------------------------------------------------------------------
+# Numeric expression parser
+# -----------------------------------------------------------------------------
+# Compiles numeric filter expressions like
+#   buttons >= 2 and buttons <= 6
+#   2 <= players <= 4
+#   buttons in 2..6
+#   players in (1, 2, 4)
+#   not (year in 1985..1989) or year == 1995
+# into the set of integers for which the expression is True. The set is stored
+# as a sorted list of disjoint closed intervals (low, high), where low may be
+# -inf and high may be +inf. Only one variable name is allowed in an expression.
+# Nothing is executed with eval(), so the configuration file cannot run code.
+#
+# Grammar:
+#   expression := and_expr ('or' and_expr)*
+#   and_expr   := not_expr ('and' not_expr)*
+#   not_expr   := 'not' not_expr | '(' expression ')' | comparison
+#   comparison := operand (cmp_op operand)+ | variable 'in' set
+#   set        := integer '..' integer | '(' integer (',' integer)* ')'
+#   operand    := variable | integer
+#
+numeric_inf = float('inf')
+
+class Numeric_Expression:
+  def __init__(self, variable_name, interval_list):
+    self.variable_name = variable_name
+    self.interval_list = interval_list
+    self.low_list = [interval[0] for interval in interval_list]
+
+  def contains(self, value):
+    index = bisect.bisect_right(self.low_list, value) - 1
+    if index < 0: return False
+
+    return value <= self.interval_list[index][1]
+
+  # True if any integer in [low, high] satisfies the expression.
+  def overlaps(self, low, high):
+    index = bisect.bisect_right(self.low_list, high) - 1
+    if index < 0: return False
+
+    return low <= self.interval_list[index][1]
+
+  # postings is a dictionary with key an integer value and value the bitset of
+  # the items that have that value. Each distinct value is tested only once.
+  # Returns the bitset of the items for which the expression is True.
+  def eval_postings(self, postings):
+    bitset = 0
+    for value, value_bitset in postings.items():
+      if self.contains(value): bitset |= value_bitset
+
+    return bitset
+
+  def __str__(self):
+    return ' or '.join('[{0}, {1}]'.format(low, high) for low, high in self.interval_list)
+
+# --- Interval set operations. Interval lists are sorted and disjoint ---
+def interval_normalize(interval_list):
+  normalized_list = []
+  for low, high in sorted(interval_list):
+    if low > high: continue
+    if normalized_list and low <= normalized_list[-1][1] + 1:
+      if high > normalized_list[-1][1]:
+        normalized_list[-1] = (normalized_list[-1][0], high)
+    else:
+      normalized_list.append((low, high))
+
+  return normalized_list
+
+def interval_union(list_a, list_b):
+  return interval_normalize(list_a + list_b)
+
+def interval_intersection(list_a, list_b):
+  result_list = []
+  for low_a, high_a in list_a:
+    for low_b, high_b in list_b:
+      low = max(low_a, low_b)
+      high = min(high_a, high_b)
+      if low <= high: result_list.append((low, high))
+
+  return interval_normalize(result_list)
+
+def interval_complement(interval_list):
+  result_list = []
+  low = -numeric_inf
+  for interval_low, interval_high in interval_list:
+    if interval_low > low: result_list.append((low, interval_low - 1))
+    low = interval_high + 1
+  if low != numeric_inf: result_list.append((low, numeric_inf))
+
+  return result_list
+
+# Interval list of "variable op number"
+def interval_comparison(operator, number):
+  if   operator == '<':  return [(-numeric_inf, number - 1)]
+  elif operator == '<=': return [(-numeric_inf, number)]
+  elif operator == '>':  return [(number + 1, numeric_inf)]
+  elif operator == '>=': return [(number, numeric_inf)]
+  elif operator == '==': return [(number, number)]
+  elif operator == '!=': return interval_complement([(number, number)])
+  raise SyntaxError("Unknown comparison operator: %r" % operator)
+
+# Swaps operands of a comparison: "number op variable" -> "variable op' number"
+numeric_swapped_operator = {'<' : '>', '<=' : '>=', '>' : '<', '>=' : '<=', '==' : '==', '!=' : '!='}
+
+def numeric_tokenize(program):
+  token_list = []
+  position = 0
+  pattern = re.compile(r"\s*(?:(\d+)|(\.\.)|(<=|>=|==|!=|<|>)|([(),])|([A-Za-z_]\w*))")
+  program = program.rstrip()
+  while position < len(program):
+    match = pattern.match(program, position)
+    if not match or match.end() == position:
+      raise SyntaxError("Unexpected character %r" % program[position:].strip()[0])
+    number, dots, comparison, punctuation, name = match.groups()
+    if number:        token_list.append(('NUMBER', int(number)))
+    elif dots:        token_list.append(('OP', '..'))
+    elif comparison:  token_list.append(('CMP', comparison))
+    elif punctuation: token_list.append(('OP', punctuation))
+    elif name in ('and', 'or', 'not', 'in'): token_list.append(('OP', name))
+    else:             token_list.append(('NAME', name))
+    position = match.end()
+  token_list.append(('END', None))
+
+  return token_list
+
+class Numeric_Parser:
+  def __init__(self, program, variable_name):
+    self.token_list = numeric_tokenize(program)
+    self.position = 0
+    self.variable_name = variable_name
+
+  def peek(self):
+    return self.token_list[self.position]
+
+  def advance(self, kind = None, value = None):
+    token = self.token_list[self.position]
+    if (kind and token[0] != kind) or (value and token[1] != value):
+      raise SyntaxError("Expected %r, found %r" % (value or kind, token[1]))
+    self.position += 1
+    return token
+
+  def is_operator(self, value):
+    token = self.peek()
+    return token[0] == 'OP' and token[1] == value
+
+  def parse(self):
+    interval_list = self.expression()
+    if self.peek()[0] != 'END':
+      raise SyntaxError("Unexpected token %r" % (self.peek()[1],))
+
+    return Numeric_Expression(self.variable_name, interval_list)
+
+  def expression(self):
+    interval_list = self.and_expression()
+    while self.is_operator('or'):
+      self.advance()
+      interval_list = interval_union(interval_list, self.and_expression())
+    return interval_list
+
+  def and_expression(self):
+    interval_list = self.not_expression()
+    while self.is_operator('and'):
+      self.advance()
+      interval_list = interval_intersection(interval_list, self.not_expression())
+    return interval_list
+
+  def not_expression(self):
+    if self.is_operator('not'):
+      self.advance()
+      return interval_complement(self.not_expression())
+    if self.is_operator('('):
+      self.advance()
+      interval_list = self.expression()
+      self.advance('OP', ')')
+      return interval_list
+    return self.comparison()
+
+  def operand(self):
+    token = self.peek()
+    if token[0] == 'NAME':
+      if token[1] != self.variable_name:
+        raise SyntaxError("Unknown variable %r (must be %r)" % (token[1], self.variable_name))
+    elif token[0] != 'NUMBER':
+      raise SyntaxError("Expected %r or a number, found %r" % (self.variable_name, token[1]))
+    return self.advance()
+
+  def comparison(self):
+    left = self.operand()
+    # variable in a..b / variable in (a, b, c)
+    if self.is_operator('in'):
+      if left[0] != 'NAME':
+        raise SyntaxError("Expected %r before 'in'" % self.variable_name)
+      self.advance()
+      if self.is_operator('('):
+        self.advance()
+        interval_list = [(self.advance('NUMBER')[1],) * 2]
+        while self.is_operator(','):
+          self.advance()
+          interval_list.append((self.advance('NUMBER')[1],) * 2)
+        self.advance('OP', ')')
+        return interval_normalize(interval_list)
+      low = self.advance('NUMBER')[1]
+      self.advance('OP', '..')
+      high = self.advance('NUMBER')[1]
+      return interval_normalize([(low, high)])
+
+    # Chained comparisons are and-ed, like in Python: a <= x <= b
+    if self.peek()[0] != 'CMP':
+      raise SyntaxError("Expected a comparison after %r" % (left[1],))
+    interval_list = [(-numeric_inf, numeric_inf)]
+    while self.peek()[0] == 'CMP':
+      operator = self.advance()[1]
+      right = self.operand()
+      if left[0] == 'NAME' and right[0] == 'NUMBER':
+        comparison_list = interval_comparison(operator, right[1])
+      elif left[0] == 'NUMBER' and right[0] == 'NAME':
+        comparison_list = interval_comparison(numeric_swapped_operator[operator], left[1])
+      else:
+        raise SyntaxError("Comparison must have %r on one side and a number on the other" % self.variable_name)
+      interval_list = interval_intersection(interval_list, comparison_list)
+      left = right
+    return interval_list
+
+#
+# Compiles a numeric expression over variable_name. Returns a Numeric_Expression.
+# Raises SyntaxError if program is not a valid expression.
+#
+def parse_numeric_compile(program, variable_name):
+  return Numeric_Parser(program, variable_name).parse()
+
 # -----------------------------------------------------------------------------
 # Search engine and parser
 # -----------------------------------------------------------------------------
-# --- Global variables for parser ---
-def set_parser_search_list(search_list):
-  global parser_search_list
-  
-  parser_search_list = search_list
+# The parser keeps no global state. An expression is compiled once into a tree
+# of token objects with parse_compile(), and then evaluated any number of times
+# with eval_postings(context). The context object holds the per-call data, so
+# the same compiled expression can be evaluated from several threads or nested
+# inside another evaluation.
+#
+# Context to evaluate an expression over all the items at once with
+# eval_postings(context). postings is an inverted index, a dictionary with key
+# a string and value the bitset of the items that have that string. all_mask is
+# the bitset with all the items (needed by not).
+# eval_postings() returns the bitset of the items for which the expression is
+# True.
+#
+class Postings_Context:
+  def __init__(self, postings, all_mask):
+    self.postings = postings
+    self.all_mask = all_mask
 
 # --- Token objects ---
 class literal_token:
   def __init__(self, value):
     self.value = value
     self.id = "STRING"
-  def nud(self):
+  def nud(self, parser):
     return self
   # --- Actual implementation
-  def exec_token(self):
-    global parser_search_list
-
-    return self.value in parser_search_list
-
-def advance(id = None):
-  global token
-  if id and token.id != id:
-    raise SyntaxError("Expected %r" % id)
-  token = next()
+  def eval_postings(self, context):
+    return context.postings.get(self.value, 0)
 
 class operator_open_par_token:
   lbp = 0
   def __init__(self):
     self.id = "OP ("
-  def nud(self):
-    expr = expression()
-    advance("OP )")
+  def nud(self, parser):
+    expr = parser.expression()
+    parser.advance("OP )")
     return expr
 
 class operator_close_par_token:
@@ -763,36 +2665,36 @@ class operator_not_token:
   lbp = 50
   def __init__(self):
     self.id = "OP NOT"
-  def nud(self):
-    self.first = expression(50)
+  def nud(self, parser):
+    self.first = parser.expression(50)
     return self
   # --- Actual implementation
-  def exec_token(self):
-    return not self.first.exec_token()
+  def eval_postings(self, context):
+    return context.all_mask & ~self.first.eval_postings(context)
 
 class operator_and_token:
   lbp = 10
   def __init__(self):
     self.id = "OP AND"
-  def led(self, left):
+  def led(self, parser, left):
     self.first = left
-    self.second = expression(10)
+    self.second = parser.expression(10)
     return self
   # --- Actual implementation
-  def exec_token(self):
-    return self.first.exec_token() and self.second.exec_token()
+  def eval_postings(self, context):
+    return self.first.eval_postings(context) & self.second.eval_postings(context)
 
 class operator_or_token:
   lbp = 10
   def __init__(self):
     self.id = "OP OR"
-  def led(self, left):
+  def led(self, parser, left):
     self.first = left
-    self.second = expression(10)
+    self.second = parser.expression(10)
     return self
   # --- Actual implementation
-  def exec_token(self):
-    return self.first.exec_token() or self.second.exec_token()
+  def eval_postings(self, context):
+    return self.first.eval_postings(context) | self.second.eval_postings(context)
 
 class end_token:
   lbp = 0
@@ -815,7 +2717,7 @@ def tokenize(program):
   # \s* -> Matches any number of blanks [ \t\n\r\f\v].
   # (?:...) -> A non-capturing version of regular parentheses.
   # \b -> Matches the empty string, but only at the beginning or end of a word.
-  for operator, string in re.findall("\s*(?:(and|or|not|\(|\))|([\w_]+))", program):
+  for operator, string in re.findall(r"\s*(?:(and|or|not|\(|\))|([\w_]+))", program):
     # print 'Tokenize >> Program -> "' + program + \
     #       '", String -> "' + string + '", Operator -> "' + operator + '"\n';
     if string:
@@ -838,30 +2740,51 @@ def tokenize(program):
 # Parser
 # Inspired by http://effbot.org/zone/simple-top-down-parsing.htm
 # ----------------------------------------------------------------------------
-def expression(rbp = 0):
-  global token
-  t = token
-  token = next()
-  left = t.nud()
-  while rbp < token.lbp:
-    t = token
-    token = next()
-    left = t.led(left)
-  return left
-
-def expression_exec(rbp = 0):
-  global token
-  t = token
-  token = next()
-  left = t.nud()
-  while rbp < token.lbp:
-    t = token
-    token = next()
-    left = t.led(left)
-  return left.exec_token()
-
-def parse_exec(program):
-  global token, next
-  next = tokenize(program).__next__
-  token = next()
-  return expression_exec()
+# Parser state (current token and token stream) lives in the Parser object, so
+# several expressions can be parsed at the same time.
+class Parser:
+  def __init__(self, program, tokenizer = tokenize):
+    self.next = tokenizer(program).__next__
+    self.token = self.next()
+
+  def advance(self, id = None):
+    if id and self.token.id != id:
+      raise SyntaxError("Expected %r" % id)
+    self.token = self.next()
+
+  def expression(self, rbp = 0):
+    t = self.token
+    self.token = self.next()
+    left = t.nud(self)
+    while rbp < self.token.lbp:
+      t = self.token
+      self.token = self.next()
+      left = t.led(self, left)
+    return left
+
+  # Parses the whole program. Raises SyntaxError if program is not a valid
+  # expression.
+  def parse(self):
+    try:
+      expr = self.expression()
+    except AttributeError:
+      # Token in a position where it has no nud()/led() (for example "and and")
+      raise SyntaxError("Unexpected token %r" % self.token.id)
+    except StopIteration:
+      raise SyntaxError("Unexpected end of expression")
+    if self.token.id != "END TOKEN":
+      raise SyntaxError("Unexpected token %r" % self.token.id)
+    return expr
+
+#
+# Parses program once and returns the root token of the expression tree. The
+# tree can be evaluated many times with parse_eval_postings(), with no tokenizing
+# or parsing cost.
+# Raises SyntaxError if program is not a valid expression.
+#
+def parse_compile(program):
+  return Parser(program).parse()
+
+# Evaluates a compiled expression over an inverted index. Returns a bitset.
+def parse_eval_postings(expr, postings, all_mask):
+  return expr.eval_postings(Postings_Context(postings, all_mask))
@@ -37,23 +37,26 @@ __prog_option_clean_ROMs = 0
 __prog_option_clean_NFOs = 0
 __prog_option_clean_ArtWork = 0
 __prog_option_sync = 0
+__prog_option_link = None
+__prog_option_verify_hash = 0
 
 # -------------------------------------------------------------------------------------------------
 A_NAME   = 0
 A_SOURCE = 1
 A_DEST   = 2
+A_EXT    = 3
 NARS_ARTWORK_LIST = [
-    ('Titles',     'SourceTitles',     'DestinationTitles'),
-    ('Snaps',      'SourceSnaps',      'DestinationSnaps'),
-    ('Fanarts',    'SourceFanarts',    'DestinationFanarts'),
-    ('Banners',    'SourceBanners',    'DestinationBanners'),
-    ('Clearlogos', 'SourceClearlogos', 'DestinationClearlogos'),
-    ('Boxfronts',  'SourceBoxfronts',  'DestinationBoxfronts'),
-    ('Boxbacks',   'SourceBoxbacks',   'DestinationBoxbacks'),
-    ('Cartridges', 'SourceCartridges', 'DestinationCartridges'),
-    ('Flyers',     'SourceFlyers',     'DestinationFlyers'),
-    ('Manuals',    'SourceManuals',    'DestinationManuals'),
-    ('Trailers',   'SourceTrailers',   'DestinationTrailers')
+    ('Titles',     'SourceTitles',     'DestinationTitles',     NARS.artwork_image_ext_list),
+    ('Snaps',      'SourceSnaps',      'DestinationSnaps',      NARS.artwork_image_ext_list),
+    ('Fanarts',    'SourceFanarts',    'DestinationFanarts',    NARS.artwork_image_ext_list),
+    ('Banners',    'SourceBanners',    'DestinationBanners',    NARS.artwork_image_ext_list),
+    ('Clearlogos', 'SourceClearlogos', 'DestinationClearlogos', NARS.artwork_image_ext_list),
+    ('Boxfronts',  'SourceBoxfronts',  'DestinationBoxfronts',  NARS.artwork_image_ext_list),
+    ('Boxbacks',   'SourceBoxbacks',   'DestinationBoxbacks',   NARS.artwork_image_ext_list),
+    ('Cartridges', 'SourceCartridges', 'DestinationCartridges', NARS.artwork_image_ext_list),
+    ('Flyers',     'SourceFlyers',     'DestinationFlyers',     NARS.artwork_image_ext_list),
+    ('Manuals',    'SourceManuals',    'DestinationManuals',    NARS.artwork_manual_ext_list),
+    ('Trailers',   'SourceTrailers',   'DestinationTrailers',   NARS.artwork_trailer_ext_list)
 ]
 
 # -----------------------------------------------------------------------------
@@ -63,6 +66,8 @@ class Config:
     def __init__(self):
         self.filters = {}
 
+    # A filter is a dictionary with the <collection> tags as keys. Options
+    # parsed from <Options> are stored as 'option_<Name>' (e.g. option_NoBIOS).
     def new_filter(self):
         f = {
             'NoIntroDat'       : '',
@@ -166,9 +171,9 @@ def parse_File_Config():
                     # Parse each option individually
                     for index, item in enumerate(str_list):
                         if str_list[index] == 'NoBIOS':
-                            filter['NoBIOS'] = True
+                            filter['option_NoBIOS'] = True
                         else:
-                            print('[ERROR] On <collection> \'{0}\' in configuration file'.format(filter_class.name))
+                            print('[ERROR] On <collection> \'{0}\' in configuration file'.format(filter_name))
                             print('[ERROR] On tag <{0}>'.format(filter_child.tag))
                             print('[ERROR] Unrecognised option \'{0}\''.format(str_list[index]))
                             sys.exit(10)
@@ -204,12 +209,12 @@ def get_Filter_from_Config(filterName):
 # NOTE: be careful, maybe artwork should be when copied to match ROM name
 #       if artwork was subtituted.
 def copy_ArtWork_file(fileName, artName, sourceDir, destDir):
-  sourceFullFilename = sourceDir + artName + '.png'
-  destFullFilename = destDir + fileName + '.png'
-
   # Maybe artwork does not exist... Then do nothing
-  if not os.path.isfile(sourceFullFilename):
+  artFileName = NARS.fs_dir_snapshot(sourceDir).resolve(artName, NARS.artwork_image_ext_list)
+  if artFileName is None:
     return 1
+  sourceFullFilename = sourceDir + artFileName
+  destFullFilename = destDir + fileName + os.path.splitext(artFileName)[1]
 
   NARS.p_debug('Copying ' + sourceFullFilename)
   NARS.p_debug('Into    ' + destFullFilename)
@@ -228,14 +233,13 @@ def copy_ArtWork_file(fileName, artName, sourceDir, destDir):
 # NOTE: be careful, maybe artwork should be when copied to match ROM name
 #       if artwork was subtituted.
 def update_ArtWork_file(fileName, artName, sourceDir, destDir):
-  sourceFullFilename = sourceDir + artName + '.png'
-  destFullFilename = destDir + fileName + '.png'
-  
-  existsSource = os.path.isfile(sourceFullFilename)
-  existsDest = os.path.isfile(destFullFilename)
   # --- Maybe artwork does not exist... Then do nothing
-  if not os.path.isfile(sourceFullFilename):
+  artFileName = NARS.fs_dir_snapshot(sourceDir).resolve(artName, NARS.artwork_image_ext_list)
+  if artFileName is None:
     return 1
+  sourceFullFilename = sourceDir + artFileName
+  destFullFilename = destDir + fileName + os.path.splitext(artFileName)[1]
+  existsDest = os.path.isfile(destFullFilename)
 
   sizeSource = os.path.getsize(sourceFullFilename)
   if existsDest:
@@ -268,25 +272,41 @@ def copy_ROM_list(rom_list, sourceDir, destDir):
   step = 0
   num_files = 0
   num_copied_roms = 0
+  num_missing_roms = 0
+  num_errors = 0
   for rom_copy_item in sorted(rom_list):
     # --- Update progress
     percentage = 100 * step / num_steps
     sys.stdout.write('{:5.2f}% '.format(percentage))
 
-    # --- Copy file (this function succeeds or aborts program)
+    # --- Copy file
     romFileName = rom_copy_item + '.zip'
     source_path = sourceDir + romFileName
     dest_path = destDir + romFileName
-    NARS.copy_file(source_path, dest_path, __prog_option_dry_run)
-    num_copied_roms += 1
-    NARS.p_info('<Copied> ' + romFileName)
+    ret = NARS.transfer_file(source_path, dest_path, 0, __prog_option_dry_run, link_mode = __prog_option_link)
+    if ret == 0:
+      num_copied_roms += 1
+      NARS.p_info('<Copied> ' + romFileName)
+    elif ret == 1:
+      num_missing_roms += 1
+      NARS.p_info('<Miss  > ' + romFileName)
+    elif ret == -1:
+      num_errors += 1
+      NARS.p_info('<ERROR > ' + romFileName)
+    else:
+      NARS.print_error('[ERROR] copy_ROM_list: Wrong value returned by NARS.transfer_file()')
+      sys.exit(10)
     sys.stdout.flush()
 
     # --- Update progress
     step += 1
 
+  NARS.fs_forget_dir_snapshot(destDir)
+
   NARS.p_info('[Report]')
   NARS.p_info('Copied ROMs ' + '{:6d}'.format(num_copied_roms))
+  NARS.p_info('Missing ROMs ' + '{:5d}'.format(num_missing_roms))
+  NARS.p_info('Errors ' + '{:11d}'.format(num_errors))
 
 def update_ROM_list(rom_list, sourceDir, destDir):
   NARS.p_info('[Updating ROMs into destDir]')
@@ -296,6 +316,8 @@ def update_ROM_list(rom_list, sourceDir, destDir):
   step = 0
   num_copied_roms = 0
   num_updated_roms = 0
+  digest_cache = None
+  if __prog_option_verify_hash: digest_cache = NARS.Digest_Cache(destDir + NARS.digest_cache_filename)
   for rom_copy_item in sorted(rom_list):
     # --- Update progress
     percentage = 100 * step / num_steps
@@ -304,7 +326,8 @@ def update_ROM_list(rom_list, sourceDir, destDir):
     romFileName = rom_copy_item + '.zip'
     source_path = sourceDir + romFileName
     dest_path = destDir + romFileName
-    ret = NARS.update_file(source_path, dest_path, __prog_option_dry_run)
+    ret = NARS.transfer_file(source_path, dest_path, 1, __prog_option_dry_run, digest_cache,
+                             link_mode = __prog_option_link)
     if ret == 0:
       # On default verbosity level only report copied files
       sys.stdout.write('{:5.2f}% '.format(percentage))
@@ -333,6 +356,9 @@ def update_ROM_list(rom_list, sourceDir, destDir):
     # --- Update progress
     step += 1
 
+  NARS.fs_forget_dir_snapshot(destDir)
+  if digest_cache is not None and not __prog_option_dry_run: digest_cache.save()
+
   NARS.p_info('[Report]')
   NARS.p_info('Copied ROMs ' + '{:6d}'.format(num_copied_roms))
   NARS.p_info('Updated ROMs ' + '{:5d}'.format(num_updated_roms))
@@ -341,19 +367,23 @@ def clean_ROMs_destDir(destDir, rom_copy_dic):
   NARS.p_info('[Cleaning ROMs in ROMsDest]')
 
   # --- Delete ROMs present in destDir not present in the filtered list
-  rom_main_list = []
-  for file in os.listdir(destDir):
-    if file.endswith(".zip"):
-      rom_main_list.append(file)
+  # Links (--link) are deleted like files, the linked ROM is never touched.
+  # Symlinks whose target does not exist any more are also deleted.
+  snapshot = NARS.fs_dir_snapshot(destDir)
+  rom_main_list = snapshot.file_list('.zip')
+  rom_main_list.extend([file for file in snapshot.link_set if file.endswith('.zip') and snapshot.is_dangling(file)])
 
   num_cleaned_roms = 0
   for file in sorted(rom_main_list):
     basename, ext = os.path.splitext(file) # Remove extension
-    if basename not in rom_copy_dic:
-      fileName = destDir + file
+    fileName = destDir + file
+    is_link = file in snapshot.link_set
+    if basename not in rom_copy_dic or snapshot.is_dangling(file):
       NARS.delete_file(fileName, __prog_option_dry_run)
       num_cleaned_roms += 1
-      NARS.p_info('<Deleted> ' + file)
+      if is_link: NARS.p_info('<Unlinked> ' + file)
+      else:       NARS.p_info('<Deleted> ' + file)
+  NARS.fs_forget_dir_snapshot(destDir)
 
   NARS.p_info('Deleted ' + str(num_cleaned_roms) + ' redundant ROMs')
 
@@ -361,21 +391,22 @@ __debug_delete_redundant_NFO = 0
 def delete_redundant_NFO(destDir):
   NARS.p_info('[Deleting redundant NFO files]')
   num_deletedNFO_files = 0
-  for file in os.listdir(destDir):
-    if file.endswith(".nfo"):
-      # Chech if there is a corresponding ROM for this NFO file
-      thisFileName, thisFileExtension = os.path.splitext(file)
-      romFileName_temp = destDir + thisFileName + '.zip'
-      if not os.path.isfile(romFileName_temp):
-        if __debug_delete_redundant_NFO:
-          print('MISSING \'{0}\''.format(romFileName_temp))
-        fileName = destDir + file
-        NARS.delete_file(fileName, __prog_option_dry_run)
-        num_deletedNFO_files += 1
-        NARS.p_info('<Deleted NFO> ' + file)
-      else:
-        if __debug_delete_redundant_NFO:
-          print('EXISTS  \'{0}\''.format(romFileName_temp))
+  snapshot = NARS.fs_dir_snapshot(destDir)
+  for file in snapshot.file_list('.nfo'):
+    # Chech if there is a corresponding ROM for this NFO file
+    thisFileName, thisFileExtension = os.path.splitext(file)
+    romFileName_temp = thisFileName + '.zip'
+    if not snapshot.has_file(romFileName_temp):
+      if __debug_delete_redundant_NFO:
+        print('MISSING \'{0}\''.format(destDir + romFileName_temp))
+      fileName = destDir + file
+      NARS.delete_file(fileName, __prog_option_dry_run)
+      num_deletedNFO_files += 1
+      NARS.p_info('<Deleted NFO> ' + file)
+    else:
+      if __debug_delete_redundant_NFO:
+        print('EXISTS  \'{0}\''.format(destDir + romFileName_temp))
+  NARS.fs_forget_dir_snapshot(destDir)
   NARS.p_info('Deleted ' + str(num_deletedNFO_files) + ' redundant NFO files')
 
 def copy_ArtWork_files(filter_config, artwork_copy_dic):
@@ -547,6 +578,20 @@ def update_ArtWork_files(filter_config, artwork_copy_dic):
 #   if romName is     equal to fileBaseName, it is original artwork.
 #   if romName is not equal to fileBaseName, it is substituted artwork.
 #
+#
+# Returns a dictionary with key a ROM file name and value the file name list of
+# its parent/clone set (PClone.filenames), so the set of a ROM is found in O(1).
+# If a file is in several sets the first set wins, like a linear search.
+#
+def get_PClone_filename_index(romMainList_list):
+    pclone_index = {}
+    for pclone_obj in romMainList_list:
+        for filename in pclone_obj.filenames:
+            if filename not in pclone_index:
+                pclone_index[filename] = pclone_obj.filenames
+
+    return pclone_index
+
 def optimize_ArtWork_list(roms_destDir_list, romMainList_list, filter_config):
     __debug_optimize_ArtWork = 1
 
@@ -558,6 +603,8 @@ def optimize_ArtWork_list(roms_destDir_list, romMainList_list, filter_config):
 
     # - For every ROM to be copied (filtered) check if ArtWork exists. If not,
     #   try artwork of other ROMs in the parent/clone set.
+    pclone_index = get_PClone_filename_index(romMainList_list)
+    thumbs_snapshot = NARS.fs_dir_snapshot(thumbsSourceDir)
     artwork_copy_dic = {}
     for rom_copy_item in sorted(roms_destDir_list):
         artworkBaseName = rom_copy_item
@@ -568,29 +615,25 @@ def optimize_ArtWork_list(roms_destDir_list, romMainList_list, filter_config):
 
         # --- Check Thumbs ---
         # First check if we have the original artwork
-        thumbPath = thumbsSourceDir + artworkBaseName + '.png'
+        thumbPath = thumbsSourceDir + artworkBaseName
         if __debug_optimize_ArtWork: print('Testing original    thumb  {0}'.format(thumbPath))
-        if os.path.isfile(thumbPath):
+        if thumbs_snapshot.resolve(artworkBaseName, NARS.artwork_image_ext_list) is not None:
             if __debug_optimize_ArtWork: print('Found   original    thumb  {0}'.format(thumbPath))
             artwork_copy_dic[rom_copy_item]['thumb'] = rom_copy_item
         else:
             # If not found walk through the pclone list
             # Locate in which pClone object set the destDir ROM is
             file = rom_copy_item + '.zip'
-            pclone_list = []
-            for pclone_obj in romMainList_list:
-                if file in pclone_obj.filenames:
-                    pclone_list = pclone_obj.filenames
-                    break
+            pclone_list = pclone_index.get(file, [])
             if len(pclone_list) == 0:
                 NARS.print_error('Logical error')
                 sys.exit(10)
             # Check if artwork exists for every from of this set
             for pclone_rom_full_name in pclone_list:
                 pclone_rom_base_name, ext = os.path.splitext(pclone_rom_full_name)
-                thumbPath = thumbsSourceDir + pclone_rom_base_name + '.png'
+                thumbPath = thumbsSourceDir + pclone_rom_base_name
                 if __debug_optimize_ArtWork: print('Testing substituted thumb  {0}'.format(thumbPath))
-                if os.path.isfile(thumbPath):
+                if thumbs_snapshot.resolve(pclone_rom_base_name, NARS.artwork_image_ext_list) is not None:
                     if __debug_optimize_ArtWork: print('Found   substituted thumb  {0}'.format(thumbPath))
                     artwork_copy_dic[rom_copy_item]['thumb'] = pclone_rom_base_name
                     break
@@ -608,10 +651,7 @@ def clean_ArtWork_destDir(filter_config, artwork_copy_dic):
   NARS.have_dir_or_abort(fanartDestDir, 'fanartDestDir')
 
   # --- Delete unknown thumb ---
-  thumbs_file_list = []
-  for file in os.listdir(thumbsDestDir):
-    if file.endswith(".png"):
-      thumbs_file_list.append(file)
+  thumbs_file_list = NARS.fs_dir_snapshot(thumbsDestDir).file_list(tuple(NARS.artwork_image_ext_list))
 
   num_cleaned_thumbs = 0
   for file in sorted(thumbs_file_list):
@@ -623,10 +663,7 @@ def clean_ArtWork_destDir(filter_config, artwork_copy_dic):
       NARS.p_info('<Deleted thumb > ' + file)
 
   # --- Delete unknown fanart ---
-  fanart_file_list = []
-  for file in os.listdir(fanartDestDir):
-    if file.endswith(".png"):
-      fanart_file_list.append(file)
+  fanart_file_list = NARS.fs_dir_snapshot(fanartDestDir).file_list(tuple(NARS.artwork_image_ext_list))
 
   num_cleaned_fanart = 0
   for file in sorted(fanart_file_list):
@@ -636,6 +673,8 @@ def clean_ArtWork_destDir(filter_config, artwork_copy_dic):
       fileName = fanartDestDir + file
       NARS.delete_file(fileName, __prog_option_dry_run)
       NARS.p_info(' <Deleted fanart> ' + file)
+  NARS.fs_forget_dir_snapshot(thumbsDestDir)
+  NARS.fs_forget_dir_snapshot(fanartDestDir)
 
   # --- Report
   NARS.p_info('Deleted ' + str(num_cleaned_thumbs) + ' redundant thumbs')
@@ -647,14 +686,11 @@ def clean_ArtWork_destDir(filter_config, artwork_copy_dic):
 def create_copy_list(romMain_list, filter_config):
   # --- Scan sourceDir to get the list of available ROMs ---
   NARS.p_info('[Scanning sourceDir for ROMs to be copied/updated]')
-  if filter_config.option_NoBIOS: NARS.p_info('Option NoBIOS is ON')
-  else:                           NARS.p_info('Option NoBIOS is OFF')
+  if filter_config['option_NoBIOS']: NARS.p_info('Option NoBIOS is ON')
+  else:                                 NARS.p_info('Option NoBIOS is OFF')
 
-  sourceDir = filter_config.sourceDir
-  sourceDir_rom_list = []
-  for file in os.listdir(sourceDir):
-    if file.endswith(".zip"):
-      sourceDir_rom_list.append(file)
+  sourceDir = filter_config['SourceROMs']
+  source_snapshot = NARS.fs_dir_snapshot(sourceDir)
 
   # For each parent/clone list, pick the first available ROM in sourceDir
   # (if not excluded) to be copied.
@@ -664,9 +700,9 @@ def create_copy_list(romMain_list, filter_config):
     for index in range(num_pclone_set_files):
       filename    = mainROM_obj.filenames[index]
       includeFlag = mainROM_obj.include[index]
-      if filename in sourceDir_rom_list and includeFlag:
+      if source_snapshot.has_file(filename) and includeFlag:
         # If option NoBIOS is ON and the ROM name starts with '[BIOS]' then skip it
-        if filter_config.option_NoBIOS and re.search('^\[BIOS\]', filename):
+        if filter_config['option_NoBIOS'] and re.search('^\[BIOS\]', filename):
           NARS.p_debug('NoBIOS is ON. Skipping ROM \'{0}\''.format(filename))
           continue
 
@@ -954,18 +990,17 @@ def get_directory_Main_PClone_list(filter_config):
   
   # --- Read all files in sourceDir ---
   NARS.p_info('[Reading ROMs in source dir]')
-  sourceDir = filter_config.sourceDir
+  sourceDir = filter_config['SourceROMs']
   romMainList_dict = {}
   num_ROMs_sourceDir = 0
-  for file in os.listdir(sourceDir):
-    if file.endswith(".zip"):
-      num_ROMs_sourceDir += 1
-      romObject = dir_ROM(file)
-      romObject.baseName = get_ROM_baseName(file)
-      romMainList_dict[file] = romObject
-      if __debug_sourceDir_ROM_scanner:
-        print("  ROM       '" + romObject.fileName + "'")
-        print("   baseName '" + romObject.baseName + "'")
+  for file in NARS.fs_dir_snapshot(sourceDir).file_list('.zip'):
+    num_ROMs_sourceDir += 1
+    romObject = dir_ROM(file)
+    romObject.baseName = get_ROM_baseName(file)
+    romMainList_dict[file] = romObject
+    if __debug_sourceDir_ROM_scanner:
+      print("  ROM       '" + romObject.fileName + "'")
+      print("   baseName '" + romObject.baseName + "'")
   NARS.p_info('Found ' + str(num_ROMs_sourceDir) + ' ROMs')
   
   # --- Create a parent/clone list based on the baseName of the ROM ---
@@ -1046,10 +1081,10 @@ def get_Scores_and_Filter(romMain_list, rom_Tag_dic, filter_config):
   NARS.p_info('[Scoring and filtering ROMs]')
   __debug_main_ROM_list = 0
 
-  upTag_list      = filter_config.filterUpTags
-  downTag_list    = filter_config.filterDownTags
-  includeTag_list = filter_config.includeTags
-  excludeTag_list = filter_config.excludeTags
+  upTag_list      = filter_config['filterUpTags']
+  downTag_list    = filter_config['filterDownTags']
+  includeTag_list = filter_config['includeTags']
+  excludeTag_list = filter_config['excludeTags']
 
   # --- Add ROM scores to ROM main list ---
   for mainROM_obj in romMain_list:
@@ -1330,9 +1365,8 @@ def do_check_nointro(filter_name):
   NARS.p_info('[Scanning ROMs in sourceDir]')
   have_roms = 0
   unknown_roms = 0
-  file_list = []
-  for file in os.listdir(sourceDir):
-    file_list.append(file)
+  source_snapshot = NARS.fs_dir_snapshot(sourceDir)
+  file_list = source_snapshot.file_list()
   for file in sorted(file_list):
     if file.endswith(".zip"):
       if file in nointro_roms:
@@ -1345,8 +1379,7 @@ def do_check_nointro(filter_name):
   # Check how many ROMs we have in the DAT not in sourceDir
   missing_roms = 0
   for game in sorted(nointro_roms):
-    filename = sourceDir + game
-    if not os.path.isfile(filename):
+    if not source_snapshot.has_file(game):
       NARS.p_info('\033[31m{Missing ROM}\033[0m  ' + game)
       missing_roms += 1
 
@@ -1364,25 +1397,24 @@ def do_taglist(filter_name):
   NARS.p_info('[Listing tags]')
   NARS.p_info("Filter name '{:}'".format(filter_name))
   filter_config = get_Filter_from_Config(filter_name)
-  source_dir = filter_config.sourceDir
+  source_dir = filter_config['SourceROMs']
   NARS.have_dir_or_abort(source_dir, 'sourceDir')
   NARS.p_info("Source directory '{:}'".format(source_dir))
 
   # Traverse directory, for every file extract properties, and add them to the
   # dictionary.
   properties_dic = {}
-  for file in os.listdir(source_dir):
-    if file.endswith(".zip"):
-      rom_props = extract_ROM_Tags_All(file)
-      if len(rom_props) == 0:
-        print_error(file + 'Has no tags!')
-        sys.exit(10)
-      else:
-        for property in rom_props:
-          if property in properties_dic:
-            properties_dic[property] += 1
-          else:
-            properties_dic[property] = 1
+  for file in NARS.fs_dir_snapshot(source_dir).file_list('.zip'):
+    rom_props = extract_ROM_Tags_All(file)
+    if len(rom_props) == 0:
+      print_error(file + 'Has no tags!')
+      sys.exit(10)
+    else:
+      for property in rom_props:
+        if property in properties_dic:
+          properties_dic[property] += 1
+        else:
+          properties_dic[property] = 1
 
   # Works for Python 2
   # http://stackoverflow.com/questions/613183/python-sort-a-dictionary-by-value
@@ -1420,13 +1452,13 @@ def do_check(filter_name):
   num_miss_roms = 0
   num_include_roms = 0
   num_exclude_roms = 0
-  NARS.have_dir_or_abort(filter_config.sourceDir, 'sourceDir')
+  NARS.have_dir_or_abort(filter_config['SourceROMs'], 'sourceDir')
   NARS.p_info("[List of scored parent/clone ROM sets]")
   for index_main in range(len(romMainList_list)):
     rom_object = romMainList_list[index_main]
     for index in range(len(rom_object.filenames)):
       # Check if file exists (maybe it does not exist for No-Intro lists)
-      sourceFullFilename = filter_config.sourceDir + rom_object.filenames[index]
+      sourceFullFilename = filter_config['SourceROMs'] + rom_object.filenames[index]
       fullROMFilename = os.path.isfile(sourceFullFilename)
       num_roms += 1
       if index == 0: copyFlag = '\033[32mCOPY\033[0m'
@@ -1487,8 +1519,8 @@ def do_update(filter_name):
   NARS.p_info('[Copy/Update ROMs]')
   NARS.p_info("Filter name '{:}'".format(filter_name))
   filter_config = get_Filter_from_Config(filter_name)
-  sourceDir = filter_config.sourceDir
-  destDir   = filter_config.destDir
+  sourceDir = filter_config['SourceROMs']
+  destDir   = filter_config['DestinationROMs']
   NARS.have_dir_or_abort(sourceDir, 'sourceDir')
   NARS.have_dir_or_abort(destDir, 'destDir')
   NARS.p_info("Source directory      '{:}'".format(sourceDir))
@@ -1516,6 +1548,38 @@ def do_update(filter_name):
   if __prog_option_clean_NFOs:
     delete_redundant_NFO(destDir)
 
+#
+# Applies every collection and copies ROMs, reading each source ROM only once
+#
+def do_update_all():
+  NARS.p_info('[Copy/Update ROMs of all collections]')
+
+  # --- Apply filters and create union of copy plans ---
+  # Collections without ROM directories are skipped.
+  plan_list = []
+  for filter_name in sorted(configuration.filters):
+    filter_config = configuration.filters[filter_name]
+    sourceDir = filter_config['SourceROMs']
+    destDir   = filter_config['DestinationROMs']
+    if not sourceDir or not destDir:
+      NARS.p_info("Skipping collection '{:}' (ROM directories not configured)".format(filter_name))
+      continue
+    NARS.have_dir_or_abort(sourceDir, 'sourceDir')
+    NARS.have_dir_or_abort(destDir, 'destDir')
+    NARS.p_info("Filter name '{:}'".format(filter_name))
+    romMainList_list = filter_ROMs(filter_config)
+    rom_copy_list = create_copy_list(romMainList_list, filter_config)
+    plan_list.append((filter_name, sourceDir, destDir, rom_copy_list))
+
+  # --- Copy/Update ROMs into destDirs ---
+  NARS.copy_ROM_fanout(plan_list, __prog_option_sync, __prog_option_dry_run)
+
+  for (filter_name, sourceDir, destDir, rom_copy_list) in plan_list:
+    if __prog_option_clean_ROMs:
+      clean_ROMs_destDir(destDir, rom_copy_list)
+    if __prog_option_clean_NFOs:
+      delete_redundant_NFO(destDir)
+
 #
 # Checks for missing artwork and prints a report
 #
@@ -1548,6 +1612,13 @@ def do_checkArtwork(filter_name):
         enabled_asset_list[index] = True if (SourceConfigured and DestConfigured and \
                                              SourceExists and DestExists) else False
 
+    # --- Scan every enabled asset source directory once ---
+    # >> Have/miss decisions below are answered from these snapshots.
+    source_snapshot_list = [None] * len(NARS_ARTWORK_LIST)
+    for index, item in enumerate(NARS_ARTWORK_LIST):
+        if not enabled_asset_list[index]: continue
+        source_snapshot_list[index] = NARS.fs_dir_snapshot(filter_config[item[A_SOURCE]])
+
     # --- Obtain main parent/clone list, either based on DAT or source_dir file list ---
     romMainList_list = get_PClone_main_list(filter_config)
 
@@ -1582,12 +1653,10 @@ def do_checkArtwork(filter_name):
             # print(' Original   ' + art_baseName)
 
         # --- Check if artwork exist ---
-        have_asset_list = [False] * len(MAME_ARTWORK_LIST)
-        for index, item in enumerate(MAME_ARTWORK_LIST):
+        have_asset_list = [False] * len(NARS_ARTWORK_LIST)
+        for index, item in enumerate(NARS_ARTWORK_LIST):
             if not enabled_asset_list[index]: continue
-            source_dir = filter_config[item[A_SOURCE]]
-            thumb_Source_fullFileName = source_dir + art_baseName + '.png'
-            if os.path.isfile(thumb_Source_fullFileName):
+            if source_snapshot_list[index].resolve(art_baseName, item[A_EXT]) is not None:
                 num_have_thumbs += 1
                 have_asset_list[index] = True
             else:
@@ -1595,9 +1664,9 @@ def do_checkArtwork(filter_name):
                 have_asset_list[index] = False
 
         # --- Print information ---
-        asset_num = len(MAME_ARTWORK_LIST)
+        asset_num = len(NARS_ARTWORK_LIST)
         info_str = ''
-        for index, item in enumerate(MAME_ARTWORK_LIST):
+        for index, item in enumerate(NARS_ARTWORK_LIST):
             if not enabled_asset_list[index]: info_str += '    DIS'
             else:
                 info_str += '   \033[32mHAVE\033[0m' if have_asset_list[index] else '   \033[31mMISS\033[0m'
@@ -1671,6 +1740,8 @@ def do_printHelp():
 \033[31mcheck <filter>\033[0m           Applies ROM filters and prints a list of the scored ROMs.
 \033[31mcopy <filter>\033[0m            Applies ROM filters defined and copies ROMS from sourceDir into destDir.
 \033[31mupdate <filter>\033[0m          Like copy, but also delete unneeded ROMs in destDir.
+\033[31mcopy-all\033[0m                 Like copy for every collection, reading each source ROM only once.
+\033[31mupdate-all\033[0m               Like update for every collection, reading each source ROM only once.
 \033[31mcheck-artwork  <filter>\033[0m  Reads the ROMs in destDir, checks if you have the corresponding artwork. 
 \033[31mcopy-artwork   <filter>\033[0m  Reads the ROMs in destDir and tries to copy the artwork to destDir.
 \033[31mupdate-artwork <filter>\033[0m  Like copy-artwork, but also delete unknown images in artwork destDir.
@@ -1683,7 +1754,9 @@ def do_printHelp():
 \033[35m--dryRun\033[0m                 Don't modify destDir at all, just print the operations to be done.
 \033[35m--cleanROMs\033[0m              Deletes ROMs in destDir not present in the filtered ROM list.
 \033[35m--cleanNFOs\033[0m              Deletes redundant NFO files in destination directory.
-\033[35m--cleanArtWork\033[0m           Deletes unknown artwork in destination.""")
+\033[35m--cleanArtWork\033[0m           Deletes unknown artwork in destination.
+\033[35m--link\033[0m \033[31m[hard|sym]\033[0m        ROMs are hardlinked or symlinked instead of copied.
+\033[35m--verifyHash\033[0m             update compares ROM contents, not only sizes.""")
 
 # -----------------------------------------------------------------------------
 # main function
@@ -1700,9 +1773,11 @@ parser.add_argument('--dryRun', help="don't modify any files", action="store_tru
 parser.add_argument('--cleanROMs', help="clean destDir of unknown ROMs", action="store_true")
 parser.add_argument('--cleanNFOs', help="clean redundant NFO files", action="store_true")
 parser.add_argument('--cleanArtWork', help="clean unknown ArtWork", action="store_true")
+parser.add_argument('--link', help="link ROMs instead of copying", choices = NARS.link_mode_list, nargs = 1)
+parser.add_argument('--verifyHash', help="update compares file contents", action="store_true")
 parser.add_argument('command',
    help="usage, list, list-nointro, check-nointro, list-tags, \
-         check, copy, update \
+         check, copy, update, copy-all, update-all \
          check-artwork, copy-artwork, update-artwork", nargs = 1)
 parser.add_argument("filterName", help="ROM collection name", nargs='?')
 args = parser.parse_args()
@@ -1727,6 +1802,8 @@ if args.dryRun:       __prog_option_dry_run = 1
 if args.cleanROMs:    __prog_option_clean_ROMs = 1
 if args.cleanNFOs:     __prog_option_clean_NFOs = 1
 if args.cleanArtWork: __prog_option_clean_ArtWork = 1
+if args.link:         __prog_option_link = args.link[0]
+if args.verifyHash:   __prog_option_verify_hash = 1
 
 # --- Positional arguments that don't require parsing of the config file ---
 command = args.command[0]
@@ -1734,6 +1811,20 @@ if command == 'usage':
   do_printHelp()
   sys.exit(0)
 
+# --- copy-all/update-all read each source once, linking reads nothing ---
+if (command == 'copy-all' or command == 'update-all') and __prog_option_link:
+  print('\033[31m[ERROR]\033[0m --link cannot be used with {0}. Use copy/update with each collection.'.format(command))
+  sys.exit(10)
+
+# --- --verifyHash only has effect when updating copied files ---
+if __prog_option_verify_hash:
+  if command != 'update':
+    print('\033[31m[ERROR]\033[0m --verifyHash only works with command update (nars-console has no CHDs)')
+    sys.exit(10)
+  if __prog_option_link:
+    print('\033[31m[ERROR]\033[0m --verifyHash cannot be used with --link')
+    sys.exit(10)
+
 # --- Check arguments that require a filterName ---
 if command == 'list-nointro' or command == 'check-nointro' or \
    command == 'list-tags' or \
@@ -1752,8 +1843,14 @@ elif command == 'list-nointro':   do_list_nointro(args.filterName)
 elif command == 'check-nointro':  do_check_nointro(args.filterName)
 elif command == 'list-tags':      do_taglist(args.filterName)
 elif command == 'check':          do_check(args.filterName)
-elif command == 'copy':           do_update(args.filterName, False)
-elif command == 'update':         do_update(args.filterName, True)
+elif command == 'copy':           do_update(args.filterName)
+elif command == 'update':
+  __prog_option_sync = 1
+  do_update(args.filterName)
+elif command == 'copy-all':       do_update_all()
+elif command == 'update-all':
+  __prog_option_sync = 1
+  do_update_all()
 elif command == 'check-artwork':  do_checkArtwork(args.filterName)
 elif command == 'copy-artwork':   do_update_artwork(args.filterName, False)
 elif command == 'update-artwork': do_update_artwork(args.filterName, True)
@@ -20,7 +20,7 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
-import sys, os, re, shutil
+import sys, os, re, shutil, datetime
 import operator, argparse
 import xml.etree.ElementTree as ET
 import NARS
@@ -39,6 +39,10 @@ __prog_option_clean_NFO = 0
 __prog_option_clean_ArtWork = 0
 __prog_option_clean_CHD = 0
 __prog_option_sync = 0
+__prog_option_workers = 1
+__prog_option_verify_hash = 0
+__prog_option_link = None
+__prog_option_delta_CHD = 0
 
 # -----------------------------------------------------------------------------
 # Configuration file stuff
@@ -50,6 +54,7 @@ class Config:
             'MAME_XML_redux' : '',
             'Catver' : '',
             'Merged_XML' : '',
+            'DerivedArtworkCache' : '',
             'MachineSwap' : []
         }
 
@@ -77,6 +82,8 @@ class Config:
             'Buttons'            : '',
             'Players'            : '',
             'Years'              : '',
+            'MaxBytesPerSecond'  : 0,
+            'MaxFilesPerSecond'  : 0,
 
             'SourceTitles'       : '', 'DestinationTitles'     : '',
             'SourceSnaps'        : '', 'DestinationSnaps'      : '',
@@ -88,7 +95,12 @@ class Config:
             'SourcePCBs'         : '', 'DestinationPCBs'       : '',
             'SourceFlyers'       : '', 'DestinationFlyers'     : '',
             'SourceManuals'      : '', 'DestinationManuals'    : '',
-            'SourceTrailers'     : '', 'DestinationTrailers'   : ''
+            'SourceTrailers'     : '', 'DestinationTrailers'   : '',
+
+            # >> Transcode specs, see NARS.parse_transcode_string(). None means copy as is.
+            'TranscodeTitles'    : None, 'TranscodeSnaps'      : None, 'TranscodeFanarts'    : None,
+            'TranscodeMarquees'  : None, 'TranscodeClearlogos' : None, 'TranscodeCabinets'   : None,
+            'TranscodeCPanels'   : None, 'TranscodePCBs'       : None, 'TranscodeFlyers'     : None
         }
 
         return f
@@ -110,6 +122,11 @@ def parse_File_Config():
             if root_child.text is None: continue
             configuration.options[root_child.tag] = root_child.text
             NARS.print_debug('Main tag {0} = {1}'.format(root_child.tag, root_child.text))
+        elif root_child.tag == 'DerivedArtworkCache':
+            if root_child.text is None: continue
+            clean_dir = fix_directory_name(root_child.text)
+            configuration.options[root_child.tag] = clean_dir
+            NARS.print_debug('Main tag {0} = {1}'.format(root_child.tag, clean_dir))
         elif root_child.tag == 'MachineSwap':
             if root_child.text is None: continue        
             (A, B) = parse_tag_MachineSwap(root_child.text)
@@ -152,10 +169,35 @@ def parse_File_Config():
 
                 # >> Comma separated value tags
                 elif filter_child.tag in ['Options', 'Include', 'Exclude']:
-                    t_list = trim_list(filter_child.text.split(","))
+                    if filter_child.text is None: t_list = []
+                    else:                         t_list = trim_list(filter_child.text.split(","))
                     filter[filter_child.tag] = t_list
                     NARS.print_debug(' {0} = {1}'.format(filter_child.tag, t_list))
 
+                # >> Copy rate limits (see NARS.parse_rate_string())
+                elif filter_child.tag in ['MaxBytesPerSecond', 'MaxFilesPerSecond']:
+                    try:
+                        rate = NARS.parse_rate_string(filter_child.text)
+                    except ValueError:
+                        NARS.print_error('[ERROR] Inside <MAMEFilter> named "{0}"'.format(filter_name))
+                        NARS.print_error('[ERROR] Wrong rate in <{0}>{1}</{0}>'.format(filter_child.tag, filter_child.text))
+                        sys.exit(10)
+                    filter[filter_child.tag] = rate
+                    NARS.print_debug(' {0} = {1}'.format(filter_child.tag, rate))
+
+                # >> Artwork transcode specs (see NARS.parse_transcode_string())
+                elif filter_child.tag in ['TranscodeTitles', 'TranscodeSnaps', 'TranscodeFanarts',
+                                          'TranscodeMarquees', 'TranscodeClearlogos', 'TranscodeCabinets',
+                                          'TranscodeCPanels', 'TranscodePCBs', 'TranscodeFlyers']:
+                    try:
+                        transcode_spec = NARS.parse_transcode_string(filter_child.text)
+                    except ValueError:
+                        NARS.print_error('[ERROR] Inside <MAMEFilter> named "{0}"'.format(filter_name))
+                        NARS.print_error('[ERROR] Wrong transcode spec in <{0}>{1}</{0}>'.format(filter_child.tag, filter_child.text))
+                        sys.exit(10)
+                    filter[filter_child.tag] = transcode_spec
+                    NARS.print_debug(' {0} = {1}'.format(filter_child.tag, transcode_spec))
+
                 # >> MachineSwap tag
                 elif filter_child.tag == 'MachineSwap':
                     (A, B) = parse_tag_MachineSwap(filter_child.text)
@@ -199,7 +241,23 @@ def get_Filter_from_Config(filterName):
 # Misc functions
 # -----------------------------------------------------------------------------
 # A class to store the MAME machine information.
+# There are tens of thousands of Machine objects, so attributes are stored in
+# slots instead of a per-object __dict__. Repeated strings (drivers,
+# manufacturers, years, categories, ...) are interned so all machines share the
+# same string object. Lists of strings are stored as tuples once the machine is
+# parsed, and all empty lists share the same empty tuple.
+# Increment MACHINE_CACHE_VERSION whenever class Machine changes, so machine
+# caches created by older versions are discarded.
+MACHINE_CACHE_VERSION = 2
 class Machine:
+  __slots__ = ('name', 'cloneof', 'sampleof', 'sourcefile', 'isClone', 'isParent',
+               'isDevice', 'isRunnable', 'isMechanical', 'isBIOS', 'hasSamples',
+               'description', 'year', 'manufacturer', 'driver_status', 'isWorking',
+               'category', 'buttons', 'players', 'coins', 'hasCoinSlot',
+               'control_type_list', 'hasROMs', 'hasCHDs', 'hasSoftwareLists',
+               'displayType', 'orientation', 'BIOS_depends_list',
+               'device_depends_list', 'CHD_depends_list')
+
   def __init__(self):
     # XML Machine attributes
     self.name                = None   # str  machine name (<machine name="">)
@@ -224,7 +282,7 @@ class Machine:
     self.players             = 0      # int
     self.coins               = 0      # int
     self.hasCoinSlot         = False  # bool
-    self.control_type_list   = []     # str list
+    self.control_type_list   = ()     # str tuple
     # Custom <NARS> attributes
     self.hasROMs             = True   # bool
     self.hasCHDs             = False  # bool
@@ -232,9 +290,132 @@ class Machine:
     self.displayType         = None   # str
     self.orientation         = None   # str
     # Custom <NARS> tags
-    self.BIOS_depends_list   = []  # str list
-    self.device_depends_list = []  # str list
-    self.CHD_depends_list    = []  # str list
+    self.BIOS_depends_list   = ()  # str tuple
+    self.device_depends_list = ()  # str tuple
+    self.CHD_depends_list    = ()  # str tuple
+
+  # Slots objects have no __dict__. Define pickle state explicitly so the
+  # machine cache does not depend on the default slots pickling.
+  def __getstate__(self):
+    return tuple(getattr(self, slot) for slot in Machine.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in zip(Machine.__slots__, state):
+      setattr(self, slot, value)
+
+#
+# Index of the machine dictionary used by the filters. Every machine has an id
+# (its position in the sorted list of machine names) and every boolean attribute
+# of class Machine has a bitset with the ids of the machines that have the
+# attribute True. Filters work on bitsets (masks) of machine ids and the
+# filtered dictionary is created only once at the end.
+#
+class MachineIndex:
+  boolean_attributes = ('isParent', 'isClone', 'isDevice', 'isRunnable', 'isMechanical',
+                        'isBIOS', 'hasSamples', 'isWorking', 'hasROMs', 'hasCHDs',
+                        'hasCoinSlot', 'hasSoftwareLists')
+  postings_columns = ('Driver', 'Categories', 'DisplayType', 'DisplayOrientation', 'Controls')
+  numeric_columns = ('Buttons', 'Players')
+
+  def __init__(self, mame_dic):
+    self.mame_dic     = mame_dic
+    self.name_list    = sorted(mame_dic)
+    self.id_dic       = {name : id for id, name in enumerate(self.name_list)}
+    self.num_machines = len(self.name_list)
+    self.all_mask     = (1 << self.num_machines) - 1
+    self.bitset_dic   = {}
+    machine_list = [mame_dic[name] for name in self.name_list]
+    for attribute in MachineIndex.boolean_attributes:
+      self.bitset_dic[attribute] = NARS.bitset_from_ids(
+        (id for id, machine in enumerate(machine_list) if getattr(machine, attribute)),
+        self.num_machines)
+
+    # Inverted indexes of the string attributes used by the expression filters.
+    # key = filter tag : value = { attribute value : bitset of machines }
+    self.postings_dic = {}
+    for column_name in MachineIndex.postings_columns:
+      value_ids_dic = {}
+      for id, machine in enumerate(machine_list):
+        for value in self.get_column_values(column_name, machine):
+          if value is None: continue
+          if value in value_ids_dic: value_ids_dic[value].append(id)
+          else:                      value_ids_dic[value] = [id]
+      self.postings_dic[column_name] = {
+        value : NARS.bitset_from_ids(id_list, self.num_machines) for value, id_list in value_ids_dic.items()
+      }
+
+    # Inverted indexes of the integer attributes used by the numeric filters.
+    # key = filter tag : value = { integer value : bitset of machines }
+    self.numeric_postings_dic = {}
+    for column_name in MachineIndex.numeric_columns:
+      value_ids_dic = {}
+      for id, machine in enumerate(machine_list):
+        value = self.get_numeric_value(column_name, machine)
+        if value in value_ids_dic: value_ids_dic[value].append(id)
+        else:                      value_ids_dic[value] = [id]
+      self.numeric_postings_dic[column_name] = {
+        value : NARS.bitset_from_ids(id_list, self.num_machines) for value, id_list in value_ids_dic.items()
+      }
+
+    # Year intervals. Year strings are parsed only once, here. There are only a
+    # few hundred distinct intervals.
+    # key = (min_year, max_year, verified) : value = bitset of machines
+    value_ids_dic = {}
+    for id, machine in enumerate(machine_list):
+      value = parse_year_string(machine.year)
+      if value in value_ids_dic: value_ids_dic[value].append(id)
+      else:                      value_ids_dic[value] = [id]
+    self.year_postings = {
+      value : NARS.bitset_from_ids(id_list, self.num_machines) for value, id_list in value_ids_dic.items()
+    }
+
+  # Values of a machine searched by the expression filters. A machine may have
+  # more than one control, so all the values are returned as a tuple.
+  def get_column_values(self, column_name, machine):
+    if   column_name == 'Driver':             return (machine.sourcefile,)
+    elif column_name == 'Categories':         return (machine.category,)
+    elif column_name == 'DisplayType':        return (machine.displayType,)
+    elif column_name == 'DisplayOrientation': return (machine.orientation,)
+    elif column_name == 'Controls':           return machine.control_type_list
+    else:
+      NARS.print_error('[ERROR] MachineIndex >> Unknown column {0}'.format(column_name))
+      sys.exit(10)
+
+  def get_numeric_value(self, column_name, machine):
+    if   column_name == 'Buttons': return machine.buttons
+    elif column_name == 'Players': return machine.players
+    else:
+      NARS.print_error('[ERROR] MachineIndex >> Unknown numeric column {0}'.format(column_name))
+      sys.exit(10)
+
+  # Generator of the machine names in mask, sorted.
+  def names(self, mask):
+    name_list = self.name_list
+    for id in NARS.bitset_to_ids(mask):
+      yield name_list[id]
+
+  # Creates a machine dictionary with the machines in mask.
+  def materialize(self, mask):
+    mame_dic = self.mame_dic
+
+    return {name : mame_dic[name] for name in self.names(mask)}
+
+# The index is created when the machine dictionary is loaded and reused by all
+# the filters run on that dictionary.
+machine_index = None
+def get_machine_index(mame_dic):
+  global machine_index
+
+  if machine_index is None or machine_index.mame_dic is not mame_dic:
+    machine_index = MachineIndex(mame_dic)
+
+  return machine_index
+
+# Interns a string read from the XML. None is returned unchanged.
+def intern_str(string):
+  if string is None: return None
+
+  return sys.intern(string)
 
 # Parses machine swaps in configuration filter, like <MachineSwap>tmnt --> tmnt2po</MachineSwap>
 # Returns a tuple with the first machine (original name) and the second machine (swapped).
@@ -285,62 +466,51 @@ def trim_driver_string(driver_str):
 
 # Wildcard expansion range
 min_year = 1970
-max_year = 2016
-def trim_year_string(raw_year_text):
-  year_text = raw_year_text
+max_year = datetime.date.today().year
+
+#
+# Parses a MAME year string into a year interval. Returns a tuple
+# (min_year, max_year, verified):
+#   1997   -> (1997, 1997, True)   standard year
+#   1997?  -> (1997, 1997, False)  year not verified
+#   198?   -> (1980, 1989, False)  decade wildcard
+#   19??   -> (1970, 1999, False)  century wildcard, limited to min_year
+#   ????   -> (1970, today, False) unknown year
+#
+def parse_year_string(year_str):
+  if year_str is None:
+    return (min_year, max_year, False)
 
   # --- Remove quotation marks at the end for some games
+  year_text = year_str.strip()
+  verified = True
   if len(year_text) == 5 and year_text[4] == '?':
-    # About array slicing, see this page. Does not work like C!
-    # http://stackoverflow.com/questions/509211/pythons-slice-notation
     year_text = year_text[0:4]
+    verified = False
 
-  # --- Expand wildcards to numerical lists. Currently there are 6 cases
-  # Basic expansion: 197?, 198?, 199?, 200?
-  if year_text == '197?':
-    year_list = [str(x) for x in range(1970, 1979)]
-  elif year_text == '198?':
-    year_list = [str(x) for x in range(1980, 1989)]
-  elif year_text == '199?':
-    year_list = [str(x) for x in range(1990, 1999)]
-  elif year_text == '200?':
-    year_list = [str(x) for x in range(2000, 2009)]
-  # Full expansion: ????, 19??, 20??
-  elif year_text == '19??':
-    year_list = [str(x) for x in range(min_year, 1999)]
-  elif year_text == '20??':
-    year_list = [str(x) for x in range(2000, max_year)]
-  elif year_text == '????':
-    year_list = [str(x) for x in range(min_year, max_year)]
-  # No expansion
-  else:
-    year_list = [year_text]
+  if len(year_text) == 4 and year_text.isdigit():
+    return (int(year_text), int(year_text), verified)
 
-  return year_list
+  # --- Expand wildcards to an interval
+  match = re.match(r'^(\d*)(\?+)$', year_text)
+  if len(year_text) == 4 and match:
+    prefix = match.group(1)
+    num_wildcards = len(match.group(2))
+    low = max(int(prefix + '0' * num_wildcards), min_year)
+    high = min(int(prefix + '9' * num_wildcards), max_year)
+    if low > high: low = high = int(prefix + '0' * num_wildcards)
 
-# Game year information:
-# INPUT: takes a string as input
-# RETURN: returns and integer,
-# 1  standard game or game with not-verified year (example 1998?)
-# 2  game that needs decade expansion (examples 198?, 199?) or
-#    full expansion (examples 19??, ????)
-def get_game_year_information(year_srt):
-  # --- Remove quotation marks at the end for some games
-  if len(year_srt) == 5 and year_srt[4] == '?':
-    year_srt = year_srt[0:4]
-
-  # --- Get game information
-  game_info = 1
-  if year_srt == '197?' or year_srt == '198?' or \
-     year_srt == '199?' or year_srt == '200?' or \
-     year_srt == '19??' or year_srt == '20??' or \
-     year_srt == '????':
-    game_info = 2
-  elif not year_srt.isdigit():
-    print_error('Unknown MAME year string "' + year_srt + '"')
-    sys.exit(10)
+    return (low, high, False)
+
+  NARS.print_verb('[WARNING] Unknown MAME year string "{0}". Year is unknown.'.format(year_str))
 
-  return game_info
+  return (min_year, max_year, False)
+
+# Expands year wildcards into a list of year strings.
+def trim_year_string(raw_year_text):
+  (low, high, verified) = parse_year_string(raw_year_text)
+
+  return [str(x) for x in range(low, high + 1)]
 
 # Splits string into words
 # See http://stackoverflow.com/questions/15929233/writing-a-tokenizer-in-python
@@ -458,9 +628,9 @@ def create_copy_CHD_dic(mame_filtered_dic):
       print('DEBUG: Machine {0}'.format(key))
     romObject = mame_filtered_dic[key]
     # CHD dependencies
-    if hasattr(romObject, 'CHD_depends') and (romObject.CHD_depends):
+    if romObject.CHD_depends_list:
       CHD_list = []
-      for CHD_depend in romObject.CHD_depends:
+      for CHD_depend in romObject.CHD_depends_list:
         CHD_list.append(CHD_depend)
         num_added_CHDs += 1
         NARS.print_info('Game ' + key.ljust(8) + ' depends on CHD    ' + \
@@ -473,8 +643,7 @@ def create_copy_CHD_dic(mame_filtered_dic):
   return CHD_dic
 
 # This function should be renamed and put into NARS module.
-# This function should be refactored. For a file list there is no need to
-# use the Machine class!
+# Returns a dictionary with key the ROM name and value the ROM file name.
 def get_ROM_main_list(sourceDir):
   """Reads sourceDir and creates a dictionary of ROMs"""
   __debug_get_ROM_main_list = 0
@@ -482,17 +651,12 @@ def get_ROM_main_list(sourceDir):
   # --- Parse sourceDir ROM list and create main ROM list
   NARS.print_info('[Reading ROMs in source directory]')
   romMainList_dict = {}
-  for file in os.listdir(sourceDir):
-    if file.endswith(".zip"):
-      thisFileName, thisFileExtension = os.path.splitext(file)
-      romFileName_temp = thisFileName + '.zip'
-      romObject = Machine()
-      romObject.name = thisFileName
-      romObject.filename = file
-      romMainList_dict[thisFileName] = romObject
-      if __debug_get_ROM_main_list:
-        print(romObject.name)
-        print(romObject.filename)
+  for file in NARS.fs_dir_snapshot(sourceDir).file_list('.zip'):
+    thisFileName, thisFileExtension = os.path.splitext(file)
+    romMainList_dict[thisFileName] = file
+    if __debug_get_ROM_main_list:
+      print(thisFileName)
+      print(file)
 
   return romMainList_dict
 
@@ -559,8 +723,6 @@ def generate_MAME_NFO_files(rom_copy_dic, mame_filtered_dic, destDir, __prog_opt
       plot_str += ' | Buttons = {:d}'.format(romObj.buttons)
     if hasattr(romObj, 'players'):
       plot_str += ' | Players = {:d}'.format(romObj.players)
-    if hasattr(romObj, 'control_type'):
-      plot_str += ' | Controls = ' + str(romObj.control_type)
     sub_element = ET.SubElement(root_output, 'plot')
     sub_element.text = plot_str
 
@@ -570,6 +732,7 @@ def generate_MAME_NFO_files(rom_copy_dic, mame_filtered_dic, destDir, __prog_opt
     NARS.indent_ElementTree_XML(root_output)
     tree_output.write(NFO_full_filename, xml_declaration=True, encoding='utf-8', method="xml")
     num_NFO_files += 1
+  NARS.fs_forget_dir_snapshot(destDir)
 
   NARS.print_info('Generated ' + str(num_NFO_files) + ' NFO files')
 
@@ -578,46 +741,36 @@ def generate_MAME_NFO_files(rom_copy_dic, mame_filtered_dic, destDir, __prog_opt
 # -----------------------------------------------------------------------------
 mainFilter_str_length = 25
 
-def filter_do_Default(mame_xml_dic):
+def filter_do_Default(index):
   # A) Remove devices. Devices are non-runnable always.
-  mame_filtered_dic = {}
-  filtered_out_games = 0
-  for key in mame_xml_dic:
-    romObject = mame_xml_dic[key]
-    if romObject.isDevice:
-      filtered_out_games += 1
+  devices_mask = index.bitset_dic['isDevice']
+  mask = index.all_mask & ~devices_mask
+  if NARS.log_level >= NARS.Log.vverb:
+    for key in index.names(devices_mask):
       NARS.print_vverb('FILTERED ' + key)
-      continue
-    mame_filtered_dic[key] = mame_xml_dic[key]
-    NARS.print_debug('Included ' + key)
   NARS.print_info('Removing devices'.ljust(mainFilter_str_length) + \
-                  'Removed  {:5d} | '.format(filtered_out_games) + \
-                  'Remaining  {:5d}'.format(len(mame_filtered_dic)))
+                  'Removed  {:5d} | '.format(NARS.bitset_count(devices_mask)) + \
+                  'Remaining  {:5d}'.format(NARS.bitset_count(mask)))
   
-  return mame_filtered_dic
+  return mask
 
-def filter_do_IncludeExclude(machines_dic, filterControl, fieldName, filterName):
-  machines_filtered_dic = {}
-  num_included_machines = 0
-  filtered_out_games = 0
-  for key in machines_dic:
-    machineObject = machines_dic[key]
-    booleanCondition = getattr(machineObject, fieldName)
-    if (filterControl and booleanCondition) or (not filterControl and not booleanCondition):
-      # Include Machine
-        machines_filtered_dic[key] = machines_dic[key]
-        num_included_machines += 1
-        NARS.print_debug('Included ' + key)
-      
-    else:
-      # Exclude machine
-        filtered_out_games += 1
-        NARS.print_vverb('Excluded ' + key)
+#
+# Include/Exclude a boolean attribute of the machines in mask. This is an AND
+# (Include) or AND NOT (Exclude) with the attribute bitset.
+# Returns the new mask.
+#
+def filter_do_IncludeExclude(index, mask, filterControl, fieldName, filterName):
+  if filterControl: filtered_mask = mask & index.bitset_dic[fieldName]
+  else:             filtered_mask = mask & ~index.bitset_dic[fieldName]
+  excluded_mask = mask & ~filtered_mask
+  if NARS.log_level >= NARS.Log.vverb:
+    for key in index.names(excluded_mask):
+      NARS.print_vverb('Excluded ' + key)
   NARS.print_info(filterName.ljust(mainFilter_str_length) + \
-                  'Removed  {:5d} | '.format(filtered_out_games) + \
-                  'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+                  'Removed  {:5d} | '.format(NARS.bitset_count(excluded_mask)) + \
+                  'Remaining  {:5d}'.format(NARS.bitset_count(filtered_mask)))
 
-  return machines_filtered_dic
+  return filtered_mask
 
 #
 # Main filter: <Include> and <Exclude> tags.
@@ -625,7 +778,7 @@ def filter_do_IncludeExclude(machines_dic, filterControl, fieldName, filterName)
 #               False  Do Exclude filter
 #
 __debug_filter_main_filter = 0
-def filter_main_filter(machines_dic, filter_config, filterControl):
+def filter_main_filter(index, mask, filter_config, filterControl):
     if filterControl:    filter_str_list = filter_config['Include']
     else:                filter_str_list = filter_config['Exclude']
 
@@ -633,368 +786,213 @@ def filter_main_filter(machines_dic, filter_config, filterControl):
         print('filter_config = [' + ', '.join(filter_str_list) + ']')
 
     # ~~~ Do nothing if user did not wrote tag or tag is empty ~~~
-    if not filter_str_list: return machines_dic
+    if not filter_str_list: return mask
 
     # ~~~ Traverse list ~~~
     for filter_str in filter_str_list:
         if filter_str == 'Parents':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'isParent', 'Parents')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'isParent', 'Parents')
         elif filter_str ==  'Clones':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'isClone', 'Clones')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'isClone', 'Clones')
         elif filter_str == 'Mechanical':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'isMechanical', 'Mechanical')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'isMechanical', 'Mechanical')
         elif filter_str ==  'BIOS':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'isBIOS', 'BIOS')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'isBIOS', 'BIOS')
         elif filter_str ==  'Samples':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'hasSamples', 'Samples')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'hasSamples', 'Samples')
         elif filter_str ==  'Working':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'isWorking', 'Working')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'isWorking', 'Working')
         elif filter_str ==  'ROMs':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'hasROMs', 'ROMs')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'hasROMs', 'ROMs')
         elif filter_str ==  'CHDs':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'hasCHDs', 'CHDs')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'hasCHDs', 'CHDs')
         elif filter_str ==  'CoinSlot':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'hasCoinSlot', 'CoinSlot')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'hasCoinSlot', 'CoinSlot')
         elif filter_str ==  'SoftwareLists':
-            machines_dic = filter_do_IncludeExclude(machines_dic, filterControl, 'hasSoftwareLists', 'SoftwareLists')
+            mask = filter_do_IncludeExclude(index, mask, filterControl, 'hasSoftwareLists', 'SoftwareLists')
         else:
-            if filter_config: print('[ERROR] Unrecognised <Include> keyword "{0}"'.format(filter_str))
+            if filterControl: print('[ERROR] Unrecognised <Include> keyword "{0}"'.format(filter_str))
             else:             print('[ERROR] Unrecognised <Exclude> keyword "{0}"'.format(filter_str))
             print('[ERROR] Must be: Parents, Clones, Mechanical, BIOS, Samples, Working, ROMs, CHDs, CoinSlot, SoftwareLists')
             sys.exit(10)
 
-    return machines_dic
+    return mask
+
+# Compiles a filter expression once. The returned expression is evaluated over
+# the inverted indexes of the MachineIndex.
+def compile_filter_expression(filter_name, filter_expression):
+    try:
+        return NARS.parse_compile(filter_expression)
+    except SyntaxError as ex:
+        NARS.print_error('[ERROR] <{0}> filter expression "{1}" is wrong: {2}'.format(filter_name, filter_expression, ex))
+        sys.exit(10)
 
-__debug_apply_MAME_filters_Driver_tag = 0
-def filter_do_Driver_tag(mame_xml_dic, filter_config):
+#
+# Evaluates filter_expression with set algebra over the inverted index of
+# column_name (and = intersection, or = union, not = complement). Machines are
+# not traversed, except to print them in verbose mode.
+# Returns the new mask.
+#
+def filter_do_expression_tag(index, mask, filter_expression, column_name, value_name):
+    NARS.print_info('Filter expression "' + filter_expression + '"')
+    filter_compiled = compile_filter_expression(column_name, filter_expression)
+    filtered_mask = mask & NARS.parse_eval_postings(filter_compiled, index.postings_dic[column_name], index.all_mask)
+    excluded_mask = mask & ~filtered_mask
+    if NARS.log_level >= NARS.Log.vverb:
+        for key in index.names(excluded_mask):
+            value_list = index.get_column_values(column_name, index.mame_dic[key])
+            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' ' + value_name + ' ' + ', '.join(map(str, value_list)))
+    if NARS.log_level >= NARS.Log.debug:
+        for key in index.names(filtered_mask):
+            value_list = index.get_column_values(column_name, index.mame_dic[key])
+            NARS.print_debug('Included ' + key.ljust(8) + ' ' + value_name + ' ' + ', '.join(map(str, value_list)))
+    NARS.print_info(' '.ljust(mainFilter_str_length) + \
+                    'Removed  {:5d} | '.format(NARS.bitset_count(excluded_mask)) + \
+                    'Remaining  {:5d}'.format(NARS.bitset_count(filtered_mask)))
+
+    return filtered_mask
+
+def filter_do_Driver_tag(index, mask, filter_config):
     NARS.print_info('<Driver filter>')
-  
+
     if not filter_config['Driver']:
         # NARS.print_info('User wants all drivers')
-        return mame_xml_dic
-    driver_filter_expression = filter_config['Driver']
-    filtered_out_games = 0
-    machines_filtered_dic = {}
-    NARS.print_info('Filter expression "' + driver_filter_expression + '"')
-    for key in sorted(mame_xml_dic):
-        romObject = mame_xml_dic[key]
-        driver_name_list = []
-        driver_str = trim_driver_string(romObject.sourcefile)
-        driver_name_list.append(driver_str)
-        # --- Update search variable and call parser to evaluate expression
-        NARS.set_parser_search_list(driver_name_list)
-        boolean_result = NARS.parse_exec(driver_filter_expression)
-        # --- Filter ROM or not
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' driver ' + ', '.join(driver_name_list))
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key.ljust(8) + ' driver ' + ', '.join(driver_name_list))
-        # --- DEBUG info ---
-        if __debug_apply_MAME_filters_Driver_tag:
-            print('[DEBUG] ----- Game = ' + key + ' -----')
-            print('[DEBUG] Driver name list = ', sorted(driver_name_list))
-            print('[DEBUG] Filter = "' + driver_filter_expression + '"')
-            print('[DEBUG] boolean_result = ' + str(boolean_result))
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_expression_tag(index, mask, filter_config['Driver'], 'Driver', 'driver')
 
-__debug_apply_MAME_filters_Category_tag = 0
-def filter_do_Categories_tag(mame_xml_dic, filter_config):
+def filter_do_Categories_tag(index, mask, filter_config):
     NARS.print_info('<Categories filter>')
 
     if not filter_config['Categories']:
         # NARS.print_info('User wants all categories')
-        return mame_xml_dic
-      
-    categories_filter_expression = filter_config['Categories']
-    machines_filtered_dic = {}
-    filtered_out_games = 0
-    NARS.print_info('Filter expression "' + categories_filter_expression + '"')
-    for key in sorted(mame_xml_dic):
-        romObject = mame_xml_dic[key]
-        categories_type_list = []
-        categories_type_list.append(romObject.category)
-        # --- Update search variable and call parser to evaluate expression
-        NARS.set_parser_search_list(categories_type_list)
-        boolean_result = NARS.parse_exec(categories_filter_expression)
-        # --- Filter ROM or not
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' category ' + ', '.join(categories_type_list))
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key.ljust(8) + ' category ' + ', '.join(categories_type_list))
-        # --- DEBUG info
-        if __debug_apply_MAME_filters_Category_tag:
-            print('[DEBUG] Category list = ', sorted(categories_type_list))
-            print('[DEBUG] Filter = "' + categories_filter_expression + '"')
-            print('[DEBUG] boolean_result = ' + str(boolean_result))
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_expression_tag(index, mask, filter_config['Categories'], 'Categories', 'category')
 
-__debug_apply_MAME_filters_displayType = 0
-def filter_do_displayType_tag(mame_xml_dic, filter_config):
+def filter_do_displayType_tag(index, mask, filter_config):
     NARS.print_info('<Display type filter>')
 
     if not filter_config['DisplayType']:
-        # NARS.print_info('User wants all categories')
-        return mame_xml_dic
-    displayType_filter_expression = filter_config['DisplayType']
-    machines_filtered_dic = {}
-    filtered_out_games = 0
-    NARS.print_info('Filter expression "' + displayType_filter_expression + '"')
-    for key in sorted(mame_xml_dic):
-        romObject = mame_xml_dic[key]
-        displayType_list = [romObject.displayType]
-        NARS.set_parser_search_list(displayType_list)
-        boolean_result = NARS.parse_exec(displayType_filter_expression)
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' display type ' + ', '.join(displayType_list))
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key.ljust(8) + ' display type ' + ', '.join(displayType_list))
-        if __debug_apply_MAME_filters_displayType:
-            print('[DEBUG] Machine {0}'.format(romObject.name))
-            print('[DEBUG] DisplayType list = ', sorted(displayType_list))
-            print('[DEBUG] Filter = "' + displayType_filter_expression + '"')
-            print('[DEBUG] boolean_result = ' + str(boolean_result))
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+        # NARS.print_info('User wants all display types')
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_expression_tag(index, mask, filter_config['DisplayType'], 'DisplayType', 'display type')
 
-__debug_apply_MAME_filters_Orientation_tag = 0
-def filter_do_Orientation_tag(mame_xml_dic, filter_config):
+def filter_do_Orientation_tag(index, mask, filter_config):
     NARS.print_info('<Orientation filter>')
 
     if not filter_config['DisplayOrientation']:
         # NARS.print_info('User wants all display orientations')
-        return mame_xml_dic
-    orientation_filter_expression = filter_config['DisplayOrientation']
-    machines_filtered_dic = {}
-    filtered_out_games = 0
-    NARS.print_info('Filter expression "' + orientation_filter_expression + '"')
-    for key in sorted(mame_xml_dic):
-        romObject = mame_xml_dic[key]
-        orientation_type_list = []
-        orientation_type_list.append(romObject.orientation)
-        # --- Update search variable and call parser to evaluate expression ---
-        NARS.set_parser_search_list(orientation_type_list)
-        boolean_result = NARS.parse_exec(orientation_filter_expression)
-        # --- Filter ROM or not ---
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' orientation ' + ', '.join(orientation_type_list))
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key.ljust(8) + ' orientation ' + ', '.join(orientation_type_list))
-        # --- DEBUG info ---
-        if __debug_apply_MAME_filters_Orientation_tag:
-            print('[DEBUG] Machine {0}'.format(romObject.name))
-            print('[DEBUG] Orientation list = ', sorted(orientation_type_list))
-            print('[DEBUG] Filter = "' + orientation_filter_expression + '"')
-            print('[DEBUG] boolean_result = ' + str(boolean_result))
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_expression_tag(index, mask, filter_config['DisplayOrientation'], 'DisplayOrientation', 'orientation')
 
-__debug_apply_MAME_filters_Controls_tag = 0
-def filter_do_Controls_tag(mame_xml_dic, filter_config):
+def filter_do_Controls_tag(index, mask, filter_config):
     NARS.print_info('<Controls filter>')
 
     if not filter_config['Controls']:
         # NARS.print_info('User wants all controls')
-        return mame_xml_dic
-    controls_type_filter_expression = filter_config['Controls']
-    filtered_out_games = 0
-    machines_filtered_dic = {}
-    NARS.print_info('Filter expression "' + controls_type_filter_expression + '"')
-    for key in sorted(mame_xml_dic):
-        # --- Some games may have two controls, so controls_type_list is a list
-        romObject = mame_xml_dic[key]
-        controls_type_list = romObject.control_type
-        # --- Update search variable and call parser to evaluate expression
-        NARS.set_parser_search_list(controls_type_list)
-        boolean_result = NARS.parse_exec(controls_type_filter_expression)
-        # --- Filter ROM or not
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' controls ' + ', '.join(controls_type_list))
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key.ljust(8) + ' controls ' + ', '.join(controls_type_list))
-        # --- DEBUG info ---
-        if __debug_apply_MAME_filters_Controls_tag:
-            print('[DEBUG] ----- Game = ' + key + ' -----')
-            print('[DEBUG] Control list = ', sorted(controls_type_list))
-            print('[DEBUG] Filter = "' + controls_type_filter_expression + '"')
-            print('[DEBUG] boolean_result = ' + str(boolean_result))
+        return mask
+
+    return filter_do_expression_tag(index, mask, filter_config['Controls'], 'Controls', 'controls')
+
+def compile_numeric_filter_expression(filter_name, filter_expression, variable_name):
+    try:
+        filter_compiled = NARS.parse_numeric_compile(filter_expression, variable_name)
+    except SyntaxError as ex:
+        NARS.print_error('[ERROR] <{0}> filter expression "{1}" is wrong: {2}'.format(filter_name, filter_expression, ex))
+        sys.exit(10)
+    NARS.print_verb('Filter intervals ' + str(filter_compiled))
+
+    return filter_compiled
+
+#
+# Evaluates the numeric filter_expression over variable_name (for example,
+# "buttons >= 2 and buttons <= 6"). The expression is compiled into a set of
+# integer intervals and tested once per distinct value of the column, not once
+# per machine.
+# Returns the new mask.
+#
+def filter_do_numeric_tag(index, mask, filter_expression, column_name, variable_name):
+    NARS.print_info('Filter expression "' + filter_expression + '"')
+    filter_compiled = compile_numeric_filter_expression(column_name, filter_expression, variable_name)
+    filtered_mask = mask & filter_compiled.eval_postings(index.numeric_postings_dic[column_name])
+    excluded_mask = mask & ~filtered_mask
+    if NARS.log_level >= NARS.Log.vverb:
+        for key in index.names(excluded_mask):
+            value = index.get_numeric_value(column_name, index.mame_dic[key])
+            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' ' + variable_name + ' ' + str(value))
+    if NARS.log_level >= NARS.Log.debug:
+        for key in index.names(filtered_mask):
+            value = index.get_numeric_value(column_name, index.mame_dic[key])
+            NARS.print_debug('Included ' + key.ljust(8) + ' ' + variable_name + ' ' + str(value))
     NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+                    'Removed  {:5d} | '.format(NARS.bitset_count(excluded_mask)) + \
+                    'Remaining  {:5d}'.format(NARS.bitset_count(filtered_mask)))
 
-    return machines_filtered_dic
+    return filtered_mask
 
-__debug_apply_MAME_filters_Buttons_tag = 0
-def filter_do_Buttons_tag(mame_xml_dic, filter_config):
+def filter_do_Buttons_tag(index, mask, filter_config):
     NARS.print_info('<Buttons filter>')
 
     if not filter_config['Buttons']:
         # NARS.print_info('User wants all buttons')
-        return mame_xml_dic
-    button_filter_expression = filter_config['Buttons']
-    machines_filtered_dic = {}
-    filtered_out_games = 0
-    NARS.print_info('Filter expression "' + button_filter_expression + '"')
-    for key in mame_xml_dic:
-        romObject = mame_xml_dic[key]
-        buttons_str = romObject.buttons
-        buttons = int(buttons_str)
-        if __debug_apply_MAME_filters_Buttons_tag:
-            print('[DEBUG] Buttons number = ' + buttons_str)
-            print('[DEBUG] Buttons filter = "' + button_filter_expression + '"')
-        boolean_result = eval(button_filter_expression, globals(), locals())
-
-        # If not all items are true, the game is NOT copied (filtered)
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key + ' buttons ' + buttons_str)
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key + ' buttons ' + buttons_str)
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_numeric_tag(index, mask, filter_config['Buttons'], 'Buttons', 'buttons')
 
-__debug_apply_MAME_filters_Players_tag = 0
-def filter_do_Players_tag(mame_xml_dic, filter_config):
+def filter_do_Players_tag(index, mask, filter_config):
     NARS.print_info('<Players filter>')
 
     if not filter_config['Players']:
         # NARS.print_info('User wants all players')
-        return mame_xml_dic
-    players_filter_expression = filter_config['Players']
-    machines_filtered_dic = {}
-    filtered_out_games = 0
-    NARS.print_info('Filter expression "' + players_filter_expression + '"')
-    for key in mame_xml_dic:
-        romObject = mame_xml_dic[key]
-        players_str = romObject.players
-        players = int(players_str)
-        if __debug_apply_MAME_filters_Players_tag:
-            print('[DEBUG] Players number = ' + players_str)
-            print('[DEBUG] Players filter = "' + players_filter_expression + '"')
-        boolean_result = eval(players_filter_expression, globals(), locals())
-
-        # If not all items are true, the game is NOT copied (filtered)
-        if not boolean_result:
-            filtered_out_games += 1
-            NARS.print_vverb('FILTERED ' + key + ' players ' + players_str)
-        else:
-            machines_filtered_dic[key] = mame_xml_dic[key]
-            NARS.print_debug('Included ' + key + ' players ' + players_str)
-    NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(mame_filtered_dic)))
+        return mask
 
-    return machines_filtered_dic
+    return filter_do_numeric_tag(index, mask, filter_config['Players'], 'Players', 'players')
 
-__debug_apply_MAME_filters_years_tag = 0
-def filter_do_Years_tag(mame_xml_dic, filter_config):
+#
+# Year filter. Machine years are intervals (see parse_year_string()):
+#  a) Machines with a single year (1997, 1997?) are included if the year
+#     satisfies the filter expression.
+#  b) Machines with a wildcard year (198?, 19??, ????) are excluded, unless
+#     option YearExpansion is set. In that case they are included if any year
+#     of the interval satisfies the filter expression.
+# The expression is tested once per distinct interval, not once per machine
+# and expanded year.
+#
+def filter_do_Years_tag(index, mask, filter_config):
     NARS.print_info('<Year filter>')
-    
-    return mame_xml_dic
-    
-    year_YearExpansion = filter_config['Players']
+
+    if not filter_config['Years']:
+        # NARS.print_info('User wants all years')
+        return mask
+
+    year_YearExpansion = 'YearExpansion' in filter_config['Options']
     if year_YearExpansion: NARS.print_info('Year expansion activated')
     else:                  NARS.print_info('Year expansion deactivated')
-
-    if filter_config['Years'] is not None:
-        NARS.print_info('User wants all years')
-        return mame_xml_dic
-    machines_filtered_dic = {}
-    filtered_out_games = 0
     year_filter_expression = filter_config['Years']
-    NARS.print_info('Filter expression "' + year_filter_expression + '"')    
-    for key in sorted(mame_xml_dic):
-        romObject = mame_xml_dic[key]
-        # year is a string, convert to int
-        year_srt = romObject.year
-        # Game year information:
-        #  1 standard game or game with not-verified year (example 1998?)
-        #  2 game that needs decade expansion (examples 198?, 199?) or
-        #    full expansion (examples 19??, ????)
-        game_info = get_game_year_information(year_srt)
-
-        # Game is standard (no ? or strange characters): do filtering
-        if game_info == 1:
-            # Convert number string to int (supports games like 1997?)
-            year_list = trim_year_string(year_srt)
-            if len(year_list) != 1:
-                NARS.print_error('Logical error filtering year (standard year)')
-                sys.exit(10)
-            year = int(year_list[0])
-            if __debug_apply_MAME_filters_years_tag:
-                print('[DEBUG] Game ' + key.ljust(8) + ' / Year value = ' + str(year) +
-                      ' / Filter = "' + year_filter_expression + '"')
-            boolean_result = eval(year_filter_expression, globals(), locals())
-            # If not all items are true, the game is NOT copied (filtered)
-            if not boolean_result:
-                filtered_out_games += 1
-                NARS.print_vverb('FILTERED ' + key.ljust(8) + ' year ' + str(year))
-            else:
-                machines_filtered_dic[key] = mame_xml_dic[key]
-                NARS.print_debug('Included ' + key.ljust(8) + ' year ' + str(year))
-
-        # Game needs expansion. If user activated this option expand wildcars and
-        # then do filtering. If option not activated, discard game
-        elif game_info == 2:
-            if year_YearExpansion:
-                year_list = trim_year_string(year_srt)
-                if len(year_list) < 2:
-                    print('Logical error filtering year (expanded year)')
-                    sys.exit(10)
-                boolean_list = []
-                for year_str in year_list:
-                    year = int(year_str)
-                    if __debug_apply_MAME_filters_years_tag:
-                        print('[DEBUG] Game ' + key.ljust(8) + ' / Year value = ' + str(year) +
-                                ' / Filter = "' + year_filter_expression + '"')
-                    boolean_result = eval(year_filter_expression, globals(), locals())
-                    boolean_list.append(boolean_result)
-                # Knowing the boolean results for the wildcard expansion, check if game
-                # should be included or not.
-                if any(boolean_list):
-                    machines_filtered_dic[key] = mame_xml_dic[key]
-                    NARS.print_debug('Included ' + key.ljust(8) + ' year ' + str(year))
-                else:
-                    filtered_out_games += 1
-                    NARS.print_vverb('FILTERED ' + key.ljust(8) + ' year ' + str(year))
-            else:
-                filtered_out_games += 1
-                NARS.print_vverb('FILTERED ' + key.ljust(8) + ' year ' + str(year))
-        else:
-            NARS.print_error('Wrong result returned by get_game_year_information() = ' + str(game_info))
-            sys.exit(10)
+    NARS.print_info('Filter expression "' + year_filter_expression + '"')
+    filter_compiled = compile_numeric_filter_expression('Years', year_filter_expression, 'year')
+    years_mask = 0
+    for (low, high, verified), year_bitset in index.year_postings.items():
+        if low == high:
+            if filter_compiled.contains(low): years_mask |= year_bitset
+        elif year_YearExpansion:
+            if filter_compiled.overlaps(low, high): years_mask |= year_bitset
+    filtered_mask = mask & years_mask
+    excluded_mask = mask & ~filtered_mask
+    if NARS.log_level >= NARS.Log.vverb:
+        for key in index.names(excluded_mask):
+            NARS.print_vverb('FILTERED ' + key.ljust(8) + ' year ' + str(index.mame_dic[key].year))
+    if NARS.log_level >= NARS.Log.debug:
+        for key in index.names(filtered_mask):
+            NARS.print_debug('Included ' + key.ljust(8) + ' year ' + str(index.mame_dic[key].year))
     NARS.print_info(' '.ljust(mainFilter_str_length) + \
-                    'Removed  {:5d} | '.format(filtered_out_games) + \
-                    'Remaining  {:5d}'.format(len(machines_filtered_dic)))
+                    'Removed  {:5d} | '.format(NARS.bitset_count(excluded_mask)) + \
+                    'Remaining  {:5d}'.format(NARS.bitset_count(filtered_mask)))
 
-    return machines_filtered_dic
+    return filtered_mask
 
 def filter_do_substitute_machines(mame_xml_dic):
   
@@ -1055,22 +1053,26 @@ def filter_MAME_machines(mame_dic, filter_config):
   NARS.print_info('NOTE: -vv if you want to see filters in action')
   
   # ~~~~~ Main filter: Include and Exclude ~~~~~~
+  # All filters work on bitsets. Filtered dictionary is created once, after
+  # them.
+  index = get_machine_index(mame_dic)
   NARS.print_info('<Default filter>')
-  mame_filtered_dic = filter_do_Default(mame_dic)
+  mask = filter_do_Default(index)
   NARS.print_info('<Include filter>')
-  mame_filtered_dic = filter_main_filter(mame_filtered_dic, filter_config, 1)
+  mask = filter_main_filter(index, mask, filter_config, 1)
   NARS.print_info('<Exclude filter>')
-  mame_filtered_dic = filter_main_filter(mame_filtered_dic, filter_config, 0)
+  mask = filter_main_filter(index, mask, filter_config, 0)
 
   # ~~~~~ Secondary filters ~~~~~~  
-  mame_filtered_dic = filter_do_Driver_tag     (mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Categories_tag (mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_displayType_tag(mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Orientation_tag(mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Controls_tag   (mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Buttons_tag    (mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Players_tag    (mame_filtered_dic, filter_config)
-  mame_filtered_dic = filter_do_Years_tag      (mame_filtered_dic, filter_config)
+  mask = filter_do_Driver_tag     (index, mask, filter_config)
+  mask = filter_do_Categories_tag (index, mask, filter_config)
+  mask = filter_do_displayType_tag(index, mask, filter_config)
+  mask = filter_do_Orientation_tag(index, mask, filter_config)
+  mask = filter_do_Controls_tag   (index, mask, filter_config)
+  mask = filter_do_Buttons_tag    (index, mask, filter_config)
+  mask = filter_do_Players_tag    (index, mask, filter_config)
+  mask = filter_do_Years_tag      (index, mask, filter_config)
+  mame_filtered_dic = index.materialize(mask)
 
   # ~~~~~ Global ROM substitution ~~~~~
   
@@ -1133,11 +1135,30 @@ def parse_catver_ini(catver_filename):
 # Used in the filtering functions (do_checkFilter, do_update(), do_checkArtwork(),
 # do_update_artwork()), but not in the do_list_*() functions.
 #
+# The machine dictionary is cached in a binary file next to the merged XML. The
+# merged XML is only parsed if the cache does not exist or is outdated.
+#
 # Returns dictionary machine_dict with key the Machine name and value a Machine object.
 #
 def parse_MAME_merged_XML():
   NARS.print_info('[Parsing MAME merged XML]')
   filename = configuration.options['Merged_XML']
+  if not os.path.isfile(filename):
+    NARS.print_error('\033[31m[ERROR]\033[0m File \'{0}\' not found'.format(filename))
+    sys.exit(10)
+  cache_filename = filename + '.cache'
+  machine_dict = NARS.cache_load(cache_filename, filename, MACHINE_CACHE_VERSION)
+  if machine_dict is None:
+    machine_dict = parse_MAME_merged_XML_file(filename)
+    NARS.print_info('Writing cache file \'{0}\''.format(cache_filename))
+    NARS.cache_save(cache_filename, filename, MACHINE_CACHE_VERSION, machine_dict)
+  else:
+    NARS.print_info('Number of machines  ' + str(len(machine_dict)))
+  get_machine_index(machine_dict)
+
+  return machine_dict
+
+def parse_MAME_merged_XML_file(filename):
   tree = NARS.XML_read_file_cElementTree(filename, "Parsing merged XML file")
 
   # --- Raw list: literal information from the XML
@@ -1165,7 +1186,7 @@ def parse_MAME_merged_XML():
       num_clones += 1
       machineObj.isClone = True
       machineObj.isParent = False
-      machineObj.cloneof = game_attrib['cloneof']
+      machineObj.cloneof = intern_str(game_attrib['cloneof'])
       NARS.print_debug(' Clone of = ' + game_attrib['cloneof'])
     else:
       num_parents += 1
@@ -1187,13 +1208,13 @@ def parse_MAME_merged_XML():
 
     # --- Samples (isSamples defaults False) ---
     if 'sampleof' in game_attrib:
-      machineObj.sampleof = game_attrib['sampleof']
+      machineObj.sampleof = intern_str(game_attrib['sampleof'])
       machineObj.hasSamples = True
 
     # --- Game driver ---
     if 'sourcefile' in game_attrib:
       # Remove the trailing '.c' or '.cpp' from driver name
-      machineObj.sourcefile = trim_driver_string(game_attrib['sourcefile'])
+      machineObj.sourcefile = intern_str(trim_driver_string(game_attrib['sourcefile']))
 
     # ~~~~~ Parse machine child tags ~~~~~
     for child_game in game_EL:
@@ -1201,9 +1222,9 @@ def parse_MAME_merged_XML():
       if child_game.tag == 'description':
         machineObj.description = child_game.text
       elif child_game.tag == 'year':
-        machineObj.year = child_game.text
+        machineObj.year = intern_str(child_game.text)
       elif child_game.tag == 'manufacturer':
-        machineObj.manufacturer = child_game.text    
+        machineObj.manufacturer = intern_str(child_game.text)
 
       # --- Driver status ---
       elif child_game.tag == 'driver':
@@ -1214,7 +1235,7 @@ def parse_MAME_merged_XML():
         # imperfect games are emulated with some minor issues
         # good games are perfectly emulated
         if 'status' in driver_attrib:
-          machineObj.driver_status = driver_attrib['status']
+          machineObj.driver_status = intern_str(driver_attrib['status'])
           NARS.print_debug(' Driver status = ' + machineObj.driver_status)
           if machineObj.driver_status == 'good' or machineObj.driver_status == 'imperfect':
             machineObj.isWorking = True
@@ -1228,7 +1249,7 @@ def parse_MAME_merged_XML():
 
       # --- Category ---
       elif child_game.tag == 'category':
-        machineObj.category = child_game.text
+        machineObj.category = intern_str(child_game.text)
 
       # --- Controls ---
       elif child_game.tag == 'input':
@@ -1248,12 +1269,14 @@ def parse_MAME_merged_XML():
             machineObj.hasCoinSlot = True
 
         # A game may have more than one control (joystick, dial, ...)
+        control_type_list = []
         for control in child_game:
           if control.tag == 'control':
             if 'type' in control.attrib:
-              machineObj.control_type_list.append(control.attrib['type'].title())
-        if len(machineObj.control_type_list) < 1:
-          machineObj.control_type_list.append('ButtonsOnly')
+              control_type_list.append(sys.intern(control.attrib['type'].title()))
+        if len(control_type_list) < 1:
+          control_type_list.append(sys.intern('ButtonsOnly'))
+        machineObj.control_type_list = tuple(control_type_list)
 
       # --- <NARS> custom tag (attributes and sub-tags) ---
       elif child_game.tag == 'NARS':
@@ -1281,25 +1304,31 @@ def parse_MAME_merged_XML():
           sys.exit(10)
 
         if 'displayType' in nars_attrib:
-          machineObj.displayType = nars_attrib['displayType']
+          machineObj.displayType = intern_str(nars_attrib['displayType'])
         else:
           print('[ERROR] Not found <NARS displayType=... > (Machine {0})\n'.format(machineObj.name))
           sys.exit(10)
 
         if 'orientation' in nars_attrib:
-          machineObj.orientation = nars_attrib['orientation']
+          machineObj.orientation = intern_str(nars_attrib['orientation'])
         else:
           print('[ERROR] Not found <NARS orientation=... > (Machine {0})\n'.format(machineObj.name))
           sys.exit(10)
 
         # --- <NARS> tags ---
+        BIOS_depends_list = []
+        device_depends_list = []
+        CHD_depends_list = []
         for NARS_tag in child_game:
           if NARS_tag.tag == 'BIOS':
-            machineObj.BIOS_depends_list.append(NARS_tag.text)
+            BIOS_depends_list.append(sys.intern(NARS_tag.text))
           elif NARS_tag.tag == 'Device':
-            machineObj.device_depends_list.append(NARS_tag.text)
+            device_depends_list.append(sys.intern(NARS_tag.text))
           elif NARS_tag.tag == 'CHD':
-            machineObj.CHD_depends_list.append(NARS_tag.text)
+            CHD_depends_list.append(sys.intern(NARS_tag.text))
+        machineObj.BIOS_depends_list = tuple(BIOS_depends_list)
+        machineObj.device_depends_list = tuple(device_depends_list)
+        machineObj.CHD_depends_list = tuple(CHD_depends_list)
 
     # --- Add new game to the list ---
     machine_dict[game_attrib['name']] = machineObj
@@ -1559,46 +1588,141 @@ def parse_MAME_merged_XML():
 #  <CHD>chd2</CHD>
 # </NARS>
 __debug_do_reduce_XML_dependencies = 0
+
+#
+# Copies the <machine> children we want to keep into a new, reduced, element.
+# Only the information used by the filters and the NFO files is kept.
+#
+def reduce_MAME_machine_EL(machine_EL):
+  machine_name = machine_EL.attrib['name']
+  machine_output = ET.Element('machine', machine_EL.attrib)
+  for machine_child in machine_EL:
+    if machine_child.tag == 'description':
+      NARS.print_verb(' description = ' + machine_child.text)
+      description_output = ET.SubElement(machine_output, 'description')
+      description_output.text = machine_child.text
+
+    elif machine_child.tag == 'year':
+      NARS.print_verb(' year = ' + machine_child.text)
+      year_output = ET.SubElement(machine_output, 'year')
+      year_output.text = machine_child.text
+
+    elif machine_child.tag == 'manufacturer':
+      NARS.print_verb(' manufacturer = ' + machine_child.text)
+      manufacturer_output = ET.SubElement(machine_output, 'manufacturer')
+      manufacturer_output.text = machine_child.text
+
+    elif machine_child.tag == 'input':
+      input_output = ET.SubElement(machine_output, 'input', machine_child.attrib)
+      # Traverse <input> children and copy <control> tags
+      for input_child in machine_child:
+        if input_child.tag == 'control':
+          ET.SubElement(input_output, 'control', input_child.attrib)
+
+    # From tag <driver> only copy attribute status, discard the rest to save
+    # space in output XML.
+    elif machine_child.tag == 'driver':
+      if 'status' in machine_child.attrib:
+        driver_output = ET.SubElement(machine_output, 'driver')
+        driver_output.attrib['status'] = machine_child.attrib['status']
+      else:
+        print('Machine "{0}" <driver> has no "status" attribute\n'.format(machine_name))
+        sys.exit(10)
+
+  return machine_output
+
+#
+# Creates the <NARS> tag of a machine in the reduced XML. Dependency lists may
+# have repeated elements. Repeated elements are written only once, keeping the
+# order in which they were found so the output XML is always the same.
+#
+def make_NARS_element(machine_output, hasROMs, hasCHDs, hasSoftwareLists, displayType, orientation,
+                      BIOS_list, device_list, CHD_list):
+  machine_name = machine_output.attrib['name']
+  NARS_element = ET.SubElement(machine_output, 'NARS')
+
+  # <NARS hasROMs="yes|no" hasSoftwareLists="yes|no" displayType="Raster|Vector|LCD|Unknown" 
+  #       orientation="Horizontal|Vertical">
+  NARS_element.attrib['hasROMs']          = 'yes' if hasROMs else 'no'
+  NARS_element.attrib['hasCHDs']          = 'yes' if hasCHDs else 'no'
+  NARS_element.attrib['hasSoftwareLists'] = 'yes' if hasSoftwareLists else 'no'
+  NARS_element.attrib['displayType']      = displayType
+  NARS_element.attrib['orientation']      = orientation
+
+  # <NARS> tags: <BIOS>, <Device>, <CHD>
+  if len(BIOS_list) > 1:
+    print('[ERROR] Machine ' + '{:>12}'.format(machine_name) + ' depends on more than 1 BIOS')
+    sys.exit(10)
+  for bios_name in BIOS_list:
+    bios_depends_tag = ET.SubElement(NARS_element, 'BIOS')
+    bios_depends_tag.text = bios_name
+
+  device_unique_list = []
+  for device_name in device_list:
+    if device_name not in device_unique_list: device_unique_list.append(device_name)
+  for device_unique_name in device_unique_list:
+    device_depends_tag = ET.SubElement(NARS_element, 'Device')
+    device_depends_tag.text = device_unique_name
+
+  CHD_unique_list = []
+  for CHD_name in CHD_list:
+    if CHD_name not in CHD_unique_list: CHD_unique_list.append(CHD_name)
+  if len(CHD_unique_list) != len(CHD_list):
+    print('[WARNING] machine ' + '{:>12}'.format(machine_name) +
+          ' len(CHD_set) != len(CHD_list)')
+  for CHD_unique_name in CHD_unique_list:
+    CHD_depends_tag = ET.SubElement(NARS_element, 'CHD')
+    CHD_depends_tag.text = CHD_unique_name
+
+  return NARS_element
+
+#
+# The MAME XML is streamed with iterparse() and every <machine> element is
+# discarded as soon as it has been processed. The whole MAME XML is never loaded
+# in memory. Memory consumption is bounded by one machine plus the (small)
+# dependency tables. The reduced XML is also written one machine at a time.
+#
+# The big MAME XML is traversed only once:
+# 1) Single scan) Check machine attributes, record the raw romof/cloneof,
+#                 device_ref and disk facts of every machine in compact tables
+#                 and write the reduced machines (without <NARS> tag) to a
+#                 temporal file.
+# 2) Resolve the BIOS/device/CHD dependencies using the tables only.
+# 3) Read the (small) temporal file, attach the <NARS> tags and write the
+#    reduced XML.
+#
 def do_reduce_XML():
   """Strip out unused MAME XML information, and add ROM/CHD dependencies"""
 
   NARS.print_info('[Reducing MAME XML machine database]')
   input_filename  = configuration.options['MAME_XML']
   output_filename = configuration.options['MAME_XML_redux']
+  temp_filename   = output_filename + '.tmp'
 
-  # --- Build XML output file ---
-  tree_output = ET.ElementTree()
-  root_output = ET.Element('mame')
-  tree_output._setroot(root_output)
-
-  # --- Read MAME XML input file ---
-  NARS.print_info('Reading MAME XML game database...')
-  NARS.print_info('NOTE: this will take a looong time...')
-  tree_input = NARS.XML_read_file_ElementTree(input_filename, "Parsing MAME XML file")
-
-  # Several lists of machines.
-  # Checking if a list has an element is SLOW. This lists will be transformed
-  # into sets for quicker access. List can have repeated elements, sets have unique 
-  # elements. Sets and dictionaries use hashing, list do not use hashing.
+  # Several sets of machines. Sets and dictionaries use hashing so checking
+  # membership is fast, lists do not use hashing.
   # See http://stackoverflow.com/questions/513882/python-list-vs-dict-for-look-up-table
-  machine_isBIOS_list = []            # machines that are BIOS
-  machine_isDevice_with_ROM_list = [] # machines that are devices and have ROMs
-  machine_with_CHD_list = []          # machines that have CHDs
-  machine_with_ROM_list = []          # machines that have ROMs
-  machine_with_SoftList_list = []     # machines that have one or more software lists
-  machine_displayType_dic = {}        # key = machine_name : value = "Raster|Vector|LCD|Unknown"
-  machine_orientation_dic = {}        # key = machine_name : value = "Vertical|Horizontal"
+  machine_isBIOS_set = set()            # machines that are BIOS
+  machine_isDevice_with_ROM_set = set() # machines that are devices and have ROMs
+  machine_with_CHD_set = set()          # machines that have CHDs
+  machine_with_ROM_set = set()          # machines that have ROMs
+  machine_with_SoftList_set = set()     # machines that have one or more software lists
+  machine_displayType_dic = {}          # key = machine_name : value = "Raster|Vector|LCD|Unknown"
+  machine_orientation_dic = {}          # key = machine_name : value = "Vertical|Horizontal"
+
+  # Raw dependency facts. Only machines that have the fact are in the dictionary.
+  machine_romof_dic = {}                # key = machine_name : value = romof attribute
+  machine_cloneof_dic = {}              # key = machine_name : value = cloneof attribute
+  machine_device_ref_dic = {}           # key = machine_name : value = tuple of <device_ref> names
+  machine_disk_dic = {}                 # key = machine_name : value = tuple of <disk> names with sha1
 
   # NOTE All the MAME XML checks must be done here, and not when the reduced XML is loaded.
   #      Loading the reduced XML must be as quick as possible.
 
-
   # --- Traverse MAME XML input file ---
   # Root element:
   # <mame build="0.153 (Apr  7 2014)" debug="no" mameconfig="10">
-  root_input = tree_input.getroot()
-  root_output.attrib = root_input.attrib  # Copy mame attributes in output XML
-
+  #
   # Child elements we want to keep in the reduced XML:
   # NOTE since the mergue of MAME and MESS, <game> has been substituded by
   #      <machine>
@@ -1618,339 +1742,185 @@ def do_reduce_XML():
   # ...
   #   <driver status="imperfect" .../>
   # </machine>
-  NARS.print_info('[Reducing MAME XML database]')
-  for machine_EL in root_input:
+  NARS.print_info('[Reducing MAME XML machines and recording dependencies]')
+  mame_attrib = {}
+  temp_XML = None
+  for machine_EL in NARS.XML_iterparse_file(input_filename, "Parsing MAME XML file", mame_attrib):
+    if machine_EL.tag != 'machine':
+      print('Found a no <machine> tag ' + machine_EL.tag)
+      sys.exit(10)
+    # Root attributes are known only after the first child has been started
+    if temp_XML is None:
+      temp_XML = NARS.XML_Stream_Writer(temp_filename, 'mame', mame_attrib)
     flag_isDevice = 0
     flag_isRunnable = 1
-    if machine_EL.tag == 'machine':
-      NARS.print_verb('[Machine]')
-      machine_name = machine_EL.attrib['name']
-
-      # Copy all machine attributes in output XML
-      machine_output = ET.SubElement(root_output, 'machine')
-      machine_output.attrib = machine_EL.attrib
-      machine_attrib = machine_output.attrib
-
-      # Put BIOSes and devices in the list
-      if 'isbios' in machine_attrib and machine_attrib['isbios'] == 'yes':
-        machine_isBIOS_list.append(machine_name)
-      if 'isdevice' in machine_attrib and machine_attrib['isdevice'] == 'yes':
-        flag_isDevice = 1
-      if 'runnable' in machine_attrib and machine_attrib['runnable'] == 'no':
-        flag_isRunnable = 0
-
-      # --- Attribute consistence test ---
-      # Test A) Are all devices non runnable?
-      if flag_isDevice == 1 and flag_isRunnable == 1:
-        NARS.print_error('[ERROR] Found a machine which is device and runnable (machine = {0})'.format(machine_name))
-        sys.exit(10)
-      if 'isdevice' in machine_attrib and 'runnable' not in machine_attrib:
-        NARS.print_error('[ERROR] isdevice attribute but NOT runnable attribute (machine = {0})'.format(machine_name))
-        sys.exit(10)
-      if 'isdevice' not in machine_attrib and 'runnable' in machine_attrib:
-        NARS.print_error('[ERROR] NOT isdevice attribute but runnable attribute (machine = {0})'.format(machine_name))
-        sys.exit(10)
-
-      # --- Iterate through machine tag attributes (DEBUG) ---
-      # for key in machine_EL.attrib:
-      #   print ' machine --', key, '->', machine_EL.attrib[key];
-
-      # --- Iterate through the children tags of a machine, and copy the ones we want to
-      #     keep into the output XML.
-      for machine_child in machine_EL:
-        if machine_child.tag == 'description':
-          NARS.print_verb(' description = ' + machine_child.text)
-          description_output = ET.SubElement(machine_output, 'description')
-          description_output.text = machine_child.text
-
-        if machine_child.tag == 'year':
-          NARS.print_verb(' year = ' + machine_child.text)
-          year_output = ET.SubElement(machine_output, 'year')
-          year_output.text = machine_child.text
-
-        if machine_child.tag == 'manufacturer':
-          NARS.print_verb(' manufacturer = ' + machine_child.text)
-          manufacturer_output = ET.SubElement(machine_output, 'manufacturer')
-          manufacturer_output.text = machine_child.text
+    NARS.print_verb('[Machine]')
+    machine_attrib = machine_EL.attrib
+    machine_name = machine_attrib['name']
+
+    # Put BIOSes and devices in the list
+    if 'isbios' in machine_attrib and machine_attrib['isbios'] == 'yes':
+      machine_isBIOS_set.add(machine_name)
+    if 'isdevice' in machine_attrib and machine_attrib['isdevice'] == 'yes':
+      flag_isDevice = 1
+    if 'runnable' in machine_attrib and machine_attrib['runnable'] == 'no':
+      flag_isRunnable = 0
+
+    # --- Attribute consistence test ---
+    # Test A) Are all devices non runnable?
+    if flag_isDevice == 1 and flag_isRunnable == 1:
+      NARS.print_error('[ERROR] Found a machine which is device and runnable (machine = {0})'.format(machine_name))
+      sys.exit(10)
+    if 'isdevice' in machine_attrib and 'runnable' not in machine_attrib:
+      NARS.print_error('[ERROR] isdevice attribute but NOT runnable attribute (machine = {0})'.format(machine_name))
+      sys.exit(10)
+    if 'isdevice' not in machine_attrib and 'runnable' in machine_attrib:
+      NARS.print_error('[ERROR] NOT isdevice attribute but runnable attribute (machine = {0})'.format(machine_name))
+      sys.exit(10)
 
-        # ~~~ Check machine display information ~~~
-        if machine_child.tag == 'display':
-          # Display type
-          # <!ATTLIST display type (raster|vector|lcd|unknown) #REQUIRED>
-          if 'type' in machine_child.attrib:
-            type_attrib = machine_child.attrib['type']
-            if type_attrib == 'raster':
-              machine_displayType_dic[machine_name] = 'Raster'
-            elif type_attrib == 'vector':
-              machine_displayType_dic[machine_name] = 'Vector'
-            elif type_attrib == 'lcd':
-              machine_displayType_dic[machine_name] = 'LCD'
-            elif type_attrib == 'unknown':
-              machine_displayType_dic[machine_name] = 'Unknown'
-            else:
-              print(machine_child.attrib)
-              print('Machine "{0}" Unknown type = {1}\n'.format(machine_name, machine_child.attrib['type']))
-              sys.exit(10)
+    # --- Raw romof/cloneof facts ---
+    if 'romof' in machine_attrib:
+      machine_romof_dic[machine_name] = machine_attrib['romof']
+    if 'cloneof' in machine_attrib:
+      machine_cloneof_dic[machine_name] = machine_attrib['cloneof']
+
+    device_ref_list = []
+    disk_list = []
+    for machine_child in machine_EL:
+      # ~~~ Check machine display information ~~~
+      if machine_child.tag == 'display':
+        # Display type
+        # <!ATTLIST display type (raster|vector|lcd|unknown) #REQUIRED>
+        if 'type' in machine_child.attrib:
+          type_attrib = machine_child.attrib['type']
+          if type_attrib == 'raster':
+            machine_displayType_dic[machine_name] = 'Raster'
+          elif type_attrib == 'vector':
+            machine_displayType_dic[machine_name] = 'Vector'
+          elif type_attrib == 'lcd':
+            machine_displayType_dic[machine_name] = 'LCD'
+          elif type_attrib == 'unknown':
+            machine_displayType_dic[machine_name] = 'Unknown'
           else:
             print(machine_child.attrib)
-            print('Machine "{0}" <display> has no "type" attribute\n'.format(machine_name))
+            print('Machine "{0}" Unknown type = {1}\n'.format(machine_name, machine_child.attrib['type']))
             sys.exit(10)
-          
-          # Check machine orientation
-          # <!ATTLIST display rotate (0|90|180|270) #REQUIRED>
-          if 'rotate' in machine_child.attrib:
-            rotate_attrib = machine_child.attrib['rotate']
-            if rotate_attrib == '0':
-              machine_orientation_dic[machine_name] = 'Horizontal'
-            elif rotate_attrib == '90':
-              machine_orientation_dic[machine_name] = 'Vertical'
-            elif rotate_attrib == '180':
-              machine_orientation_dic[machine_name] = 'Horizontal'
-            elif rotate_attrib == '270':
-              machine_orientation_dic[machine_name] = 'Vertical'
-            else:
-              print(machine_child.attrib)
-              print('Machine "{0}" Unknown rotate = {1}\n'.format(machine_name, machine_child.attrib['rotate']))
-              sys.exit(10)
-          else:
-            print(machine_child.attrib)
-            print('Machine "{0}" <display> has no "rotate" attribute\n'.format(machine_name))
-            sys.exit(10)
-
-        if machine_child.tag == 'input':
-          input_output = ET.SubElement(machine_output, 'input')
-          input_output.attrib = machine_child.attrib
-          # Traverse <input> children and copy <control> tags
-          for input_child in machine_child:
-            if input_child.tag == 'control':
-              control_output = ET.SubElement(input_output, 'control')
-              control_output.attrib = input_child.attrib
+        else:
+          print(machine_child.attrib)
+          print('Machine "{0}" <display> has no "type" attribute\n'.format(machine_name))
+          sys.exit(10)
 
-        # From tag <driver> only copy attribute status, discard the rest to save
-        # space in output XML.
-        if machine_child.tag == 'driver':
-          if 'status' in machine_child.attrib:
-            driver_output = ET.SubElement(machine_output, 'driver')
-            driver_output.attrib['status'] = machine_child.attrib['status']
+        # Check machine orientation
+        # <!ATTLIST display rotate (0|90|180|270) #REQUIRED>
+        if 'rotate' in machine_child.attrib:
+          rotate_attrib = machine_child.attrib['rotate']
+          if rotate_attrib == '0':
+            machine_orientation_dic[machine_name] = 'Horizontal'
+          elif rotate_attrib == '90':
+            machine_orientation_dic[machine_name] = 'Vertical'
+          elif rotate_attrib == '180':
+            machine_orientation_dic[machine_name] = 'Horizontal'
+          elif rotate_attrib == '270':
+            machine_orientation_dic[machine_name] = 'Vertical'
           else:
-            print('Machine "{0}" <driver> has no "status" attribute\n'.format(machine_name))
+            print(machine_child.attrib)
+            print('Machine "{0}" Unknown rotate = {1}\n'.format(machine_name, machine_child.attrib['rotate']))
             sys.exit(10)
-
-        # --- CHDs (disk) list ---
-        if machine_child.tag == 'disk' and 'name' in machine_child.attrib and \
-           'sha1' in machine_child.attrib:
-          machine_with_CHD_list.append(machine_name)
-
-        # --- List of devices with ROMs ---
-        if flag_isDevice and machine_child.tag == 'rom':
-          machine_isDevice_with_ROM_list.append(machine_name)
-            
-        # --- List of machines with ROMs ---
-        if machine_child.tag == 'rom':
-          machine_with_ROM_list.append(machine_name)
-        
-        # --- List of machines with Software Lists ---
-        if machine_child.tag == 'softwarelist':
-          machine_with_SoftList_list.append(machine_name)
-
-  # Transform lists into sets for quick membership testing. See comments above.
-  machine_isBIOS_set = set(machine_isBIOS_list)
-  machine_isDevice_with_ROM_set = set(machine_isDevice_with_ROM_list)
-  machine_with_CHD_set = set(machine_with_CHD_list)
-  machine_with_ROM_set = set(machine_with_ROM_list)
-  machine_with_SoftList_set = set(machine_with_SoftList_list)
-
-  # --- Make list of dependencies ---
-  # Dependencies can be more than 1. Also, quick indexing by name is required
-  # so use a dictionary or a set.
-  # depends_dic = { machine_name : [device/bios/chd, device/bios/chd, ...], 
-  #                 machine_name : [device/bios/chd, device/bios/chd, ...], 
-  #                 ...
-  #               }
-  Device_depends_dic = {}
-  CHD_depends_dic = {}
-  parent_bios_depends_dic = {}
-  NARS.print_info('[Checking ROM dependencies (1st pass)]')
-  for machine_EL in root_input:
-    if machine_EL.tag == 'machine':
-      machine_name = machine_EL.attrib['name']
-      if 'romof' in machine_EL.attrib:
-        # BIOS depends case a)
-        if 'cloneof' not in machine_EL.attrib:
-          parent_bios_depends_dic[machine_name] = machine_EL.attrib['romof']
-          if __debug_do_reduce_XML_dependencies:
-            print('machine ' + '{:>12}'.format(machine_name) + ' BIOS depends on ' +
-                  machine_EL.attrib['romof'] + ' (1st pass)')
-        # BIOS depends Case b) Parent should be checked
         else:
-          # print 'game = ' + machine_name + ' is a clone and parent must be checked for BIOS dependencies';
-          pass
-
-      # Machine child tags
-      # --- Check for device with ROMs dependencies and CHD dependencies ---
-      # BIOS dependencies are unique. However, device and CHD with dependencies
-      # can be multiple. Create lists with all the dependencies, and then insert
-      # that list into the dictionary as value.
-      device_depends_list = []
-      CHD_depends_list = []
-      for game_child in machine_EL:
-        # Check for devices
-        if game_child.tag == 'device_ref':
-          if 'name' in game_child.attrib:
-            device_ref_name = game_child.attrib['name']
-            # Check if device this is in the list of devices with ROMs
-            if device_ref_name in machine_isDevice_with_ROM_set:
-              if __debug_do_reduce_XML_dependencies:
-                print('machine ' + '{:>12}'.format(machine_name) +
-                      ' device depends on ' + device_ref_name)
-              device_depends_list.append(device_ref_name)
-          else:
-            print_error('device_ref has no name attribute!')
-            sys.exit(10)
-        # Check for CHDs
-        elif game_child.tag == 'disk':
-          if 'sha1' in game_child.attrib:
-            chd_name = game_child.attrib['name']
-            if __debug_do_reduce_XML_dependencies:
-              print('machine ' + '{:>12}'.format(machine_name) +
-                    ' depends on CHD ' + chd_name)
-            CHD_depends_list.append(chd_name)
-
-      # If device dependency list is not empty, insert a new entry in the
-      # dictionary of dependencies.
-      num_device_depends = len(device_depends_list)
-      num_CHD_depends = len(CHD_depends_list)
-      if num_device_depends > 0:
-        Device_depends_dic[machine_name] = device_depends_list
-      if num_CHD_depends > 0:
-        CHD_depends_dic[machine_name] = CHD_depends_list
-      if __debug_do_reduce_XML_dependencies:
-        if num_device_depends > 1:
-          print('machine ' + '{:>12}'.format(machine_name) + ' depends on ' +
-                str(num_device_depends) + ' devices with ROM')
-        if num_CHD_depends > 1:
-          print('machine ' + '{:>12}'.format(machine_name) + ' depends on ' +
-                str(num_CHD_depends) + ' CHDs')
-    else:
-      print('Found a no <machine> tag ' + machine_EL.tag)
-      sys.exit(10)
+          print(machine_child.attrib)
+          print('Machine "{0}" <display> has no "rotate" attribute\n'.format(machine_name))
+          sys.exit(10)
 
-  BIOS_depends_dic = {}
-  NARS.print_info('[Checking ROM dependencies (2nd pass)]')
-  for machine_EL in root_input:
-    if machine_EL.tag == 'machine':
-      machine_name = machine_EL.attrib['name']
-      if 'romof' in machine_EL.attrib:
-        chd_depends_list = []
-        # BIOS depends case a)
-        if 'cloneof' not in machine_EL.attrib:
-          chd_depends_list.append(machine_EL.attrib['romof'])
-          BIOS_depends_dic[machine_name] = chd_depends_list
-          if __debug_do_reduce_XML_dependencies:
-            print('machine = ' + '{:>12}'.format(machine_name) +
-                  ' BIOS depends on ' + machine_EL.attrib['romof'])
-        # BIOS depends case b) Parent should be checked
+      # --- Raw device_ref facts ---
+      elif machine_child.tag == 'device_ref':
+        if 'name' in machine_child.attrib:
+          device_ref_list.append(machine_child.attrib['name'])
         else:
-          # If parent is in this list then clone has a BIOS dependence
-          if machine_EL.attrib['cloneof'] in parent_bios_depends_dic:
-            chd_depends_list.append(parent_bios_depends_dic[machine_EL.attrib['cloneof']])
-            BIOS_depends_dic[machine_name] = chd_depends_list
-            if __debug_do_reduce_XML_dependencies:
-              print('machine = ' + '{:>12}'.format(machine_name) +
-                    ' is a clone that BIOS depends on ' + chd_depends_list[0])
-    else:
-      print('Found a no <machine> tag ' + machine_EL.tag)
-      sys.exit(10)
-
-  # --- To save memory destroy variables now
-  del tree_input
-  del root_input
-
-  # --- Incorporate dependencies into output XML ---
-  NARS.print_info('[Merging ROM dependencies in output XML]')
-  for machine_EL in root_output:
-    if machine_EL.tag == 'machine':
-      machine_name = machine_EL.attrib['name']
-      has_BIOS_dep     = machine_name in BIOS_depends_dic
-      has_devices_dep  = machine_name in Device_depends_dic
-      has_CHDs_dep     = machine_name in CHD_depends_dic
-      has_ROMs         = machine_name in machine_with_ROM_set
-      has_CHDs         = machine_name in machine_with_CHD_set
-      hasSoftwareLists = machine_name in machine_with_SoftList_list
-      # Create tag <NARS>
-      NARS_element = ET.SubElement(machine_EL, 'NARS')
-      
-      # <NARS hasROMs="yes|no" hasSoftwareLists="yes|no" displayType="Raster|Vector|LCD|Unknown" 
-      #       orientation="Horizontal|Vertical">
-      if has_ROMs:         NARS_element.attrib['hasROMs'] = "yes"
-      else:                NARS_element.attrib['hasROMs'] = "no"
-      if has_CHDs:         NARS_element.attrib['hasCHDs'] = "yes"
-      else:                NARS_element.attrib['hasCHDs'] = "no"
-      if hasSoftwareLists: NARS_element.attrib['hasSoftwareLists'] = "yes"
-      else:                NARS_element.attrib['hasSoftwareLists'] = "no"
-
-      # mechanical/device machines do not have <display> tag. Set orientation to Unknown
-      if machine_name in machine_displayType_dic:
-        NARS_element.attrib['displayType'] = machine_displayType_dic[machine_name]  
-      else:
-        NARS_element.attrib['displayType'] = 'Unknown'
-
-      # mechanical/device machines do not have <display> tag. Set orientation to Unknown
-      if machine_name in machine_orientation_dic:
-        NARS_element.attrib['orientation'] = machine_orientation_dic[machine_name]  
-      else:
-        NARS_element.attrib['orientation'] = 'Unknown'
-
-      # <NARS> tags: <BIOS>, <Device>, <CHD>
-      if has_BIOS_dep:
-        # values of BIOS_depends_dic are list of strings, even if only 1 element
-        bios_list = BIOS_depends_dic[machine_name]
-        if len(bios_list) > 1:
-          print('[ERROR] Machine ' + '{:>12}'.format(machine_name) + ' depends on more than 1 BIOS')
+          NARS.print_error('device_ref has no name attribute!')
           sys.exit(10)
-        for bios_name in bios_list:
-          bios_depends_tag = ET.SubElement(NARS_element, 'BIOS')
-          bios_depends_tag.text = bios_name
-
-      if has_devices_dep:
-        devices_list = Device_depends_dic[machine_name]
-        devices_set = set(devices_list)
-        for device_unique_name in devices_set:
-          device_depends_tag = ET.SubElement(NARS_element, 'Device')
-          device_depends_tag.text = device_unique_name
-
-      if has_CHDs_dep:
-        CHD_list = CHD_depends_dic[machine_name]
-        CHD_set = set(CHD_list)
-        if len(CHD_set) != len(CHD_list):
-          print('[WARNING] machine ' + '{:>12}'.format(machine_name) +
-                ' len(CHD_set) != len(CHD_list)')
-        for CHD_unique_name in CHD_set:
-          CHD_depends_tag = ET.SubElement(NARS_element, 'CHD')
-          CHD_depends_tag.text = CHD_unique_name
-    else:
-      print('Found a no <machine> tag ' + machine_EL.tag)
-      sys.exit(10)
 
-  # --- Pretty print XML output using miniDOM
-  # See http://broadcast.oreilly.com/2010/03/pymotw-creating-xml-documents.html
-  # NOTE this approach works well but is very slooow
-  if 0:
-    NARS.print_info('[Building reduced output XML file]')
-    rough_string = ET.tostring(root_output, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    del root_output  # Reduce memory consumption
-    NARS.print_info('Writing reduced XML file ' + output_filename)
-    f = open(output_filename, "w")
-    f.write(reparsed.toprettyxml(indent=" "))
-    f.close()
-
-  # --- Write output file (don't use miniDOM, is sloow)
-  # See http://norwied.wordpress.com/2013/08/27/307/
-  NARS.print_info('[Writing output file]')
+      # --- CHDs (disk) list ---
+      elif machine_child.tag == 'disk':
+        if 'name' in machine_child.attrib and 'sha1' in machine_child.attrib:
+          machine_with_CHD_set.add(machine_name)
+          disk_list.append(machine_child.attrib['name'])
+
+      # --- List of machines with ROMs and list of devices with ROMs ---
+      elif machine_child.tag == 'rom':
+        machine_with_ROM_set.add(machine_name)
+        if flag_isDevice:
+          machine_isDevice_with_ROM_set.add(machine_name)
+
+      # --- List of machines with Software Lists ---
+      elif machine_child.tag == 'softwarelist':
+        machine_with_SoftList_set.add(machine_name)
+
+    if device_ref_list: machine_device_ref_dic[machine_name] = tuple(device_ref_list)
+    if disk_list:       machine_disk_dic[machine_name] = tuple(disk_list)
+
+    # --- Write reduced machine to temporal file ---
+    temp_XML.write_element(reduce_MAME_machine_EL(machine_EL))
+  if temp_XML is None:
+    temp_XML = NARS.XML_Stream_Writer(temp_filename, 'mame', mame_attrib)
+  temp_XML.close()
+
+  # --- Resolve dependencies ---
+  # Dependencies can be more than 1 (devices and CHDs). BIOS dependencies are
+  # unique.
+  NARS.print_info('[Resolving ROM dependencies]')
+  # BIOS depends case a) Parent machines (no cloneof) that are romof a BIOS.
+  parent_bios_depends_dic = {}
+  for machine_name, romof_name in machine_romof_dic.items():
+    if machine_name not in machine_cloneof_dic:
+      parent_bios_depends_dic[machine_name] = romof_name
+  BIOS_depends_dic = {}
+  for machine_name, romof_name in machine_romof_dic.items():
+    # BIOS depends case a)
+    if machine_name not in machine_cloneof_dic:
+      BIOS_depends_dic[machine_name] = [romof_name]
+      if __debug_do_reduce_XML_dependencies:
+        print('machine = ' + '{:>12}'.format(machine_name) + ' BIOS depends on ' + romof_name)
+    # BIOS depends case b) If parent has a BIOS then clone has a BIOS dependence
+    elif machine_cloneof_dic[machine_name] in parent_bios_depends_dic:
+      BIOS_depends_dic[machine_name] = [parent_bios_depends_dic[machine_cloneof_dic[machine_name]]]
+      if __debug_do_reduce_XML_dependencies:
+        print('machine = ' + '{:>12}'.format(machine_name) +
+              ' is a clone that BIOS depends on ' + BIOS_depends_dic[machine_name][0])
+
+  # Only devices that have ROMs are dependencies
+  Device_depends_dic = {}
+  for machine_name, device_ref_tuple in machine_device_ref_dic.items():
+    device_depends_list = [d for d in device_ref_tuple if d in machine_isDevice_with_ROM_set]
+    if device_depends_list:
+      Device_depends_dic[machine_name] = device_depends_list
+      if __debug_do_reduce_XML_dependencies and len(device_depends_list) > 1:
+        print('machine ' + '{:>12}'.format(machine_name) + ' depends on ' +
+              str(len(device_depends_list)) + ' devices with ROM')
+
+  # CHD dependencies are the machine disks.
+  CHD_depends_dic = machine_disk_dic
+  del machine_device_ref_dic, machine_romof_dic, machine_cloneof_dic
+
+  # --- Attach <NARS> tags and write output file ---
+  NARS.print_info('[Adding NARS tags to reduced MAME XML]')
   NARS.print_info('Writing reduced XML file ' + output_filename)
-  NARS.indent_ElementTree_XML(root_output)
-  tree_output.write(output_filename, xml_declaration=True, encoding='utf-8', method="xml")
+  output_XML = NARS.XML_Stream_Writer(output_filename, 'mame', mame_attrib)
+  for machine_output in NARS.XML_iterparse_file(temp_filename, "Parsing temporal XML file"):
+    machine_name = machine_output.attrib['name']
+    # mechanical/device machines do not have <display> tag. Set display type
+    # and orientation to Unknown
+    make_NARS_element(machine_output,
+                      machine_name in machine_with_ROM_set,
+                      machine_name in machine_with_CHD_set,
+                      machine_name in machine_with_SoftList_set,
+                      machine_displayType_dic.get(machine_name, 'Unknown'),
+                      machine_orientation_dic.get(machine_name, 'Unknown'),
+                      BIOS_depends_dic.get(machine_name, ()),
+                      Device_depends_dic.get(machine_name, ()),
+                      CHD_depends_dic.get(machine_name, ()))
+    output_XML.write_element(machine_output)
+  output_XML.close()
+  os.remove(temp_filename)
 
 def do_merge():
   """Merges main MAME database ready for filtering"""
@@ -2669,6 +2639,8 @@ def do_list_filters():
       NARS.print_info('Merged_XML      {0}'.format(root_child.text))
     elif root_child.tag == 'Catver':
       NARS.print_info('Catver          {0}'.format(root_child.text))
+    elif root_child.tag == 'DerivedArtworkCache':
+      NARS.print_info('DerivedArtworkCache {0}'.format(root_child.text))
     elif root_child.tag == 'Genre':
       NARS.print_info('Genre           {0}'.format(root_child.text))
     elif root_child.tag == 'MachineSwap':
@@ -2780,6 +2752,7 @@ def do_check(filterName):
 
   # --- Create main ROM list in sourceDir -------------------------------------
   # rom_main_list = get_ROM_main_list(filter_config.sourceDir)
+  source_snapshot = NARS.fs_dir_snapshot(filter_config['SourceROMs'])
 
   # --- Print list in alphabetical order ---
   NARS.print_info('[Filtered machine list]')
@@ -2792,9 +2765,8 @@ def do_check(filterName):
     # If machine has no ROMs then skip checking
     if romObject.hasROMs:
       num_roms += 1
-      sourceFullFilename = filter_config['SourceROMs'] + romObject.name + '.zip'
       fileName = romObject.name + '.zip'
-      if not os.path.isfile(sourceFullFilename):
+      if not source_snapshot.has_file(fileName):
         missing_roms += 1
         flag_str = 'Missing ROM'
         NARS.print_info("<Machine> " + romObject.name.ljust(12) + flag_str.rjust(12) + '  ' +
@@ -2858,7 +2830,9 @@ def do_update(filterName):
   rom_copy_list = create_copy_list(mame_filtered_dic, rom_main_list)
 
   # --- Copy/Update ROMs into destDir -----------------------------------------
-  NARS.copy_ROM_list(rom_copy_list, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run)
+  NARS.set_rate_limit(filter_config['MaxBytesPerSecond'], filter_config['MaxFilesPerSecond'])
+  NARS.copy_ROM_list(rom_copy_list, sourceDir, destDir, __prog_option_sync, __prog_option_dry_run,
+                     __prog_option_workers, __prog_option_verify_hash, __prog_option_link)
 
   # If --cleanROMs is on then delete unknown files.
   if __prog_option_clean_ROMs:
@@ -2872,6 +2846,61 @@ def do_update(filterName):
   if __prog_option_clean_NFO:
     NARS.clean_NFO_destDir(destDir, __prog_option_dry_run)
 
+# -------------------------------------------------------------------------------------------------
+# Copy ROMs of every filter in destDirs
+def do_update_all():
+  """Applies every filter and copies ROMs, reading each source ROM only once"""
+
+  NARS.print_info('[Copy/Update ROMs of all filters]')
+
+  # --- Check for errors, missing paths, etc... -------------------------------
+  # Filters without ROM directories (for example, CHD only filters) are skipped.
+  filter_name_list = []
+  for filterName in configuration.filters:
+    filter_config = configuration.filters[filterName]
+    if not filter_config['SourceROMs'] or not filter_config['DestinationROMs']:
+      NARS.print_info('Skipping filter ' + filterName + ' (ROM directories not configured)')
+      continue
+    NARS.have_dir_or_abort(filter_config['SourceROMs'], 'SourceROMs')
+    NARS.have_dir_or_abort(filter_config['DestinationROMs'], 'DestinationROMs')
+    filter_name_list.append(filterName)
+
+  # --- Get MAME parent/clone dictionary --------------------------------------
+  mame_xml_dic = parse_MAME_merged_XML()
+
+  # --- Apply filters and create union of copy plans --------------------------
+  # Filters sharing a source directory read it only once.
+  rom_main_list_dic = {}
+  plan_list = []
+  for filterName in filter_name_list:
+    NARS.print_info('Filter name = ' + filterName)
+    filter_config = configuration.filters[filterName]
+    sourceDir = filter_config['SourceROMs']
+    destDir   = filter_config['DestinationROMs']
+    if sourceDir not in rom_main_list_dic:
+      rom_main_list_dic[sourceDir] = get_ROM_main_list(sourceDir)
+    mame_filtered_dic = filter_MAME_machines(mame_xml_dic, filter_config)
+    rom_copy_list = create_copy_list(mame_filtered_dic, rom_main_list_dic[sourceDir])
+    plan_list.append((filterName, sourceDir, destDir, rom_copy_list, mame_filtered_dic))
+
+  # --- Copy/Update ROMs into destDirs ----------------------------------------
+  # All filters copy at the same time, so the strictest limits apply.
+  filter_config_list = [configuration.filters[filterName] for filterName in filter_name_list]
+  bytes_limit_list = [fc['MaxBytesPerSecond'] for fc in filter_config_list if fc['MaxBytesPerSecond'] > 0]
+  files_limit_list = [fc['MaxFilesPerSecond'] for fc in filter_config_list if fc['MaxFilesPerSecond'] > 0]
+  NARS.set_rate_limit(min(bytes_limit_list) if bytes_limit_list else 0,
+                      min(files_limit_list) if files_limit_list else 0)
+  NARS.copy_ROM_fanout([plan[0:4] for plan in plan_list], __prog_option_sync, __prog_option_dry_run,
+                       __prog_option_workers)
+
+  for (filterName, sourceDir, destDir, rom_copy_list, mame_filtered_dic) in plan_list:
+    if __prog_option_clean_ROMs:
+      NARS.clean_ROMs_destDir(rom_copy_list, destDir, __prog_option_dry_run)
+    if __prog_option_generate_NFO:
+      generate_MAME_NFO_files(rom_copy_list, mame_filtered_dic, destDir, __prog_option_dry_run)
+    if __prog_option_clean_NFO:
+      NARS.clean_NFO_destDir(destDir, __prog_option_dry_run)
+
 # -------------------------------------------------------------------------------------------------
 # Copy ROMs in destDir
 def do_update_CHD(filterName):
@@ -2905,7 +2934,10 @@ def do_update_CHD(filterName):
   CHD_dic = create_copy_CHD_dic(mame_filtered_dic)
 
   # --- Copy/Update CHDs into destDir -----------------------------------------
-  NARS.copy_CHD_dic(CHD_dic, sourceDir_CHD, destDir, __prog_option_sync, __prog_option_dry_run)
+  NARS.set_rate_limit(filter_config['MaxBytesPerSecond'], filter_config['MaxFilesPerSecond'])
+  NARS.copy_CHD_dic(CHD_dic, sourceDir_CHD, destDir, __prog_option_sync, __prog_option_dry_run,
+                    __prog_option_workers, __prog_option_verify_hash, __prog_option_link,
+                    __prog_option_delta_CHD)
 
   # If --cleanCHDs is on then delete unknown CHD and directories.
   if __prog_option_clean_CHD:
@@ -2915,18 +2947,20 @@ def do_update_CHD(filterName):
 A_NAME   = 0
 A_SOURCE = 1
 A_DEST   = 2
+A_EXT    = 3
+A_TRANSCODE = 4
 MAME_ARTWORK_LIST = [
-    ('Titles',     'SourceTitles',     'DestinationTitles'),
-    ('Snaps',      'SourceSnaps',      'DestinationSnaps'),
-    ('Fanarts',    'SourceFanarts',    'DestinationFanarts'),
-    ('Marquees',   'SourceMarquees',   'DestinationMarquees'),
-    ('Clearlogos', 'SourceClearlogos', 'DestinationClearlogos'),
-    ('Cabinets',   'SourceCabinets',   'DestinationCabinets'),
-    ('CPanels',    'SourceCPanels',    'DestinationCPanels'),
-    ('PCBs',       'SourcePCBs',       'DestinationPCBs'),
-    ('Flyers',     'SourceFlyers',     'DestinationFlyers'),
-    ('Manuals',    'SourceManuals',    'DestinationManuals'),
-    ('Trailers',   'SourceTrailers',   'DestinationTrailers')
+    ('Titles',     'SourceTitles',     'DestinationTitles',     NARS.artwork_image_ext_list,   'TranscodeTitles'),
+    ('Snaps',      'SourceSnaps',      'DestinationSnaps',      NARS.artwork_image_ext_list,   'TranscodeSnaps'),
+    ('Fanarts',    'SourceFanarts',    'DestinationFanarts',    NARS.artwork_image_ext_list,   'TranscodeFanarts'),
+    ('Marquees',   'SourceMarquees',   'DestinationMarquees',   NARS.artwork_image_ext_list,   'TranscodeMarquees'),
+    ('Clearlogos', 'SourceClearlogos', 'DestinationClearlogos', NARS.artwork_image_ext_list,   'TranscodeClearlogos'),
+    ('Cabinets',   'SourceCabinets',   'DestinationCabinets',   NARS.artwork_image_ext_list,   'TranscodeCabinets'),
+    ('CPanels',    'SourceCPanels',    'DestinationCPanels',    NARS.artwork_image_ext_list,   'TranscodeCPanels'),
+    ('PCBs',       'SourcePCBs',       'DestinationPCBs',       NARS.artwork_image_ext_list,   'TranscodePCBs'),
+    ('Flyers',     'SourceFlyers',     'DestinationFlyers',     NARS.artwork_image_ext_list,   'TranscodeFlyers'),
+    ('Manuals',    'SourceManuals',    'DestinationManuals',    NARS.artwork_manual_ext_list,  None),
+    ('Trailers',   'SourceTrailers',   'DestinationTrailers',   NARS.artwork_trailer_ext_list, None)
 ]
 
 #
@@ -2934,7 +2968,7 @@ MAME_ARTWORK_LIST = [
 #
 def do_check_Artwork(filterName):
     NARS.print_info('[Check-ArtWork]')
-    NARS.p_info('Filter name {0}'.format(filter_name))
+    NARS.print_info('Filter name {0}'.format(filterName))
 
     # --- Get configuration for the selected filter and check for errors ---
     filter_config = get_Filter_from_Config(filterName)
@@ -2957,6 +2991,13 @@ def do_check_Artwork(filterName):
         enabled_asset_list[index] = True if (SourceConfigured and DestConfigured and \
                                              SourceExists and DestExists) else False
 
+    # --- Scan every enabled asset source directory once ---
+    # >> Have/miss decisions below are answered from these snapshots.
+    source_snapshot_list = [None] * len(MAME_ARTWORK_LIST)
+    for index, item in enumerate(MAME_ARTWORK_LIST):
+        if not enabled_asset_list[index]: continue
+        source_snapshot_list[index] = NARS.fs_dir_snapshot(filter_config[item[A_SOURCE]])
+
     # --- Create a list of ROMs in destDir ---
     roms_destDir_list = NARS.fs_create_dir_list_files(destDir, '.zip')
 
@@ -3000,9 +3041,7 @@ def do_check_Artwork(filterName):
         have_asset_list = [False] * len(MAME_ARTWORK_LIST)
         for index, item in enumerate(MAME_ARTWORK_LIST):
             if not enabled_asset_list[index]: continue
-            source_dir = filter_config[item[A_SOURCE]]
-            thumb_Source_fullFileName = source_dir + art_baseName + '.png'
-            if os.path.isfile(thumb_Source_fullFileName):
+            if source_snapshot_list[index].resolve(art_baseName, item[A_EXT]) is not None:
                 num_have_thumbs += 1
                 have_asset_list[index] = True
             else:
@@ -3038,6 +3077,7 @@ def do_update_Artwork(filterName):
     filter_config = get_Filter_from_Config(filterName)
     destDir = filter_config['DestinationROMs']
     NARS.have_dir_or_abort(destDir, 'DestinationROMs')
+    NARS.set_rate_limit(filter_config['MaxBytesPerSecond'], filter_config['MaxFilesPerSecond'])
 
     # --- Check for missing paths ---
     # >> If source/dest path is '', disable that asset.
@@ -3055,6 +3095,14 @@ def do_update_Artwork(filterName):
         enabled_asset_list[index] = True if (SourceConfigured and DestConfigured and 
                                              SourceExists and DestExists) else False
 
+    # --- Scan every enabled asset source/dest directory once ---
+    source_snapshot_list = [None] * len(MAME_ARTWORK_LIST)
+    dest_snapshot_list   = [None] * len(MAME_ARTWORK_LIST)
+    for index, item in enumerate(MAME_ARTWORK_LIST):
+        if not enabled_asset_list[index]: continue
+        source_snapshot_list[index] = NARS.fs_dir_snapshot(filter_config[item[A_SOURCE]])
+        dest_snapshot_list[index]   = NARS.fs_dir_snapshot(filter_config[item[A_DEST]])
+
     # --- Create a list of ROMs in destDir ---
     roms_destDir_list = NARS.fs_create_dir_list_files(destDir, '.zip')
 
@@ -3071,23 +3119,48 @@ def do_update_Artwork(filterName):
     for rom in rom_copy_list: artwork_copy_dic[rom] = rom
 
     # --- Copy/Update artwork ---
+    # >> Every enabled asset is a work queue. Queues share --workers threads.
+    art_baseName_list = []
     for rom_baseName in sorted(roms_destDir_list):
         if rom_baseName not in artwork_copy_dic:
             print(' Not found')
             sys.exit(10)
-        else:
-            art_baseName = artwork_copy_dic[rom_baseName]
+        art_baseName_list.append(artwork_copy_dic[rom_baseName])
+    asset_plan_list = []
+    for index, item in enumerate(MAME_ARTWORK_LIST):
+        if not enabled_asset_list[index]: continue
+        transcode_spec = filter_config[item[A_TRANSCODE]] if item[A_TRANSCODE] else None
+        asset_plan_list.append((item[A_NAME], filter_config[item[A_SOURCE]], filter_config[item[A_DEST]],
+                                art_baseName_list, source_snapshot_list[index], dest_snapshot_list[index],
+                                item[A_EXT], transcode_spec))
+
+    # >> Images of assets with a <Transcode*> tag are transcoded into the derived cache.
+    transcoder = None
+    if any(asset_plan[7] is not None for asset_plan in asset_plan_list):
+        if NARS.Image is None:
+            NARS.print_error('[ERROR] Transcoding artwork needs Pillow. Install it with "pip install Pillow".')
+            sys.exit(10)
+        derived_cache_dir = configuration.options['DerivedArtworkCache']
+        if not derived_cache_dir:
+            NARS.print_error('[ERROR] Transcoding artwork needs a <DerivedArtworkCache> directory.')
+            sys.exit(10)
+        NARS.have_dir_or_abort(derived_cache_dir, 'DerivedArtworkCache')
+        transcoder = NARS.Artwork_Transcoder(derived_cache_dir, __prog_option_workers, __prog_option_dry_run)
+    counter_dic = NARS.copy_ArtWork_asset_list(asset_plan_list, __prog_option_sync, __prog_option_dry_run,
+                                               __prog_option_workers, transcoder)
+    if transcoder is not None: transcoder.close()
 
-        for index, item in enumerate(MAME_ARTWORK_LIST):
-            if not enabled_asset_list[index]: continue
-            asset_name = item[A_NAME]
-            source_dir = filter_config[item[A_SOURCE]]
-            dest_dir   = filter_config[item[A_DEST]]
-            NARS.copy_ArtWork_file(art_baseName, asset_name, source_dir, dest_dir, __prog_option_sync, __prog_option_dry_run)
+    # --- Report ---
+    NARS.print_info('[Report]')
+    NARS.print_info('Asset         Copied  Updated  Missing   Errors')
+    for asset_plan in asset_plan_list:
+        counter = counter_dic[asset_plan[0]]
+        NARS.print_info('{0:<12} {1:7d}  {2:7d}  {3:7d}  {4:7d}'.format(
+            asset_plan[0], counter['copied'], counter['updated'], counter['missing'], counter['error']))
 
     # --- If --cleanArtWork is on then delete unknown files.
-    # if __prog_option_clean_ArtWork:
-    #     NARS.clean_ArtWork_destDir(filter_config, artwork_copy_dic, __prog_option_dry_run)
+    if __prog_option_clean_ArtWork:
+        NARS.clean_ArtWork_destDir(asset_plan_list, __prog_option_dry_run)
 
 def do_printHelp():
     print("""\033[32mUsage: nars-mame.py [options] <command> [filter]\033[0m
@@ -3108,6 +3181,8 @@ def do_printHelp():
 \033[31mcheck <filter>\033[0m            Applies filter and checks you source directory for Have and Missing ROMs.
 \033[31mcopy <filter>\033[0m             Applies filter and copies sourceDir ROMs into destDir.
 \033[31mupdate <filter>\033[0m           Like copy, but only copies files if file size is different.
+\033[31mcopy-all\033[0m                  Like copy for every filter, reading each source ROM only once.
+\033[31mupdate-all\033[0m                Like update for every filter, reading each source ROM only once.
 \033[31mcopy-chd <filter>\033[0m         Applies filter and copies sourceDir CHDs into destDir.
 \033[31mupdate-chd <filter>\033[0m       Like copy-chd, but only copies files if CHD size is different.
 \033[31mcheck-artwork <filter>\033[0m    Checks for Have and Missing artwork.
@@ -3124,7 +3199,11 @@ def do_printHelp():
 \033[35m--generateNFO\033[0m             Generates NFO files with game information for the launchers.
 \033[35m--cleanNFO\033[0m                Deletes ROMs in destDir not present in the filtered ROM list.
 \033[35m--cleanCHD\033[0m                Deletes unknown CHDs in destination directory.
-\033[35m--cleanArtWork\033[0m            Deletes unknown Artowork in destination directories.""")
+\033[35m--cleanArtWork\033[0m            Deletes unknown Artowork in destination directories.
+\033[35m--workers\033[0m \033[31m[N]\033[0m             Copy N files at the same time (default 1).
+\033[35m--verifyHash\033[0m              update and update-chd compare file contents, not only sizes.
+\033[35m--link\033[0m \033[31m[hard|sym]\033[0m        ROMs and CHDs are hardlinked or symlinked instead of copied.
+\033[35m--deltaCHD\033[0m                update-chd only rewrites the changed blocks of CHDs.""")
 
 # -------------------------------------------------------------------------------------------------
 # main function
@@ -3143,12 +3222,16 @@ parser.add_argument('--generateNFO', help="generate NFO files", action="store_tr
 parser.add_argument('--cleanNFO', help="clean redundant NFO files", action="store_true")
 parser.add_argument('--cleanArtWork', help="clean unknown ArtWork", action="store_true")
 parser.add_argument('--cleanCHD', help="clean unknown CHDs", action="store_true")
+parser.add_argument('--workers', help="number of files copied in parallel", type = int, nargs = 1)
+parser.add_argument('--verifyHash', help="update compares file contents", action="store_true")
+parser.add_argument('--link', help="link ROMs/CHDs instead of copying", choices = NARS.link_mode_list, nargs = 1)
+parser.add_argument('--deltaCHD', help="update-chd rewrites changed blocks only", action="store_true")
 parser.add_argument('command',
     help="usage, reduce-XML, merge, list-merged, \
           list-categories, list-genres, \
           list-drivers, list-controls, list-years,\
           query, list, diff, \
-          check, copy, update \
+          check, copy, update, copy-all, update-all \
           copy-chd, update-chd \
           check-artwork, copy-artwork, update-artwork", nargs = 1)
 parser.add_argument("filterNameA", help="MAME ROM filter name", nargs = '?')
@@ -3177,6 +3260,14 @@ if args.generateNFO:  __prog_option_generate_NFO = 1
 if args.cleanNFO:     __prog_option_clean_NFO = 1
 if args.cleanArtWork: __prog_option_clean_ArtWork = 1
 if args.cleanCHD:     __prog_option_clean_CHD = 1
+if args.verifyHash:   __prog_option_verify_hash = 1
+if args.link:         __prog_option_link = args.link[0]
+if args.deltaCHD:     __prog_option_delta_CHD = 1
+if args.workers:
+  if args.workers[0] < 1:
+    print('\033[31m[ERROR]\033[0m --workers must be 1 or more')
+    sys.exit(10)
+  __prog_option_workers = args.workers[0]
 
 # --- Positional arguments that don't require parsing of the config file ---
 command = args.command[0]
@@ -3190,6 +3281,33 @@ if command == 'diff':
     print('\033[31m[ERROR]\033[0m Command "{0}" requires two filter names'.format(command))
     sys.exit(10)
 
+# ~~~ copy-all/update-all read each source ROM once, linking reads nothing ~~~
+if command == 'copy-all' or command == 'update-all':
+  if __prog_option_link:
+    print('\033[31m[ERROR]\033[0m --link cannot be used with {0}. Use copy/update with each filter.'.format(command))
+    sys.exit(10)
+
+# ~~~ --deltaCHD only has effect when updating copied CHDs ~~~
+if __prog_option_delta_CHD:
+  if command != 'update-chd':
+    print('\033[31m[ERROR]\033[0m --deltaCHD only works with command update-chd')
+    sys.exit(10)
+  if __prog_option_link:
+    print('\033[31m[ERROR]\033[0m --deltaCHD cannot be used with --link')
+    sys.exit(10)
+
+# ~~~ --verifyHash only has effect when updating copied files ~~~
+if __prog_option_verify_hash:
+  if command != 'update' and command != 'update-chd':
+    print('\033[31m[ERROR]\033[0m --verifyHash only works with commands update and update-chd')
+    sys.exit(10)
+  if __prog_option_link:
+    print('\033[31m[ERROR]\033[0m --verifyHash cannot be used with --link')
+    sys.exit(10)
+  if __prog_option_delta_CHD:
+    print('\033[31m[ERROR]\033[0m --verifyHash cannot be used with --deltaCHD (delta sync already compares contents)')
+    sys.exit(10)
+
 if command == 'query' or \
    command == 'check' or command == 'copy' or command == 'update' or \
    command == 'copy-chd' or command == 'update-chd' or \
@@ -3218,6 +3336,10 @@ elif command == 'copy':            do_update(args.filterNameA)
 elif command == 'update':
     __prog_option_sync = 1
     do_update(args.filterNameA)
+elif command == 'copy-all':        do_update_all()
+elif command == 'update-all':
+    __prog_option_sync = 1
+    do_update_all()
 elif command == 'copy-chd':        do_update_CHD(args.filterNameA)
 elif command == 'update-chd':
     __prog_option_sync = 1